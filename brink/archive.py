@@ -0,0 +1,718 @@
+# Copyright (c) 2020 Adi Roiban.
+# See LICENSE for details.
+"""
+Creation of distributable archives.
+"""
+from __future__ import (
+    absolute_import,
+    print_function,
+    with_statement,
+    unicode_literals,
+    )
+from collections import deque
+from contextlib import closing
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+import errno
+import io
+import json
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import time
+import traceback
+import zlib
+
+from brink.execute import _get_rss_kb, _POOL_WAIT_TIMEOUT
+from brink.filesystem import _to_text, wait_background_deletes
+
+# Size of the buffer used when reading files to be compressed.
+ARCHIVE_BUFFER_SIZE = 1024 * 1024
+
+# Compressed members larger than this are spilled to disk while they
+# wait to be written in the archive.
+SPILL_SIZE = 4 * 1024 * 1024
+
+# Size of the blocks which are compressed independently in a gzip stream.
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+# Compression level used by the gzip command.
+GZIP_LEVEL = 6
+
+# Gzip header without file name and modification time, and with an
+# unknown OS, so that it is the same on all systems.
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+# Extensions of files which are already compressed and are stored in
+# archives without compression.
+COMPRESSED_EXTENSIONS = frozenset([
+    '.7z',
+    '.bz2',
+    '.cab',
+    '.egg',
+    '.gif',
+    '.gz',
+    '.jar',
+    '.jpeg',
+    '.jpg',
+    '.msi',
+    '.png',
+    '.tgz',
+    '.whl',
+    '.xz',
+    '.zip',
+    ])
+
+# Size of the sample compressed to check if a file is compressible.
+PROBE_SIZE = 64 * 1024
+
+# Files for which the sample does not compress below this ratio are
+# stored without compression.
+STORE_RATIO = 0.95
+
+# Attribute for folder members, as used by MS-DOS.
+_ZIP_FOLDER_ATTRIBUTE = 16
+
+
+def _native(path):
+    """
+    Return `path` as the native `str` used by zipfile for member names.
+    """
+    if isinstance(path, str):
+        return path
+    if bytes is str:
+        return path.encode('utf-8')
+    return path.decode('utf-8')
+
+
+class CompressionPolicy(object):
+    """
+    Choose the archive members which are stored without compression.
+
+    Files are stored when they have the extension of a compressed format,
+    or when a sample of their content does not compress.
+    Extensions from `deflate` are always compressed.
+    """
+
+    def __init__(
+            self, store=(), deflate=(), store_ratio=STORE_RATIO,
+            probe_size=PROBE_SIZE):
+        self.store = tuple(sorted(
+            COMPRESSED_EXTENSIONS |
+            set(_to_text(name).lower() for name in store)
+            ))
+        self.deflate = tuple(sorted(
+            set(_to_text(name).lower() for name in deflate)))
+        self.store_ratio = store_ratio
+        self.probe_size = probe_size
+
+    @classmethod
+    def fromConfiguration(cls, configuration):
+        """
+        Return the policy for the `compression` configuration of
+        a product.
+        """
+        return cls(
+            store=configuration.get('store', ()),
+            deflate=configuration.get('deflate', ()),
+            store_ratio=configuration.get('store_ratio', STORE_RATIO),
+            )
+
+    def matchName(self, path):
+        """
+        Return True if the file should be stored based on its name,
+        False if it should be compressed and None when the content needs
+        to be checked.
+        """
+        name = _to_text(path).lower()
+        if name.endswith(self.deflate):
+            return False
+        if name.endswith(self.store):
+            return True
+        return None
+
+    def isIncompressible(self, data):
+        """
+        Return True if the first part of `data` does not compress.
+        """
+        sample = data[:self.probe_size]
+        if not sample:
+            return False
+        compressed = zlib.compress(sample, 1)
+        return len(compressed) >= len(sample) * self.store_ratio
+
+    def isStored(self, path):
+        """
+        Return True if the file at `path` should be stored without
+        compression.
+        """
+        stored = self.matchName(path)
+        if stored is not None:
+            return stored
+        with io.open(path, 'rb') as input_file:
+            return self.isIncompressible(input_file.read(self.probe_size))
+
+
+class _StoreCompressor(object):
+    """
+    Compressor which keeps the data as it is.
+    """
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+def _list_members(source_path, exclude):
+    """
+    Return the sorted list of (path, name) for the members of a zip archive
+    containing the `source_path` folder.
+
+    Path is None for empty folders.
+    """
+    parent_path = os.path.dirname(source_path)
+
+    def get_name(path):
+        name = _native(path[len(parent_path):])
+        return name.replace(os.sep, '/').lstrip('/')
+
+    members = []
+    for root, dirs, files in os.walk(source_path):
+        dirs.sort()
+        files = sorted(
+            name for name in files if _native(name) not in exclude)
+        for name in files:
+            path = os.path.join(root, name)
+            members.append((path, get_name(path)))
+
+        # For empty folders, we need to create a special member.
+        if not files and not dirs:
+            members.append((None, get_name(root) + '/'))
+
+    members.sort(key=lambda member: member[1])
+    return members
+
+
+def _compress_member(member, policy, level):
+    """
+    Return the (ZipInfo, data) for a zip member, with `data` being
+    a file with the content of the member, deflated with `level` or
+    stored as selected by `policy`.
+
+    Called in a worker thread, as zlib releases the GIL while compressing.
+    """
+    path, name = member
+    if path is None:
+        info = ZipInfo(name)
+        info.external_attr = _ZIP_FOLDER_ATTRIBUTE
+        info.compress_type = ZIP_STORED
+        info.file_size = 0
+        info.compress_size = 0
+        info.CRC = 0
+        return info, None
+
+    status = os.stat(path)
+    info = ZipInfo(name, time.localtime(status.st_mtime)[0:6])
+    info.external_attr = (status.st_mode & 0xFFFF) << 16
+
+    data = tempfile.SpooledTemporaryFile(max_size=SPILL_SIZE)
+    crc = 0
+    size = 0
+    try:
+        with io.open(path, 'rb') as input_file:
+            chunk = input_file.read(ARCHIVE_BUFFER_SIZE)
+            stored = policy.matchName(name)
+            if stored is None:
+                stored = policy.isIncompressible(chunk)
+
+            if stored:
+                info.compress_type = ZIP_STORED
+                compressor = _StoreCompressor()
+            else:
+                info.compress_type = ZIP_DEFLATED
+                # Raw deflate, as used by zipfile.
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+            while chunk:
+                size += len(chunk)
+                crc = zlib.crc32(chunk, crc)
+                data.write(compressor.compress(chunk))
+                chunk = input_file.read(ARCHIVE_BUFFER_SIZE)
+        data.write(compressor.flush())
+    except Exception:
+        data.close()
+        raise
+
+    info.file_size = size
+    info.compress_size = data.tell()
+    info.CRC = crc & 0xffffffff
+    data.seek(0)
+    return info, data
+
+
+def _write_member(archive, info, data):
+    """
+    Write a member which was already compressed at the end of `archive`.
+
+    zipfile has no public API for writing compressed data, so this does
+    what `ZipFile.writestr` does after compressing the data.
+    """
+    output = archive.fp
+    info.header_offset = output.tell()
+    output.write(info.FileHeader())
+    if data is not None:
+        shutil.copyfileobj(data, output, ARCHIVE_BUFFER_SIZE)
+    archive.start_dir = output.tell()
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+    archive._didModify = True
+
+
+def _write_compressed(archive, result):
+    """
+    Write the (ZipInfo, data) `result` of _compress_member to `archive`.
+    """
+    info, data = result
+    try:
+        _write_member(archive, info, data)
+    finally:
+        if data is not None:
+            data.close()
+
+
+def create_zip_archive(
+        source_path, archive_path, exclude=(), max_workers=None,
+        policy=None, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Create a zip file at `archive_path` with the `source_path` folder.
+
+    Members are compressed in parallel, using at most `max_workers`
+    threads, and written in sorted order by the calling thread, so that
+    the archive is the same for the same files.
+    As for ParallelGzipWriter, at most 2 compressed members per worker
+    wait to be written.
+    `policy` is the CompressionPolicy for selecting the stored members.
+    """
+    if policy is None:
+        policy = CompressionPolicy()
+    compress = partial(_compress_member, policy=policy, level=level)
+    members = _list_members(source_path, exclude)
+
+    if max_workers is None:
+        max_workers = cpu_count()
+    max_workers = max(1, min(max_workers, len(members)))
+
+    pool = None
+    if max_workers > 1:
+        pool = ThreadPool(max_workers)
+    pending = deque()
+    max_pending = 2 * max_workers
+
+    try:
+        archive = ZipFile(_native(archive_path), 'w', allowZip64=True)
+        with closing(archive):
+            for member in members:
+                if pool is None:
+                    _write_compressed(archive, compress(member))
+                    continue
+                pending.append(pool.apply_async(compress, (member,)))
+                while len(pending) > max_pending:
+                    _write_compressed(
+                        archive, pending.popleft().get(_POOL_WAIT_TIMEOUT))
+            while pending:
+                _write_compressed(
+                    archive, pending.popleft().get(_POOL_WAIT_TIMEOUT))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        # Members compressed before an error.
+        for result in pending:
+            if result.ready() and result.successful():
+                _, data = result.get()
+                if data is not None:
+                    data.close()
+
+
+def _deflate_block(job):
+    """
+    Return the raw deflate data for a block of a gzip stream.
+
+    All blocks except the last one end on a byte boundary, so that they
+    can be concatenated in a single deflate stream.
+    Called in a worker thread, as zlib releases the GIL while compressing.
+    """
+    data, level, last = job
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    if last:
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    """
+    Write-only file which compresses the written data as a gzip stream,
+    using multiple threads.
+
+    Data is split in blocks which are compressed independently, as done
+    by pigz, and are written in order to `output`.
+    The result is the same for the same data, regardless of the number
+    of workers.
+    """
+
+    def __init__(
+            self, output, level=GZIP_LEVEL, block_size=GZIP_BLOCK_SIZE,
+            max_workers=None):
+        if max_workers is None:
+            max_workers = cpu_count()
+        self._output = output
+        self._level = level
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._crc = 0
+        self._size = 0
+        self._pending = deque()
+        self._max_pending = 2 * max_workers
+        self._pool = None
+        if max_workers > 1:
+            self._pool = ThreadPool(max_workers)
+        self._output.write(_GZIP_HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stopPool()
+
+    def write(self, data):
+        """
+        Add `data` to the stream.
+        """
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer.extend(data)
+        while len(self._buffer) > self._block_size:
+            block = bytes(self._buffer[:self._block_size])
+            del self._buffer[:self._block_size]
+            self._addBlock(block, last=False)
+
+    def tell(self):
+        """
+        Return the size of the uncompressed data written so far.
+        """
+        return self._size
+
+    def setLevel(self, level):
+        """
+        Compress the data written from now on using `level`.
+        """
+        if level == self._level:
+            return
+        if self._buffer:
+            self._addBlock(bytes(self._buffer), last=False)
+            del self._buffer[:]
+        self._level = level
+
+    def close(self):
+        """
+        Write the remaining data and the gzip trailer.
+        """
+        if self._output is None:
+            return
+        try:
+            self._addBlock(bytes(self._buffer), last=True)
+            while self._pending:
+                self._writePending()
+            self._output.write(struct.pack(
+                '<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+        finally:
+            self._output = None
+            self._buffer = None
+            self._stopPool()
+
+    def _addBlock(self, block, last):
+        """
+        Start the compression of `block`.
+        """
+        job = (block, self._level, last)
+        if self._pool is None:
+            self._output.write(_deflate_block(job))
+            return
+
+        self._pending.append(self._pool.apply_async(_deflate_block, (job,)))
+        while len(self._pending) > self._max_pending:
+            self._writePending()
+
+    def _writePending(self):
+        """
+        Wait for the oldest block and write it.
+        """
+        self._output.write(self._pending.popleft().get(_POOL_WAIT_TIMEOUT))
+
+    def _stopPool(self):
+        """
+        Stop the worker threads.
+        """
+        if self._pool is None:
+            return
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+
+
+def _list_tar_members(source_path):
+    """
+    Return the sorted list of paths to be added in a tar archive
+    containing the `source_path` folder.
+    """
+    members = []
+    for root, dirs, files in os.walk(source_path):
+        dirs.sort()
+        members.append(root)
+        members.extend(os.path.join(root, name) for name in sorted(files))
+        # Links to folders are listed as folders, but are not followed.
+        members.extend(
+            os.path.join(root, name) for name in dirs
+            if os.path.islink(os.path.join(root, name))
+            )
+    return members
+
+
+def create_tar_gz_archive(
+        source_path, archive_path, max_workers=None, mtime=None,
+        level=GZIP_LEVEL, policy=None):
+    """
+    Create a tar.gz file at `archive_path` with the `source_path` folder.
+
+    The archive is streamed and compressed in parallel, without an
+    intermediate tar file.
+    Members are sorted and owned by root.
+    When `mtime` is defined, newer modification times are set to it.
+
+    The data of files stored by `policy` is written with compression
+    level 0.
+    The tar file is not opened in stream mode, as it buffers the data in
+    records and the level would not match the written member.
+    """
+    if policy is None:
+        policy = CompressionPolicy()
+    source_path = _native(source_path)
+
+    def normalize(info):
+        info.uid = 0
+        info.gid = 0
+        info.uname = ''
+        info.gname = ''
+        if mtime is not None:
+            info.mtime = min(info.mtime, mtime)
+        info.mtime = int(info.mtime)
+        return info
+
+    with io.open(_native(archive_path), 'wb') as output:
+        gzip = ParallelGzipWriter(
+            output, level=level, max_workers=max_workers)
+        with gzip:
+            archive = tarfile.open(
+                fileobj=gzip, mode='w', format=tarfile.GNU_FORMAT)
+            with closing(archive):
+                for path in _list_tar_members(source_path):
+                    if os.path.isfile(path) and not os.path.islink(path):
+                        if policy.isStored(path):
+                            gzip.setLevel(0)
+                        else:
+                            gzip.setLevel(level)
+                    archive.add(path, recursive=False, filter=normalize)
+
+
+class _StoreAllPolicy(CompressionPolicy):
+    """
+    Policy storing all files.
+    """
+
+    def matchName(self, path):
+        return True
+
+
+class _DeflateAllPolicy(CompressionPolicy):
+    """
+    Policy compressing all files.
+    """
+
+    def matchName(self, path):
+        return False
+
+
+def _create_tar_xz_archive(source_path, archive_path):
+    """
+    Create a tar.xz file at `archive_path` with the `source_path` folder.
+    """
+    source_path = _native(source_path)
+    archive = tarfile.open(
+        _native(archive_path), mode='w:xz', format=tarfile.GNU_FORMAT)
+    with closing(archive):
+        for path in _list_tar_members(source_path):
+            archive.add(path, recursive=False)
+
+
+def _read_zip_archive(archive_path):
+    """
+    Read and decompress all members of a zip archive.
+    """
+    with closing(ZipFile(_native(archive_path))) as archive:
+        for info in archive.infolist():
+            with closing(archive.open(info)) as member:
+                while member.read(ARCHIVE_BUFFER_SIZE):
+                    pass
+
+
+def _read_tar_archive(archive_path):
+    """
+    Read and decompress all members of a compressed tar archive.
+    """
+    with closing(tarfile.open(_native(archive_path), mode='r|*')) as archive:
+        for info in archive:
+            if not info.isfile():
+                continue
+            member = archive.extractfile(info)
+            while member.read(ARCHIVE_BUFFER_SIZE):
+                pass
+
+
+def get_archive_profiles():
+    """
+    Return the list of (dist_type, name, extension, create, read) for
+    the archive formats supported for each type of distributable.
+
+    `create` is called with the source folder and the archive path and
+    `read` with the archive path.
+    """
+    profiles = [(
+        'ZIP', 'zip-store', 'zip',
+        partial(create_zip_archive, policy=_StoreAllPolicy()),
+        _read_zip_archive,
+        )]
+    for level in [1, 6, 9]:
+        profiles.append((
+            'ZIP', 'zip-deflate-%d' % (level,), 'zip',
+            partial(
+                create_zip_archive, policy=_DeflateAllPolicy(), level=level),
+            _read_zip_archive,
+            ))
+    profiles.append((
+        'ZIP', 'zip-policy', 'zip', create_zip_archive, _read_zip_archive))
+
+    for level in [1, 6, 9]:
+        profiles.append((
+            'TAR_GZ', 'tar.gz-%d' % (level,), 'tar.gz',
+            partial(
+                create_tar_gz_archive,
+                policy=_DeflateAllPolicy(),
+                level=level,
+                ),
+            _read_tar_archive,
+            ))
+    profiles.append((
+        'TAR_GZ', 'tar.gz-policy', 'tar.gz',
+        create_tar_gz_archive, _read_tar_archive))
+
+    try:
+        import lzma
+    except ImportError:
+        # Only available on Python 3.
+        lzma = None
+    if lzma is not None:
+        profiles.append((
+            'TAR_GZ', 'tar.xz', 'tar.xz',
+            _create_tar_xz_archive, _read_tar_archive))
+
+    return profiles
+
+
+def _measure_archive(source_path, archive_path, create, read):
+    """
+    Return the durations for creating and reading an archive and its
+    size.
+    """
+    started = time.time()
+    create(source_path, archive_path)
+    created = time.time()
+    read(archive_path)
+    return {
+        'compress_time': created - started,
+        'decompress_time': time.time() - created,
+        'size': os.path.getsize(_native(archive_path)),
+        }
+
+
+def benchmark_archive(source_path, archive_path, create, read):
+    """
+    Return a dictionary with the durations, the archive size and the
+    peak memory in KB for creating and reading an archive of
+    `source_path` at `archive_path`.
+
+    On Unix, it runs in a child process, to measure its peak memory.
+    The peak memory of the child right after the fork, inherited from
+    the build process, is reported as `base_rss_kb` and the memory used
+    by the benchmark as `delta_rss_kb`.
+    Otherwise the memory values are None.
+    Returns None when the benchmark fails in the child process.
+    """
+    if not hasattr(os, 'fork') or not hasattr(os, 'wait4'):
+        result = _measure_archive(source_path, archive_path, create, read)
+        result['max_rss_kb'] = None
+        result['base_rss_kb'] = None
+        result['delta_rss_kb'] = None
+        return result
+
+    import resource
+
+    # Don't fork while other threads delete files, as they would compete
+    # with the benchmark for the disk.
+    wait_background_deletes()
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.close(read_end)
+            result = _measure_archive(
+                source_path, archive_path, create, read)
+            result['base_rss_kb'] = _get_rss_kb(base_rss)
+            with io.open(write_end, 'wb') as output:
+                output.write(json.dumps(result).encode('utf-8'))
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    os.close(write_end)
+    with io.open(read_end, 'rb') as output:
+        content = output.read()
+
+    while True:
+        try:
+            _, status, usage = os.wait4(pid, 0)
+            break
+        except OSError as error:
+            if error.errno != errno.EINTR:
+                raise
+
+    if status != 0:
+        return None
+
+    result = json.loads(content.decode('utf-8'))
+    result['max_rss_kb'] = _get_rss_kb(usage.ru_maxrss)
+    result['delta_rss_kb'] = result['max_rss_kb'] - result['base_rss_kb']
+    return result
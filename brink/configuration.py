@@ -12,7 +12,19 @@ SETUP = {
         'version_major': '0',
         'version_minor': '0',
         'copyright_holder': 'Chevah Project',
-        'distributables': {}
+        'distributables': {},
+        # Selection of the files stored without compression in the
+        # distributable archives.
+        'compression': {
+            # Extensions of files which are always stored, in addition to
+            # the known compressed formats.
+            'store': [],
+            # Extensions of files which are always compressed.
+            'deflate': [],
+            # Other files are stored when a sample of their content does
+            # not compress below this ratio.
+            'store_ratio': 0.95,
+            },
         },
     'python': {
         'version': '2.5',
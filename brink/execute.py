@@ -6,18 +6,611 @@ from __future__ import (
     with_statement,
     unicode_literals,
     )
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from tempfile import SpooledTemporaryFile
+import errno
+import json
+import mmap
 import os
+import signal
 import subprocess
 import sys
+import threading
+import time
+
+from brink.spawn import get_spawn_server, SpawnedProcess
+
+# Wait timeout used when joining the worker pool.
+# Python 2 can not interrupt a blocking wait without a timeout.
+_POOL_WAIT_TIMEOUT = 60 * 60 * 24
+
+# Output of spooled commands larger than this is moved to disk.
+SPOOL_MEMORY = 4 * 1024 * 1024
+
+# Size of reads from the output of spooled commands.
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+# Exit code used for commands which were stopped due to a timeout.
+# Same as the one used by the coreutils `timeout` command.
+TIMEOUT_EXIT_CODE = 124
+
+# Absolute time by which all commands should end.
+_DEADLINE = {
+    'end': None,
+    }
+
+# Processes which were started and not yet waited.
+# They are killed on keyboard interrupt.
+_ACTIVE = {
+    'processes': set(),
+    'lock': threading.Lock(),
+    }
+
+# Serializes the changes to the foreground process group of the terminal.
+_TERMINAL = {
+    'lock': threading.Lock(),
+    }
+
+# State for recording the resource usage of child processes.
+# Tracing is disabled while `path` is None.
+_TRACE = {
+    'path': None,
+    'lock': threading.Lock(),
+    }
+
+
+def set_trace_path(path):
+    """
+    Record the resource usage of all executed commands as JSON lines
+    appended to the file at `path`.
+
+    Set to `None` to disable tracing.
+    """
+    _TRACE['path'] = path
+
+
+def load_trace(path):
+    """
+    Return the list of records stored in the trace file at `path`.
+    """
+    result = []
+    with open(path, 'r') as trace_file:
+        for line in trace_file:
+            line = line.strip()
+            if not line:
+                continue
+            result.append(json.loads(line))
+    return result
+
+
+def safe_command(command):
+    """
+    Return a copy of `command` with the secrets masked, so that it can be
+    displayed or stored.
+    """
+    result = []
+    for part in command:
+        if isinstance(part, bytes):
+            part = part.decode('utf-8', 'replace')
+        if 'CODECOV_TOKEN' in part:
+            result.append('CODECOV_TOKEN=***')
+            continue
+        result.append(part)
+    return result
+
+
+def _wait_exited(process):
+    """
+    Wait for `process` to exit, without reaping it, and stop its timeout
+    timer, so that the timer never kills a reused process ID.
+
+    Only done where `os.waitid` is available. Otherwise the timer is
+    stopped after the process is reaped.
+    """
+    if getattr(process, 'kill_lock', None) is None:
+        return
+    if isinstance(process, SpawnedProcess) or not hasattr(os, 'waitid'):
+        return
+
+    while True:
+        try:
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            break
+        except OSError as error:
+            if error.errno != errno.EINTR:
+                raise
+    _set_exited(process)
+
+
+def _set_exited(process):
+    """
+    Mark `process` as exited, so that its timeout timer no longer kills
+    it.
+    """
+    lock = getattr(process, 'kill_lock', None)
+    if lock is None:
+        return
+    with lock:
+        process.exited = True
+
+
+def _wait(process):
+    """
+    Wait for `process` to end and return its resource usage.
+
+    The resource usage is None when tracing is disabled or when it is not
+    supported by the OS.
+    """
+    try:
+        return _reap(process)
+    finally:
+        _set_exited(process)
+        _take_terminal(process)
+
+
+def _reap(process):
+    """
+    Called by _wait to reap the process.
+    """
+    _wait_exited(process)
+    if isinstance(process, SpawnedProcess):
+        # The usage is reported by the spawn server.
+        process.wait()
+        if _TRACE['path'] is None:
+            return None
+        return process.usage
+
+    if _TRACE['path'] is None or not hasattr(os, 'wait4'):
+        process.wait()
+        return None
+
+    while True:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as error:
+            if error.errno != errno.EINTR:
+                raise
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return usage
+
+
+def _write_input(stream, input_text):
+    """
+    Write `input_text` to the child and close the stream.
+
+    Called in a separate thread.
+    """
+    try:
+        stream.write(input_text)
+    except IOError as error:
+        # Child has exited without reading all the input.
+        if error.errno != errno.EPIPE:
+            raise
+    finally:
+        stream.close()
+
+
+def _communicate(process, input_text):
+    """
+    Like `Popen.communicate` but also return the resource usage of the
+    child.
+
+    Returns (stdoutdata, stderrdata, usage).
+    """
+    tracing = _TRACE['path'] is not None and hasattr(os, 'wait4')
+    if not tracing and getattr(process, 'kill_lock', None) is None:
+        (stdoutdata, stderrdata) = process.communicate(input_text)
+        return (stdoutdata, stderrdata, None)
+
+    # Popen.communicate reaps the child without the resource usage and
+    # without stopping the timeout timer, so the streams are handled here.
+    writer = None
+    if input_text:
+        writer = threading.Thread(
+            target=_write_input, args=(process.stdin, input_text))
+        writer.start()
+    else:
+        process.stdin.close()
+
+    stdoutdata = None
+    if process.stdout:
+        stdoutdata = process.stdout.read()
+        process.stdout.close()
+
+    if writer:
+        writer.join()
+
+    return (stdoutdata, None, _wait(process))
+
+
+def _record(command, started, process, usage):
+    """
+    Append the resource usage of the finished `process` to the trace.
+    """
+    trace_path = _TRACE['path']
+    if trace_path is None:
+        return
+
+    record = {
+        'command': safe_command(command),
+        'started': started,
+        'duration': time.time() - started,
+        'exit_code': process.returncode,
+        'user_time': None,
+        'system_time': None,
+        'max_rss_kb': None,
+        }
+    if usage is not None:
+        record['user_time'] = usage.ru_utime
+        record['system_time'] = usage.ru_stime
+        record['max_rss_kb'] = _get_rss_kb(usage.ru_maxrss)
+
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with _TRACE['lock']:
+        # The trace might be enabled before the build folder is created.
+        parent = os.path.dirname(trace_path)
+        if parent and not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+        with open(trace_path, 'a') as trace_file:
+            trace_file.write(line)
+
+
+def _get_rss_kb(max_rss):
+    """
+    Return the `ru_maxrss` resource usage in KB.
+    """
+    if sys.platform.startswith('darwin'):
+        # On OSX the value is in bytes.
+        return max_rss // 1024
+    return max_rss
+
+
+def _get_environment(extra_environment):
+    """
+    Return the environment for the child process or None to inherit the
+    current environment.
+    """
+    if extra_environment is None:
+        return None
+
+    execute_environment = os.environ.copy()
+    execute_environment.update(extra_environment)
+    return execute_environment
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Context manager for stopping all the commands executed inside the
+    context which are still running `seconds` after entering the context.
+
+    Nested deadlines can only shorten the current deadline.
+    """
+    previous = _DEADLINE['end']
+    end = time.time() + seconds
+    if previous is not None:
+        end = min(end, previous)
+    _DEADLINE['end'] = end
+    try:
+        yield
+    finally:
+        _DEADLINE['end'] = previous
+
+
+def _get_timeout(timeout):
+    """
+    Return the timeout for a new command, based on the requested `timeout`
+    and the current deadline.
+    """
+    end = _DEADLINE['end']
+    if end is None:
+        return timeout
+
+    remaining = max(0, end - time.time())
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+
+def _get_terminal():
+    """
+    Return the file descriptor of the terminal from which the build reads
+    its input or None when the input is not a terminal.
+    """
+    if os.name == 'nt' or sys.stdin is None:
+        return None
+    try:
+        terminal = sys.stdin.fileno()
+    except (AttributeError, ValueError, IOError):
+        return None
+    if not os.isatty(terminal):
+        return None
+    return terminal
+
+
+def _needs_group(timeout):
+    """
+    Return True if the child is started in a new process group, so that
+    it can be stopped together with all its children.
+
+    A child in a background process group is stopped when it reads from
+    the terminal, as done by password prompts.
+    Without a timeout, a child which can use the terminal is kept in the
+    process group of the build.
+    """
+    return timeout is not None or _get_terminal() is None
+
+
+def _get_group_options(group):
+    """
+    Return the `Popen` arguments for starting the child in a new process
+    group, when `group` is True.
+    """
+    if not group:
+        return {}
+    if os.name == 'nt':
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    elif sys.version_info >= (3, 11):
+        return {'process_group': 0}
+    else:
+        # Not a new session, so that the child keeps the controlling
+        # terminal and can be moved to the foreground.
+        return {'preexec_fn': os.setpgrp}
+
+
+def _get_foreground_terminal():
+    """
+    Return the terminal of the build, if the build is in its foreground
+    process group, or None.
+    """
+    terminal = _get_terminal()
+    if terminal is None:
+        return None
+    if (
+        not hasattr(signal, 'pthread_sigmask') and
+        not isinstance(threading.current_thread(), threading._MainThread)
+            ):
+        # SIGTTOU can only be ignored from the main thread.
+        return None
+    try:
+        if os.tcgetpgrp(terminal) != os.getpgrp():
+            return None
+    except OSError:
+        return None
+    return terminal
+
+
+@contextmanager
+def _ignore_ttou():
+    """
+    Context manager in which the current thread can change the foreground
+    process group while in a background process group.
+    """
+    if hasattr(signal, 'pthread_sigmask'):
+        previous = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGTTOU])
+        try:
+            yield
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, previous)
+        return
+
+    previous = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTTOU, previous)
+
+
+def _give_terminal(process):
+    """
+    Move the process group of `process` to the foreground of the terminal,
+    if the build is in the foreground.
+
+    The terminal is taken back by _take_terminal().
+    """
+    process.terminal = None
+    with _TERMINAL['lock']:
+        terminal = _get_foreground_terminal()
+        if terminal is None:
+            return
+        try:
+            os.tcsetpgrp(terminal, process.pid)
+        except OSError:
+            # Process has already exited.
+            return
+        process.terminal = terminal
+
+    try:
+        # Resume the process if it was stopped while reading from the
+        # terminal before being moved to the foreground.
+        os.killpg(process.pid, signal.SIGCONT)
+    except OSError as error:
+        if error.errno != errno.ESRCH:
+            raise
+
+
+def _take_terminal(process):
+    """
+    Move the build back to the foreground of the terminal given to
+    `process`.
+    """
+    terminal = getattr(process, 'terminal', None)
+    if terminal is None:
+        return
+    process.terminal = None
+    with _TERMINAL['lock']:
+        with _ignore_ttou():
+            try:
+                os.tcsetpgrp(terminal, os.getpgrp())
+            except OSError:
+                # The terminal was closed.
+                pass
+
+
+def _print_missing_command(command):
+    """
+    Show the error for a command which was not found.
+    """
+    print('Failed to execute: %s' % ' '.join(command))
+    print('Missing command: %s' % command[0])
+
+
+def _start_process(command, output, extra_environment, timeout):
+    """
+    Start the child process and return the `Popen` instance.
+
+    Without a terminal or with a `timeout`, the child is started in a new
+    process group so that it can be stopped together with all its
+    children.
+    In that case, when the build is in the foreground of the terminal,
+    the child is moved to the foreground until it exits.
+    When the output is captured, the spawn server is used, if started.
+
+    Exits if the command is not found.
+    """
+    group = _needs_group(timeout)
+    foreground = group and _get_foreground_terminal() is not None
+    spawn_server = get_spawn_server()
+    try:
+        if spawn_server and output is subprocess.PIPE and not foreground:
+            environment = _get_environment(extra_environment)
+            if environment is None:
+                environment = os.environ.copy()
+            process = spawn_server.spawn(command, environment, group=group)
+        else:
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=output,
+                env=_get_environment(extra_environment),
+                **_get_group_options(group)
+                )
+    except OSError as error:
+        if error.errno == 2:
+            _print_missing_command(command)
+            sys.exit(1)
+        else:
+            raise
+
+    process.group = group
+    if foreground:
+        _give_terminal(process)
+    with _ACTIVE['lock']:
+        _ACTIVE['processes'].add(process)
+    return process
+
+
+def _forget(process):
+    """
+    Called when `process` was waited.
+    """
+    with _ACTIVE['lock']:
+        _ACTIVE['processes'].discard(process)
+
+
+def _kill(process):
+    """
+    Kill `process` together with all the processes started by it.
+    """
+    if os.name == 'nt':
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(
+                ['taskkill', '/F', '/T', '/PID', str(process.pid)],
+                stdout=devnull, stderr=devnull,
+                )
+        return
+
+    try:
+        if getattr(process, 'group', True):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            os.kill(process.pid, signal.SIGKILL)
+    except OSError as error:
+        # Already stopped.
+        if error.errno != errno.ESRCH:
+            raise
+
+
+def _kill_active():
+    """
+    Kill all the processes which are still running.
+    """
+    with _ACTIVE['lock']:
+        processes = list(_ACTIVE['processes'])
+    for process in processes:
+        _kill(process)
+
+
+def _start_timer(process, timeout):
+    """
+    Return a started timer which kills `process` after `timeout` seconds
+    or None if there is no timeout.
+    """
+    if timeout is None:
+        return None
+
+    def on_timeout():
+        with process.kill_lock:
+            if process.exited:
+                return
+            process.timed_out = True
+            _kill(process)
+
+    process.timed_out = False
+    process.exited = False
+    process.kill_lock = threading.Lock()
+    timer = threading.Timer(timeout, on_timeout)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def _check_timeout(command, process, timer, timeout):
+    """
+    Stop the `timer` and return True if the `process` was stopped by it.
+    """
+    if timer is None:
+        return False
+
+    timer.cancel()
+    timer.join()
+    if not process.timed_out or process.returncode == 0:
+        return False
+
+    _print_timeout(command, timeout)
+    return True
+
+
+def _print_timeout(command, timeout):
+    """
+    Show the command which was stopped due to a timeout.
+    """
+    print('Command timed out after %.1f seconds: %s' % (
+        timeout, ' '.join(safe_command(command))))
 
 
 def execute(
         command, input_text=None, output=None,
         ignore_errors=False, verbose=False,
-        extra_environment=None,
+        extra_environment=None, timeout=None,
         ):
     """
     Returns (exit_code, stdoutdata)
+
+    When the command runs for more than `timeout` seconds or past the
+    current deadline, it is stopped and the exit code is
+    TIMEOUT_EXIT_CODE.
     """
     if verbose:
         print('Calling: %s' % command)
@@ -25,35 +618,25 @@ def execute(
     if output is None:
         output = subprocess.PIPE
 
-    if extra_environment is not None:
-        execute_environment = os.environ.copy()
-        execute_environment.update(extra_environment)
-    else:
-        execute_environment = None
+    timeout = _get_timeout(timeout)
+    started = time.time()
+    process = _start_process(command, output, extra_environment, timeout)
+    timer = _start_timer(process, timeout)
 
     try:
-        process = subprocess.Popen(
-            command,
-            stdin=subprocess.PIPE,
-            stdout=output,
-            env=execute_environment,
-            )
-    except OSError as error:
-        if error.errno == 2:
-            print('Failed to execute: %s' % ' '.join(command))
-            print('Missing command: %s' % command[0])
-            sys.exit(1)
-        else:
-            raise
-
-    try:
-        (stdoutdata, stderrdata) = process.communicate(input_text)
+        (stdoutdata, stderrdata, usage) = _communicate(process, input_text)
     except KeyboardInterrupt:
         # Don't print stack trace on keyboard interrupt.
-        # Just exit.
+        # Just exit, without leaving orphan processes.
+        _kill_active()
         os._exit(1)
 
+    _forget(process)
+    _record(command, started, process, usage)
+
     exit_code = process.returncode
+    if _check_timeout(command, process, timer, timeout):
+        exit_code = TIMEOUT_EXIT_CODE
     if exit_code != 0:
         if verbose:
             print('Failed to execute %s\n%s' % (command, stderrdata))
@@ -61,3 +644,362 @@ def execute(
             sys.exit(exit_code)
 
     return (exit_code, stdoutdata)
+
+
+def call(command, extra_environment=None):
+    """
+    Execute `command` using the standard streams of the current process,
+    like `subprocess.call`.
+
+    Returns the exit code, without exiting on errors.
+    """
+    started = time.time()
+    process = subprocess.Popen(
+        command, env=_get_environment(extra_environment))
+    _record(command, started, process, _wait(process))
+    return process.returncode
+
+
+def _iter_output(
+        command, chunk_size, verbose, extra_environment, timeout, result):
+    """
+    Execute `command` and yield the output as it is produced by the child.
+
+    The exit code is stored in `result` after all output was consumed.
+    """
+    if verbose:
+        print('Calling: %s' % command)
+
+    timeout = _get_timeout(timeout)
+    started = time.time()
+    process = _start_process(
+        command, subprocess.PIPE, extra_environment, timeout)
+    timer = _start_timer(process, timeout)
+    # Streaming mode does not send any input.
+    process.stdin.close()
+
+    if chunk_size is None:
+        read = process.stdout.readline
+    else:
+        def read():
+            return process.stdout.read(chunk_size)
+
+    completed = False
+    try:
+        for data in iter(read, b''):
+            yield data
+        completed = True
+    except KeyboardInterrupt:
+        # Don't print stack trace on keyboard interrupt.
+        # Just exit, without leaving orphan processes.
+        _kill_active()
+        os._exit(1)
+    finally:
+        process.stdout.close()
+        if not completed:
+            # Consumer stopped before the end of the output.
+            # The process is not reaped yet, so its ID was not reused.
+            _kill(process)
+        usage = _wait(process)
+        _forget(process)
+        _record(command, started, process, usage)
+        timed_out = _check_timeout(command, process, timer, timeout)
+
+    result['exit_code'] = process.returncode
+    if timed_out:
+        result['exit_code'] = TIMEOUT_EXIT_CODE
+
+
+def _check_exit_code(command, exit_code, ignore_errors, verbose):
+    """
+    Exit on errors, unless `ignore_errors` is True.
+    """
+    if exit_code == 0:
+        return
+    if verbose:
+        print('Failed to execute %s' % (command,))
+    if not ignore_errors:
+        sys.exit(exit_code)
+
+
+def iter_execute(
+        command, chunk_size=None, encoding=None,
+        ignore_errors=False, verbose=False,
+        extra_environment=None, timeout=None,
+        ):
+    """
+    Execute `command` and yield its output as it is produced by the child.
+
+    By default it yields lines, including the line ending.
+    When `chunk_size` is defined, it yields chunks of at most `chunk_size`
+    bytes.
+    When `encoding` is defined, the output is decoded with it.
+
+    The exit code is checked after all output was consumed, with the same
+    `ignore_errors` semantics as execute().
+    If iteration is stopped early, the child process is terminated.
+    `timeout` has the same meaning as for execute().
+    """
+    result = {}
+    output = _iter_output(
+        command, chunk_size, verbose, extra_environment, timeout, result)
+    try:
+        for data in output:
+            if encoding is not None:
+                data = data.decode(encoding)
+            yield data
+    finally:
+        output.close()
+
+    _check_exit_code(command, result['exit_code'], ignore_errors, verbose)
+
+
+def execute_spooled(
+        command, max_memory=SPOOL_MEMORY,
+        ignore_errors=False, verbose=False,
+        extra_environment=None, timeout=None,
+        ):
+    """
+    Execute `command` and store its output in a temporary file which is
+    kept in memory only while smaller than `max_memory` bytes.
+
+    Returns (exit_code, output_file) with the file positioned at the start
+    of the output.
+    The caller should close the file, which also removes it from disk.
+
+    Errors and `timeout` are handled as in execute().
+    """
+    result = {}
+    output_file = SpooledTemporaryFile(max_size=max_memory)
+    try:
+        for chunk in _iter_output(
+                command, SPOOL_CHUNK_SIZE, verbose, extra_environment,
+                timeout, result):
+            output_file.write(chunk)
+        _check_exit_code(
+            command, result['exit_code'], ignore_errors, verbose)
+    except BaseException:
+        output_file.close()
+        raise
+
+    output_file.seek(0)
+    return (result['exit_code'], output_file)
+
+
+def get_output_view(output_file, max_memory=SPOOL_MEMORY):
+    """
+    Return a read-only view of the whole content from the spooled
+    `output_file`, created with the same `max_memory` as in
+    execute_spooled().
+
+    Content larger than `max_memory` was already moved to disk and the
+    view is a memory map of the file which should be closed by the caller.
+    Otherwise, the in-memory content is returned.
+    """
+    position = output_file.tell()
+    output_file.seek(0, os.SEEK_END)
+    size = output_file.tell()
+
+    if size <= max_memory:
+        output_file.seek(0)
+        content = output_file.read()
+        output_file.seek(position)
+        return content
+
+    output_file.seek(position)
+    output_file.flush()
+    return mmap.mmap(output_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _run_parallel(function, jobs, max_workers=None):
+    """
+    Return the list with the result of calling `function` for each of the
+    `jobs`, using a pool of at most `max_workers` threads.
+
+    It uses a thread for each CPU when `max_workers` is None.
+    A single job is called in the current thread.
+    On keyboard interrupt, the running commands are killed, so that the
+    workers can be joined.
+    """
+    jobs = list(jobs)
+    if max_workers is None:
+        max_workers = cpu_count()
+    max_workers = max(1, min(max_workers, len(jobs)))
+    if max_workers == 1:
+        return [function(job) for job in jobs]
+
+    pool = ThreadPool(max_workers)
+    try:
+        return pool.map_async(function, jobs).get(_POOL_WAIT_TIMEOUT)
+    except KeyboardInterrupt:
+        _kill_active()
+        raise
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def execute_many(
+        commands, max_workers=None, output=None,
+        ignore_errors=False, verbose=False,
+        extra_environment=None, timeout=None,
+        ):
+    """
+    Execute independent `commands` in parallel, using at most `max_workers`
+    child processes at the same time.
+
+    Returns a list of (exit_code, stdoutdata) in the same order as
+    `commands`.
+
+    All commands are waited to finish before checking for errors.
+    When `ignore_errors` is False, it exits with the exit code of the first
+    failed command, in submission order.
+
+    `timeout` is applied to each command.
+    """
+    def run(command):
+        """
+        Called in a worker thread.
+
+        Errors are always ignored here, as sys.exit() in a thread will not
+        stop the build.
+        """
+        try:
+            return execute(
+                command,
+                output=output,
+                ignore_errors=True,
+                verbose=verbose,
+                extra_environment=extra_environment,
+                timeout=timeout,
+                )
+        except SystemExit as error:
+            # Command could not be started.
+            return (error.code, None)
+
+    try:
+        results = _run_parallel(run, commands, max_workers)
+    except KeyboardInterrupt:
+        # Same as execute(), don't print stack trace on keyboard interrupt.
+        os._exit(1)
+
+    if not ignore_errors:
+        for exit_code, _ in results:
+            if exit_code != 0:
+                sys.exit(exit_code)
+
+    return results
+
+
+def async_execute(
+        command, input_text=None,
+        ignore_errors=False, verbose=False,
+        extra_environment=None, timeout=None,
+        ):
+    """
+    Execute `command` without blocking the asyncio event loop.
+
+    Returns an asyncio future for (exit_code, stdoutdata), with the same
+    semantics as execute().
+    Cancelling it kills the command.
+
+    As with execute(), errors stop the build, with SystemExit raised in
+    the awaiting coroutine.
+
+    It must be called from the running event loop.
+    Only available on Python 3.
+    """
+    import asyncio
+
+    if verbose:
+        print('Calling: %s' % command)
+
+    loop = asyncio.get_running_loop()
+    result = loop.create_future()
+    timeout = _get_timeout(timeout)
+    started = time.time()
+    group = _needs_group(timeout)
+    state = {'process': None, 'timer': None, 'timed_out': False}
+
+    def on_timeout():
+        state['timed_out'] = True
+        _kill(state['process'])
+
+    def on_cancel(future):
+        if future.cancelled() and state['process'] is not None:
+            _kill(state['process'])
+
+    def on_started(starting):
+        if starting.cancelled():
+            result.cancel()
+            return
+        error = starting.exception()
+        if result.done():
+            if error is None:
+                # Cancelled while the command was starting.
+                starting.result().group = group
+                _kill(starting.result())
+            return
+        if error is not None:
+            if getattr(error, 'errno', None) == 2:
+                _print_missing_command(command)
+                error = SystemExit(1)
+            result.set_exception(error)
+            return
+
+        process = starting.result()
+        state['process'] = process
+        process.group = group
+        if group:
+            _give_terminal(process)
+        with _ACTIVE['lock']:
+            _ACTIVE['processes'].add(process)
+        if timeout is not None:
+            state['timer'] = loop.call_later(timeout, on_timeout)
+
+        communicating = asyncio.ensure_future(
+            process.communicate(input_text))
+        communicating.add_done_callback(on_done)
+
+    def on_done(communicating):
+        process = state['process']
+        if state['timer'] is not None:
+            state['timer'].cancel()
+        _take_terminal(process)
+        _forget(process)
+        if result.done():
+            return
+        if communicating.cancelled():
+            result.cancel()
+            return
+        error = communicating.exception()
+        if error is not None:
+            result.set_exception(error)
+            return
+
+        _record(command, started, process, None)
+        stdoutdata, _ = communicating.result()
+        exit_code = process.returncode
+        if state['timed_out'] and exit_code != 0:
+            _print_timeout(command, timeout)
+            exit_code = TIMEOUT_EXIT_CODE
+
+        if exit_code != 0:
+            if verbose:
+                print('Failed to execute %s' % (command,))
+            if not ignore_errors:
+                result.set_exception(SystemExit(exit_code))
+                return
+
+        result.set_result((exit_code, stdoutdata))
+
+    result.add_done_callback(on_cancel)
+    starting = asyncio.ensure_future(asyncio.create_subprocess_exec(
+        *command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=_get_environment(extra_environment),
+        **_get_group_options(group)
+        ))
+    starting.add_done_callback(on_started)
+    return result
@@ -10,30 +10,1014 @@ from __future__ import (
     )
 
 from contextlib import contextmanager
+from functools import partial
+import errno
+import io
+import mmap
 import os
 import re
 import shutil
 import stat  # pylint: disable=bad-python3-import
 import sys
+import tempfile
+import threading
 import unicodedata
+import weakref
+
+from brink.execute import _run_parallel
+from brink.paths import FilePath
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # On Python 2 we use the backport, installed with chevah.compat.
+        from scandir import scandir
+    except ImportError:
+        # Replaced by _list_entries.
+        scandir = None
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows.
+    fcntl = None
 
 try:
     bool(type(unicode))
 except NameError:
     unicode = str
 
+# Maximum number of threads used for copying files.
+# The GIL is released while copying, so threads are enough.
+COPY_WORKERS = 8
+
+# Size of the buffer used when the file data is copied by Python.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Linux ioctl for sharing the data blocks of a file, from linux/fs.h.
+_FICLONE = 0x40049409
+
+# Errors raised when a copy method is not supported for a pair of files.
+_UNSUPPORTED_COPY_ERRORS = frozenset(
+    getattr(errno, name)
+    for name in [
+        'ENOSYS', 'ENOTTY', 'EOPNOTSUPP', 'ENOTSUP', 'EXDEV', 'EINVAL']
+    if hasattr(errno, name)
+    )
+
+# Errors raised when a hard link can not be created for a file.
+_UNSUPPORTED_LINK_ERRORS = frozenset(
+    getattr(errno, name)
+    for name in ['EXDEV', 'EPERM', 'EMLINK', 'EOPNOTSUPP', 'ENOTSUP']
+    if hasattr(errno, name)
+    )
+
+_COPY = {
+    'debug': False,
+    # Methods not supported at all by this system.
+    'disabled': set(),
+    }
+
+# Prefix of the sibling folders holding the folders deleted in background.
+_TRASH_PREFIX = '.brink-trash-'
+
+_DELETE = {
+    'threads': [],
+    # Trash folders which are deleted by this process.
+    'paths': set(),
+    'lock': threading.Lock(),
+    }
+
+# Results of `which`, keyed by command and search paths.
+# Values are (result, searched_folders, modification_times).
+_WHICH_CACHE = {}
+
+# Characters which make a replace rule pattern a regular expression.
+# Patterns with newlines are also handled as regular expressions, since
+# rules are applied on each line.
+_REGEX_SPECIAL = re.compile(br'[.^$*+?{}\[\]\\|()\n]')
+
+# Lines ending with any of the universal newlines.
+_UNIVERSAL_LINE = re.compile(br'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')
+
+# Default size of the read buffer used by iterLines.
+READ_BUFFER_SIZE = 64 * 1024
+
+# Default size of the chunks returned by iterChunks.
+READ_CHUNK_SIZE = 64 * 1024
+
+# Size of the chunks read when comparing the content of files.
+_COMPARE_CHUNK_SIZE = 1024 * 1024
+
+# Python 2 can only set the modification time with microseconds resolution.
+_MTIME_TOLERANCE = 0.000002
+
+
+def set_copy_debug(enabled):
+    """
+    Show the method used for copying each file.
+    """
+    _COPY['debug'] = enabled
+
+
+def _clone(source_file, destination_file, size):
+    """
+    Share the data blocks of the source, on filesystems like btrfs or xfs.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+    return True
+
+
+def _check_copied(copied):
+    """
+    Called when the kernel copied nothing, before reaching the expected
+    size.
+
+    Returns False when nothing was copied, so that the next method is
+    tried.
+    """
+    if copied:
+        raise IOError('Source file was truncated while copying.')
+    return False
+
+
+def _copy_file_range(source_file, destination_file, size):
+    """
+    Copy inside the kernel, starting from the current file positions.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        return False
+
+    copied = 0
+    while copied < size:
+        count = copy_file_range(
+            source_file.fileno(), destination_file.fileno(), size - copied)
+        if not count:
+            return _check_copied(copied)
+        copied += count
+    return True
+
+
+def _sendfile(source_file, destination_file, size):
+    """
+    Copy inside the kernel, on systems where sendfile works with files.
+    """
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is None or not sys.platform.startswith('linux'):
+        return False
+
+    start = source_file.tell()
+    offset = start
+    end = offset + size
+    while offset < end:
+        count = sendfile(
+            destination_file.fileno(), source_file.fileno(),
+            offset, end - offset)
+        if not count:
+            return _check_copied(offset - start)
+        offset += count
+    return True
+
+
+def _copy_data(source_file, destination_file, clone=False):
+    """
+    Copy the data from the current position of `source_file` to the
+    current position of `destination_file`.
+
+    The files are unbuffered. The data is cloned when `clone` is True,
+    otherwise it is copied in the kernel.
+    It falls back to copying with Python buffers.
+
+    Returns the name of the used method.
+    """
+    size = os.fstat(source_file.fileno()).st_size - source_file.tell()
+    methods = [
+        ('copy_file_range', _copy_file_range),
+        ('sendfile', _sendfile),
+        ]
+    if clone:
+        methods.insert(0, ('reflink', _clone))
+
+    for name, method in methods:
+        if name in _COPY['disabled']:
+            continue
+
+        source_position = source_file.tell()
+        destination_position = destination_file.tell()
+        try:
+            if method(source_file, destination_file, size):
+                return name
+        except (IOError, OSError) as error:
+            if error.errno not in _UNSUPPORTED_COPY_ERRORS:
+                raise
+            if error.errno == errno.ENOSYS:
+                _COPY['disabled'].add(name)
+            # Discard any partial copy.
+            source_file.seek(source_position)
+            destination_file.seek(destination_position)
+            destination_file.truncate()
+
+    shutil.copyfileobj(source_file, destination_file, COPY_BUFFER_SIZE)
+    return 'buffer'
+
+
+def _is_same_path(source, destination):
+    """
+    Return True if `source` and `destination` are the same path, after
+    resolving the symbolic links.
+    """
+    return (
+        os.path.normcase(os.path.realpath(source)) ==
+        os.path.normcase(os.path.realpath(destination))
+        )
+
+
+def _copy_file(source, destination):
+    """
+    Copy the data and the permissions of file at path `source` to path
+    `destination`.
+
+    The data is written to a temporary file which then replaces
+    `destination`, so that when `destination` is a hard link, as created
+    by copyFolder with `link`, the linked file is not changed.
+
+    As shutil.copyfile, it fails when they are the same file.
+    """
+    if _is_same_path(source, destination):
+        raise getattr(shutil, 'SameFileError', shutil.Error)(
+            '%r and %r are the same file' % (source, destination))
+
+    descriptor, temporary_path = _make_sibling_file(destination)
+    try:
+        with io.open(source, 'rb', buffering=0) as source_file:
+            with io.open(descriptor, 'wb', buffering=0) as destination_file:
+                method = _copy_data(source_file, destination_file, clone=True)
+        shutil.copymode(source, temporary_path)
+        _replace_file(temporary_path, destination)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+    if _COPY['debug']:
+        print('Copied %s to %s using %s.' % (source, destination, method))
+
+
+def _link_file(source, destination):
+    """
+    Create `destination` as a hard link to `source`.
+
+    Returns False when the file can not be linked, for example when it is
+    on a different device, and it needs to be copied.
+    """
+    link = getattr(os, 'link', None)
+    if link is None:
+        return False
+
+    try:
+        link(source, destination)
+    except OSError as error:
+        if error.errno not in _UNSUPPORTED_LINK_ERRORS:
+            raise
+        return False
+
+    if _COPY['debug']:
+        print('Linked %s to %s.' % (destination, source))
+    return True
+
+
+def _call_writable(function, path):
+    """
+    Call `function` for `path`, retrying after adding write permission for
+    read-only files.
+
+    A missing path is ignored.
+    """
+    try:
+        function(path)
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            return
+        os.chmod(path, stat.S_IWRITE)
+        function(path)
+
+
+def _remove_file(path):
+    """
+    Remove a file. Called from the worker threads.
+    """
+    _call_writable(os.remove, path)
+
+
+def _delete_tree(path):
+    """
+    Delete the folder at `path` with all its content.
+
+    Files are removed in parallel and then the folders are removed,
+    starting with the deepest ones.
+    """
+    if os.path.islink(path):
+        os.remove(path)
+        return
+
+    files = []
+    folders = []
+    pending = [path]
+    while pending:
+        folder = pending.pop()
+        folders.append(folder)
+        for entry in scandir(folder):
+            if _is_folder(entry):
+                pending.append(entry.path)
+            else:
+                files.append(entry.path)
+
+    _run_parallel(_remove_file, files, COPY_WORKERS)
+
+    # A folder is always listed before its children.
+    for folder in reversed(folders):
+        _call_writable(os.rmdir, folder)
+
+
+def _get_trash_prefix(path):
+    """
+    Return the prefix of the trash folders, of the same type as `path`.
+    """
+    if isinstance(path, bytes):
+        return _TRASH_PREFIX.encode('utf-8')
+    return _TRASH_PREFIX
+
+
+def _move_to_trash(path):
+    """
+    Move the folder at `path` inside a new sibling folder and return the
+    path to the new folder.
+
+    Returns None if the folder does not exist or it can not be moved.
+    """
+    parent = _get_folder(path)
+    name = os.path.basename(path)
+    prefix = _get_trash_prefix(path)
+    try:
+        trash = os.path.abspath(tempfile.mkdtemp(prefix=prefix, dir=parent))
+    except OSError:
+        return None
+
+    try:
+        os.rename(path, os.path.join(trash, name))
+    except OSError:
+        os.rmdir(trash)
+        return None
+    return trash
+
+
+def _find_stale_trash(path):
+    """
+    Return the trash folders next to `path` which were left by an
+    interrupted build.
+    """
+    parent = os.path.abspath(_get_folder(path))
+    prefix = _get_trash_prefix(path)
+    try:
+        names = os.listdir(parent)
+    except OSError:
+        return []
+
+    with _DELETE['lock']:
+        return [
+            os.path.join(parent, name)
+            for name in names
+            if name.startswith(prefix) and
+            os.path.join(parent, name) not in _DELETE['paths']
+            ]
+
+
+def _delete_trash(path):
+    """
+    Delete the trash folder at `path`. Called from a separate thread.
+    """
+    try:
+        _delete_tree(path)
+    finally:
+        with _DELETE['lock']:
+            _DELETE['paths'].discard(path)
+
+
+def _delete_in_background(path):
+    """
+    Delete the trash folder at `path` in a separate thread.
+    """
+    thread = threading.Thread(target=_delete_trash, args=(path,))
+    with _DELETE['lock']:
+        _DELETE['paths'].add(path)
+        _DELETE['threads'].append(thread)
+    # Don't daemonize, so that the deletion finishes before the build
+    # process exits.
+    thread.start()
+
+
+def wait_background_deletes():
+    """
+    Wait for all the folders deleted in background.
+    """
+    with _DELETE['lock']:
+        threads = _DELETE['threads'][:]
+        del _DELETE['threads'][:]
+    for thread in threads:
+        thread.join()
+
+
+def _compile_patterns(patterns, path):
+    """
+    Return the compiled regular expressions for matching `path` names.
+    """
+    if not patterns:
+        return []
+    result = []
+    for pattern in patterns:
+        if isinstance(path, bytes) and isinstance(pattern, unicode):
+            pattern = pattern.encode('utf-8')
+        result.append(re.compile(pattern))
+    return result
+
+
+def _matches(patterns, name):
+    """
+    Return True if `name` is matched by any of the compiled `patterns`.
+    """
+    for pattern in patterns:
+        if pattern.match(name):
+            return True
+    return False
+
+
+def _copy_stat(path, source_stat):
+    """
+    Set the permissions and times of `path` from `source_stat`.
+    """
+    if sys.version_info >= (3, 3):
+        # Keep the full resolution of the modification time.
+        os.utime(
+            path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    else:
+        os.utime(path, (source_stat.st_atime, source_stat.st_mtime))
+    os.chmod(path, stat.S_IMODE(source_stat.st_mode))
+
+
+def _is_folder(entry):
+    """
+    Return True if the DirEntry is a folder and not a link to a folder.
+    """
+    return not entry.is_symlink() and entry.is_dir()
+
+
+def _is_same_link(source, destination):
+    """
+    Return True if both DirEntry are links to the same target.
+    """
+    if not source.is_symlink() or not destination.is_symlink():
+        return False
+    return os.readlink(source.path) == os.readlink(destination.path)
+
+
+def _has_same_stat(source_stat, destination_stat):
+    """
+    Return True if the files have the same size and modification time.
+    """
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+
+    if sys.version_info >= (3, 3):
+        return source_stat.st_mtime_ns == destination_stat.st_mtime_ns
+
+    return (
+        abs(source_stat.st_mtime - destination_stat.st_mtime) <
+        _MTIME_TOLERANCE
+        )
+
+
+def _has_same_content(first, second):
+    """
+    Return True if the files at path `first` and `second` have the same
+    content.
+    """
+    with open(first, 'rb') as first_file:
+        with open(second, 'rb') as second_file:
+            while True:
+                first_chunk = first_file.read(_COMPARE_CHUNK_SIZE)
+                second_chunk = second_file.read(_COMPARE_CHUNK_SIZE)
+                if first_chunk != second_chunk:
+                    return False
+                if not first_chunk:
+                    return True
+
+
+def _copy_entry(job, link=False):
+    """
+    Copy a single folder entry.
+
+    `job` is a tuple of (source_entry, destination_path, replace, compare).
+    When `compare` is True, the content is not copied if it is the same.
+    When `link` is True, files are hard linked when possible.
+    Called from the worker threads.
+    """
+    entry, destination, replace, compare = job
+    if compare and _has_same_content(entry.path, destination):
+        _copy_stat(destination, entry.stat())
+        return
+
+    if replace:
+        os.remove(destination)
+
+    if entry.is_symlink():
+        os.symlink(os.readlink(entry.path), destination)
+        return
+
+    if link and _link_file(entry.path, destination):
+        return
+
+    _copy_file(entry.path, destination)
+    _copy_stat(destination, entry.stat())
+
+
+def _get_folder(path):
+    """
+    Return the path to the folder containing `path`, of the same type as
+    `path`.
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        return folder
+    if isinstance(path, bytes):
+        return b'.'
+    return '.'
+
+
+def _make_sibling_file(path):
+    """
+    Create a temporary file in the same folder as `path`.
+
+    Returns (descriptor, temporary_path).
+    """
+    prefix = '.brink-'
+    if isinstance(path, bytes):
+        prefix = prefix.encode('utf-8')
+    return tempfile.mkstemp(prefix=prefix, dir=_get_folder(path))
+
+
+def _replace_file(source, destination):
+    """
+    Move the file from `source` over `destination`.
+
+    The replacement is atomic, with the exception of Windows on Python 2.
+    """
+    replace = getattr(os, 'replace', None)
+    if replace is not None:
+        replace(source, destination)
+        return
+
+    if os.name == 'nt':
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+def _to_bytes(value):
+    """
+    Return the UTF-8 representation of Unicode `value`.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _to_text(value):
+    """
+    Return the Unicode representation of UTF-8 `value`.
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _overlaps(first, second):
+    """
+    Return True if `first` and `second` can share characters when found
+    next to each other in a text.
+    """
+    if first in second or second in first:
+        return True
+    for size in range(1, min(len(first), len(second))):
+        if first.endswith(second[:size]) or second.endswith(first[:size]):
+            return True
+    return False
+
+
+class ReplaceRules(object):
+    """
+    Compiled rules for `BrinkFilesystem.replaceFileContent`.
+
+    Each rule is a (pattern, substitution) pair, as used by `re.sub`.
+    Rules are applied in order, on each line.
+
+    Consecutive plain text rules are merged into a single pass, when this
+    gives the same result as applying them one after the other.
+    """
+
+    def __init__(self, rules):
+        # List of (compiled_pattern, substitution) pairs.
+        self._steps = []
+        # True when all rules are plain text.
+        self.literal = True
+
+        group = []
+        for pattern, substitution in rules:
+            pattern = _to_bytes(pattern)
+            substitution = _to_bytes(substitution)
+
+            if not self._isLiteral(pattern, substitution):
+                self._addLiterals(group)
+                group = []
+                self.literal = False
+                self._steps.append((re.compile(pattern), substitution))
+                continue
+
+            if not self._canMerge(group, pattern):
+                self._addLiterals(group)
+                group = []
+            group.append((pattern, substitution))
+
+        self._addLiterals(group)
+
+    def apply(self, content):
+        """
+        Return `content` with all rules applied.
+
+        When all rules are plain text, `content` can also be a buffer for
+        the whole file.
+        """
+        if not self._steps:
+            return content[:]
+        for pattern, substitution in self._steps:
+            content = pattern.sub(substitution, content)
+        return content
+
+    def _isLiteral(self, pattern, substitution):
+        """
+        Return True if the rule replaces a plain text with a plain text.
+        """
+        if not pattern or _REGEX_SPECIAL.search(pattern):
+            return False
+        # Substitutions can contain escapes or group references.
+        return b'\\' not in substitution
+
+    def _canMerge(self, group, pattern):
+        """
+        Return True if plain text `pattern` can be searched in the same pass
+        as the rules from `group`.
+        """
+        for previous_pattern, previous_substitution in group:
+            if _overlaps(previous_pattern, pattern):
+                return False
+            # Text replaced by a previous rule can be matched by this one.
+            if _overlaps(previous_substitution, pattern):
+                return False
+        return True
+
+    def _addLiterals(self, group):
+        """
+        Add a single step for replacing all plain text rules from `group`.
+        """
+        if not group:
+            return
+
+        replacements = dict(group)
+        pattern = re.compile(
+            b'|'.join(re.escape(text) for text, _ in group))
+        self._steps.append(
+            (pattern, lambda match: replacements[match.group(0)]))
+
+
+class FilesystemIndex(object):
+    """
+    In memory snapshot of folder listings.
+
+    Each folder is scanned once and the existence and type queries are
+    answered from the scanned DirEntry objects.
+    Paths are the result of `BrinkFilesystem.join`.
+
+    `BrinkFilesystem` invalidates the index when files are changed using
+    its methods. Changes done by other means need an explicit
+    `invalidate()` call.
+    """
+
+    def __init__(self, root):
+        self._root = self._normalize(root)
+        self._prefix = self._getChild(self._root, '')
+        # Folder path -> dict of name -> DirEntry, or None when the folder
+        # does not exist.
+        self._folders = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Discard the current snapshot and scan the whole tree.
+        """
+        with self._lock:
+            self._folders.clear()
+        pending = [self._root]
+        while pending:
+            folder = pending.pop()
+            listing = self._getListing(folder)
+            if not listing:
+                continue
+            for name, entry in listing.items():
+                if _is_folder(entry):
+                    pending.append(self._getChild(folder, name))
+
+    def contains(self, path):
+        """
+        Return True if `path` is the root folder or it is inside it.
+        """
+        if type(path) is not type(self._root):
+            return False
+        path = self._normalize(path)
+        return path == self._root or path.startswith(self._prefix)
+
+    def invalidate(self, path):
+        """
+        Forget the state of `path`, including all its children.
+
+        The listings of all its ancestors are also forgotten, as creating
+        `path` might have also created some of its parents.
+        """
+        path = self._normalize(path)
+        prefix = self._getChild(path, '')
+        with self._lock:
+            ancestor = path
+            while True:
+                parent = os.path.dirname(ancestor)
+                if parent == ancestor:
+                    break
+                self._folders.pop(parent, None)
+                ancestor = parent
+            for folder in list(self._folders):
+                if folder == path or folder.startswith(prefix):
+                    del self._folders[folder]
+
+    def exists(self, path):
+        """
+        Same as `os.path.exists`.
+        """
+        entry = self._getEntry(path)
+        if entry is None:
+            return False
+        if not entry.is_symlink():
+            return True
+        try:
+            entry.stat()
+        except OSError:
+            # Broken link.
+            return False
+        return True
+
+    def isFile(self, path):
+        """
+        Same as `os.path.isfile`.
+        """
+        entry = self._getEntry(path)
+        return entry is not None and entry.is_file()
+
+    def isFolder(self, path):
+        """
+        Same as `os.path.isdir`.
+        """
+        entry = self._getEntry(path)
+        return entry is not None and entry.is_dir()
+
+    def getSize(self, path):
+        """
+        Return the size of the file.
+        """
+        return self._getStat(path).st_size
+
+    def getModificationTime(self, path):
+        """
+        Return the modification time of the file.
+        """
+        return self._getStat(path).st_mtime
+
+    def listFolder(self, path):
+        """
+        Return the sorted names of the folder members.
+        """
+        listing = self._getListing(self._normalize(path))
+        if listing is None:
+            raise OSError(errno.ENOENT, 'No such folder', path)
+        return sorted(listing)
+
+    def _getStat(self, path):
+        """
+        Return the stat of the file.
+        """
+        entry = self._getEntry(path)
+        if entry is None:
+            raise OSError(errno.ENOENT, 'No such file', path)
+        return entry.stat()
+
+    def _getEntry(self, path):
+        """
+        Return the DirEntry for `path` or None if it does not exist.
+        """
+        path = self._normalize(path)
+        parent, name = os.path.split(path)
+        if not name:
+            # Root folders are not in a parent listing.
+            if not os.path.isdir(path):
+                return None
+            return _RootEntry(path)
+        listing = self._getListing(parent)
+        if listing is None:
+            return None
+        return listing.get(name)
+
+    def _getListing(self, folder):
+        """
+        Return the members of `folder`, scanning it on first use.
+        """
+        with self._lock:
+            if folder in self._folders:
+                return self._folders[folder]
+
+        try:
+            listing = {}
+            for entry in scandir(folder):
+                listing[entry.name] = entry
+        except OSError as error:
+            if error.errno not in [errno.ENOENT, errno.ENOTDIR]:
+                raise
+            listing = None
+
+        with self._lock:
+            self._folders[folder] = listing
+        return listing
+
+    def _getChild(self, folder, name):
+        """
+        Return the path of `name` in `folder`.
+        """
+        if isinstance(folder, bytes):
+            return folder.rstrip(b'/') + b'/' + _to_bytes(name)
+        return folder.rstrip('/') + '/' + name
+
+    def _normalize(self, path):
+        """
+        Return the path without trailing separators.
+        """
+        if isinstance(path, bytes):
+            return path.rstrip(b'/') or b'/'
+        return path.rstrip('/') or '/'
+
+
+class _RootEntry(object):
+    """
+    Minimal DirEntry for a root folder, which has no parent listing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = path
+
+    def is_symlink(self):
+        return False
+
+    def is_file(self):
+        return False
+
+    def is_dir(self):
+        return True
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+class _ListedEntry(object):
+    """
+    Minimal DirEntry using `os.lstat`, for when `scandir` is not
+    available.
+    """
+
+    def __init__(self, folder, name):
+        self.name = name
+        self.path = os.path.join(folder, name)
+        self._lstat = os.lstat(self.path)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._lstat.st_mode)
+
+    def is_file(self):
+        return self._hasMode(stat.S_ISREG)
+
+    def is_dir(self):
+        return self._hasMode(stat.S_ISDIR)
+
+    def stat(self):
+        if self.is_symlink():
+            return os.stat(self.path)
+        return self._lstat
+
+    def _hasMode(self, check):
+        """
+        Return True if the mode of the target is matched by `check`.
+        """
+        try:
+            return check(self.stat().st_mode)
+        except OSError:
+            # Broken link.
+            return False
+
+
+def _list_entries(folder):
+    """
+    Return the _ListedEntry for each member of `folder`.
+    """
+    entries = []
+    for name in os.listdir(folder):
+        try:
+            entries.append(_ListedEntry(folder, name))
+        except OSError as error:
+            # Removed while listing.
+            if error.errno != errno.ENOENT:
+                raise
+    return entries
+
+
+if scandir is None:
+    scandir = _list_entries
+
 
 class BrinkFilesystem(object):
     """
     Filesystem handling.
     """
 
+    def __init__(self):
+        self._indexes = weakref.WeakSet()
+        # Indexes used for answering the queries.
+        self._active = []
+
+    def createIndex(self, root):
+        """
+        Return a `FilesystemIndex` for the `root` folder, which is
+        invalidated by the changes done with this filesystem.
+        """
+        index = FilesystemIndex(self.join(root))
+        self._indexes.add(index)
+        return index
+
+    @contextmanager
+    def indexed(self, root):
+        """
+        Context manager in which the existence, type and listing queries
+        for paths inside the `root` folder are answered using a
+        `FilesystemIndex`, instead of a stat call for each path.
+
+        Files under `root` should only be changed using this filesystem
+        while inside the context.
+        """
+        index = self.createIndex(root)
+        self._active.append(index)
+        try:
+            yield index
+        finally:
+            self._active.remove(index)
+
+    def _getIndex(self, path):
+        """
+        Return the active index containing `path` or None.
+        """
+        for index in self._active:
+            if index.contains(path):
+                return index
+        return None
+
+    def _invalidate(self, path):
+        """
+        Invalidate the indexes for `path`.
+        """
+        for index in list(self._indexes):
+            index.invalidate(path)
+
     @staticmethod
     def getEncodedPath(path):
         """
         Return the encoded representation of the path, use in the lower
         lever API for accessing the filesystem.
         """
+        if isinstance(path, FilePath):
+            return path
         if os.name == 'nt':
             return path
         else:
@@ -44,7 +1028,12 @@ class BrinkFilesystem(object):
         Join paths.
 
         It also converts all paths to backslash paths.
+
+        `FilePath` members are used without being encoded again.
         """
+        if len(paths) == 1 and isinstance(paths[0], FilePath):
+            return paths[0]
+
         if os.name == 'posix':
             # Make sure we don't mix unicode
             new_paths = []
@@ -75,28 +1064,89 @@ class BrinkFilesystem(object):
         """
         Try if destination exists as file or as folder or as symlink.
         """
-        return os.path.exists(self.join(destination))
+        path = self.join(destination)
+        index = self._getIndex(path)
+        if index is not None:
+            return index.exists(path)
+        return os.path.exists(path)
 
     def isFile(self, destination):
         """
         Try if destination is a file.
         """
-        return os.path.isfile(self.join(destination))
+        path = self.join(destination)
+        index = self._getIndex(path)
+        if index is not None:
+            return index.isFile(path)
+        return os.path.isfile(path)
 
     def isFolder(self, destination):
         """
         Try if destination is a folder.
         """
-        return os.path.isdir(self.join(destination))
+        path = self.join(destination)
+        index = self._getIndex(path)
+        if index is not None:
+            return index.isFolder(path)
+        return os.path.isdir(path)
 
     def getFileContentAsString(self, target):
         """
         Return the string representation of the file.
         """
-        with open(self.join(target), 'r+') as opened_file:
+        with open(self.join(target), 'r') as opened_file:
             content = opened_file.read()
         return content
 
+    def iterLines(self, target, buffer_size=READ_BUFFER_SIZE):
+        """
+        Iterate over the lines of the file, as bytes with the newline.
+
+        As with universal newlines, a lone `\\r` also ends a line.
+        The file is read using a buffer of `buffer_size` bytes.
+        """
+        path = self.join(target)
+        with io.open(path, 'rb', buffering=buffer_size) as opened_file:
+            for line in opened_file:
+                index = line.find(b'\r')
+                if index == -1 or (
+                        index == len(line) - 2 and line.endswith(b'\n')):
+                    yield line
+                    continue
+                for part in _UNIVERSAL_LINE.findall(line):
+                    yield part
+
+    def iterChunks(self, target, chunk_size=READ_CHUNK_SIZE):
+        """
+        Iterate over the content of the file, in chunks of `chunk_size`
+        bytes.
+        """
+        with io.open(self.join(target), 'rb', buffering=0) as opened_file:
+            while True:
+                chunk = opened_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    @contextmanager
+    def getFileView(self, target):
+        """
+        Context manager for a read-only memory map of the whole file.
+
+        For empty files, which can not be mapped, it returns empty bytes.
+        """
+        with io.open(self.join(target), 'rb', buffering=0) as opened_file:
+            if not os.fstat(opened_file.fileno()).st_size:
+                yield b''
+                return
+
+            view = mmap.mmap(
+                opened_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield view
+            finally:
+                view.close()
+
     def getFileContentAsList(self, target, strip_newline=True):
         """
         Return the string representation of the file.
@@ -118,6 +1168,7 @@ class BrinkFilesystem(object):
         path = self.join(target)
         with open(path, 'w'):
             os.utime(path, None)
+        self._invalidate(path)
 
     def createFolder(self, destination, recursive=False):
         """
@@ -139,88 +1190,134 @@ class BrinkFilesystem(object):
                 pass
             else:
                 raise
+        self._invalidate(path)
 
     def copyFile(self, source, destination):
         """
         Copy file from `source` to `destination`.
         """
-        shutil.copyfile(self.join(source), self.join(destination))
+        destination = self.join(destination)
+        _copy_file(self.join(source), destination)
+        self._invalidate(destination)
 
     def copyFolder(
             self, source, destination,
             excepted_folders=None, excepted_files=None,
-            overwrite=True,
+            overwrite=True, sync=False, compare_content=False, link=False,
             ):
         """
         Copy `source` folder to `destination`.
 
         The copy is done recursive.
         If folder already exists the content will be merged.
+        Files are copied in parallel, using up to COPY_WORKERS threads.
 
         `excepted_folders` and `excepted_files` is a list of regex with
         folders and files that will not be copied.
+
+        When `sync` is True, existing files with the same size and
+        modification time are not copied again and destination files which
+        are no longer in the source are removed.
+        With `compare_content`, existing files of the same size are only
+        copied again if their content is different.
+
+        When `link` is True, files are created as hard links to the source
+        files, if they are on the same device.
+        Use it only when neither the source nor the destination files are
+        changed later.
         """
         source = self.join(source)
         destination = self.join(destination)
 
-        if excepted_folders is None:
-            excepted_folders = []
-
-        if excepted_files is None:
-            excepted_files = []
-
-        if not os.path.exists(source):
+        if not self.exists([source]):
             raise AssertionError(
                 u'Source folder does not exists: %s' % (source))
 
-        for source_folder, dirs, files in os.walk(source):
-            destination_folder = destination + source_folder[len(source):]
+        folder_patterns = _compile_patterns(excepted_folders, source)
+        file_patterns = _compile_patterns(excepted_files, source)
 
-            # Check if we need to skip this folder.
-            skip_folder = False
-            for excepted_folder in excepted_folders:
-                if re.match(excepted_folder, source_folder):
-                    skip_folder = True
-                    break
-            if skip_folder:
+        jobs = []
+        pending = [(source, destination)]
+        while pending:
+            source_folder, destination_folder = pending.pop()
+
+            # Excepted folders are matched on the full path and their
+            # content is not copied.
+            if _matches(folder_patterns, source_folder):
                 continue
 
-            if not os.path.exists(destination_folder):
+            existing = {}
+            if self.isFolder([destination_folder]):
+                for destination_entry in scandir(destination_folder):
+                    existing[destination_entry.name] = destination_entry
+            else:
                 os.mkdir(destination_folder)
+                self._invalidate(destination_folder)
 
-            for file_ in files:
-                destination_file = self.join([destination_folder, file_])
-                source_file = self.join([source_folder, file_])
+            names = set()
+            for entry in scandir(source_folder):
+                names.add(entry.name)
+                destination_path = os.path.join(destination_folder, entry.name)
+                destination_entry = existing.get(entry.name)
 
-                # Check if we need to skip this file.
-                skip_file = False
-                for excepted_file in excepted_files:
-                    if re.match(excepted_file, file_):
-                        skip_file = True
-                        break
+                if sync and destination_entry is not None:
+                    if _is_folder(entry) != _is_folder(destination_entry):
+                        self._deleteEntry(destination_entry)
+                        destination_entry = None
 
-                destination_file = self.join([destination_folder, file_])
-                source_file = self.join([source_folder, file_])
+                if _is_folder(entry):
+                    pending.append((entry.path, destination_path))
+                    continue
 
-                if not overwrite and os.path.exists(destination_file):
-                    skip_file = True
+                if _matches(file_patterns, entry.name):
+                    continue
 
-                if skip_file:
+                if destination_entry is None:
+                    jobs.append((entry, destination_path, False, False))
                     continue
 
-                if os.path.exists(destination_file):
-                    os.remove(destination_file)
+                if not overwrite:
+                    continue
 
-                if os.path.islink(source_file):
-                    linkto = os.readlink(source_file)
-                    os.symlink(linkto, destination_file)
-                else:
-                    shutil.copyfile(source_file, destination_file)
-                    shutil.copystat(source_file, destination_file)
+                compare = False
+                if sync:
+                    if entry.is_symlink() or destination_entry.is_symlink():
+                        if _is_same_link(entry, destination_entry):
+                            continue
+                    elif compare_content:
+                        compare = (
+                            entry.stat().st_size ==
+                            destination_entry.stat().st_size
+                            )
+                    elif _has_same_stat(
+                            entry.stat(), destination_entry.stat()):
+                        continue
+
+                jobs.append((entry, destination_path, True, compare))
+
+            if sync:
+                for name, destination_entry in existing.items():
+                    if name not in names:
+                        self._deleteEntry(destination_entry)
+
+        _run_parallel(partial(_copy_entry, link=link), jobs, COPY_WORKERS)
+        self._invalidate(destination)
+
+    def _deleteEntry(self, entry):
+        """
+        Delete the file or the folder of the DirEntry.
+        """
+        if _is_folder(entry):
+            self.deleteFolder([entry.path])
+        else:
+            os.remove(entry.path)
 
-    def copyFolderContent(self, source, destination, mask='.*'):
+    def copyFolderContent(self, source, destination, mask='.*', link=False):
         """
         Copy folder content. cp source/* destination/
+
+        When `link` is True, files are created as hard links to the source
+        files, if they are on the same device.
         """
         source = self.join(source)
         destination = self.join(destination)
@@ -229,20 +1326,32 @@ class BrinkFilesystem(object):
             file_source_path = self.join([source, name])
             file_destination_path = self.join([destination, name])
             try:
-                if os.path.isfile(file_source_path) and re.search(mask, name):
-                    shutil.copyfile(file_source_path, file_destination_path)
+                if self.isFile([file_source_path]) and re.search(mask, name):
+                    if link:
+                        self.deleteFile([file_destination_path])
+                        if _link_file(
+                                file_source_path, file_destination_path):
+                            continue
+                    _copy_file(file_source_path, file_destination_path)
                     shutil.copymode(file_source_path, file_destination_path)
             except re.error:
                 pass
+        self._invalidate(destination)
 
     def concatenateFiles(self, sources, destination):
         """
         Concatenate sources files to destination.
         """
-        with open(self.join(destination), 'wb') as destination_file:
+        destination_path = self.join(destination)
+        with io.open(destination_path, 'wb', buffering=0) as destination_file:
             for source in sources:
-                shutil.copyfileobj(
-                    open(self.join(source), 'rb'), destination_file)
+                source_path = self.join(source)
+                with io.open(source_path, 'rb', buffering=0) as source_file:
+                    method = _copy_data(source_file, destination_file)
+                if _COPY['debug']:
+                    print('Appended %s to %s using %s.' % (
+                        source_path, destination_path, method))
+        self._invalidate(destination_path)
 
     def deleteFile(self, path):
         """
@@ -250,41 +1359,49 @@ class BrinkFilesystem(object):
 
         Ignores errors if it does not exists.
         """
+        path = self.join(path)
         try:
-            os.unlink(self.join(path))
+            os.unlink(path)
         except OSError as error:
             if error.errno == 2:
                 pass
             else:
                 raise
+        self._invalidate(path)
 
-    def deleteFolder(self, target):
+    def deleteFolder(self, target, background=False):
         """
         Delete a folder.
 
         Ignores errors if it does not exists.
-        """
 
-        def on_error(func, path, exc_info):
-            """
-            Error handler for ``shutil.rmtree``.
+        If the file is read only, it attempts to add write permission and
+        then retries.
 
-            If the error is due to an access error (read only file)
-            it attempts to add write permission and then retries.
+        When `background` is True, the folder is moved to a sibling trash
+        folder and it is deleted in a separate thread. The build process
+        waits for it to finish before exiting.
+        Trash folders left by an interrupted build are also deleted.
+        """
+        path = self.join(target)
 
-            If the error is for another reason it re-raises the error.
-            """
-            os.chmod(path, stat.S_IWRITE)
-            func(path)
+        if background:
+            for stale in _find_stale_trash(path):
+                _delete_in_background(stale)
+            trash = _move_to_trash(path)
+            if trash is not None:
+                self._invalidate(path)
+                _delete_in_background(trash)
+                return
 
         try:
-            shutil.rmtree(
-                self.join(target), ignore_errors=False, onerror=on_error)
+            _delete_tree(path)
         except OSError as error:
             if error.errno == 2:
                 pass
             else:
                 raise
+        self._invalidate(path)
 
     def createLink(self, source, destination):
         """
@@ -293,7 +1410,9 @@ class BrinkFilesystem(object):
         createLink requires using absolute paths for source.
         """
         if os.name != 'nt':
-            os.symlink(self.join(source), self.join(destination))
+            destination_path = self.join(destination)
+            os.symlink(self.join(source), destination_path)
+            self._invalidate(destination_path)
         else:
             self.copyFolder(
                 source=source,
@@ -303,39 +1422,74 @@ class BrinkFilesystem(object):
         """
         Append content to file.
         """
-        with open(self.join(destination), 'a') as opened_file:
+        path = self.join(destination)
+        with open(path, 'a') as opened_file:
             opened_file.write(content)
+        self._invalidate(path)
 
-    def writeContentToFile(self, destination, content):
+    def writeContentToFile(self, destination, content, atomic=False):
         """
         Write content to file.
+
+        When `atomic` is True, the content is written and synced to a
+        temporary file which then replaces the destination, so that the
+        destination never has partial content.
         """
-        with open(self.join(destination), 'w') as opened_file:
-            opened_file.write(content)
+        path = self.join(destination)
+        if not atomic:
+            with open(path, 'w') as opened_file:
+                opened_file.write(content)
+            self._invalidate(path)
+            return
+
+        descriptor, temporary_path = _make_sibling_file(path)
+        try:
+            with os.fdopen(descriptor, 'w') as opened_file:
+                opened_file.write(content)
+                opened_file.flush()
+                os.fsync(opened_file.fileno())
+            _replace_file(temporary_path, path)
+        except Exception:
+            os.remove(temporary_path)
+            raise
+        finally:
+            self._invalidate(path)
 
-    def replaceFileContent(self, target, rules):
+    def replaceFileContent(self, target, rules, use_mmap=False):
         """
         Replace the file content.
 
         It takes a list for tuples [(pattern1, substitution1), (pat2, sub2)]
         and applies them in order.
+        `rules` can also be a `ReplaceRules`, to reuse the compiled rules
+        for multiple files.
+
+        The new content is written to a temporary file which then replaces
+        the target.
+        When `use_mmap` is True and all rules are plain text, the file is
+        mapped in memory and processed in a single pass, instead of line by
+        line.
         """
-        with open(self.join(target), 'r') as source_file:
-            altered_lines = []
-            for line in source_file:
-                new_line = line
-                for rule in rules:
-                    pattern = rule[0]
-                    substitution = rule[1]
-                    new_line = re.sub(
-                        pattern.encode('utf-8'),
-                        substitution.encode('utf-8'),
-                        new_line)
-                altered_lines.append(new_line)
-
-        with open(self.join(target), 'w') as source_file:
-            for line in altered_lines:
-                source_file.write(line)
+        if not isinstance(rules, ReplaceRules):
+            rules = ReplaceRules(rules)
+
+        path = self.join(target)
+        descriptor, temporary_path = _make_sibling_file(path)
+        try:
+            with io.open(descriptor, 'wb') as destination_file:
+                if use_mmap and rules.literal:
+                    with self.getFileView([path]) as view:
+                        destination_file.write(rules.apply(view))
+                else:
+                    for line in self.iterLines([path]):
+                        destination_file.write(rules.apply(line))
+            shutil.copymode(path, temporary_path)
+            _replace_file(temporary_path, path)
+        except Exception:
+            os.remove(temporary_path)
+            raise
+        finally:
+            self._invalidate(path)
 
     @contextmanager
     def changeFolder(self, destination):
@@ -365,14 +1519,46 @@ class BrinkFilesystem(object):
     def which(self, command, extra_paths=None):
         """
         Find and return the full path to `command`.
+
+        Results are cached for the whole process and a result is searched
+        again only when one of the searched folders is modified.
         """
         paths = self._getSearchPaths(extra_paths)
+        key = (command, tuple(paths))
+
+        cached = _WHICH_CACHE.get(key)
+        if cached is not None:
+            result, searched, modification_times = cached
+            if self._getModificationTimes(searched) == modification_times:
+                return result
 
+        result = None
+        searched = []
         for path in paths:
+            searched.append(path)
             result = self._findCommand(command, path)
             # Return the first result.
             if result:
-                return result
+                break
+
+        _WHICH_CACHE[key] = (
+            result, searched, self._getModificationTimes(searched))
+        return result
+
+    def _getModificationTimes(self, paths):
+        """
+        Return the list of modification times for `paths`, with None for
+        paths which don't exist.
+        """
+        result = []
+        for path in paths:
+            if isinstance(path, unicode):
+                path = self.getEncodedPath(path)
+            try:
+                result.append(os.stat(path).st_mtime)
+            except OSError:
+                result.append(None)
+        return result
 
     def _getSearchPaths(self, extra_paths=None):
         """
@@ -413,8 +1599,12 @@ class BrinkFilesystem(object):
             if not isinstance(path, unicode):
                 path = path.decode('utf-8')
 
+        index = self._getIndex(path)
         try:
-            result = os.listdir(path)
+            if index is not None:
+                result = index.listFolder(path)
+            else:
+                result = os.listdir(path)
         except OSError as error:
             if error.errno == 13:
                 return []
@@ -458,9 +1648,20 @@ class BrinkFilesystem(object):
             windows_targets.extend(targets)
             targets = windows_targets
 
-        files = self.listFolder(path)
         for target in targets:
-            for candidate in files:
-                if candidate == target:
-                    result = os.path.join(path, candidate)
-                    return result
+            # Paths and commands can be either bytes or Unicode.
+            if isinstance(path, unicode) and isinstance(target, bytes):
+                target = target.decode('utf-8')
+            elif isinstance(path, bytes) and isinstance(target, unicode):
+                target = target.encode('utf-8')
+            result = os.path.join(path, target)
+            if self._isCommandFile(result):
+                return result
+
+    def _isCommandFile(self, path):
+        """
+        Return True if `path` is a file.
+        """
+        if isinstance(path, unicode):
+            path = self.getEncodedPath(path)
+        return os.path.isfile(path)
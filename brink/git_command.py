@@ -14,7 +14,13 @@ from __future__ import (
 import os
 import sys
 
-from brink.execute import execute
+from brink.execute import (
+    async_execute,
+    execute,
+    execute_spooled,
+    iter_execute,
+    SPOOL_MEMORY,
+    )
 
 
 class BrinkGit(object):
@@ -47,9 +53,9 @@ class BrinkGit(object):
 
         raise AssertionError('Failed to find Git.')
 
-    def push(self, remote='origin'):
+    def push(self, remote='origin', timeout=None):
         '''Push current changes.'''
-        _, output = execute([self.git, 'push', remote])
+        _, output = execute([self.git, 'push', remote], timeout=timeout)
         return output.strip()
 
     def publish(self, remote='origin'):
@@ -142,20 +148,24 @@ class BrinkGit(object):
     def diffFileNames(ref='master'):
         """
         Return a list of (action, filename) that have changed in
-        comparison with `ref`.
+        comparison with `ref`, as text.
         """
-        result = []
         command = ['git', 'diff', '--name-status', '%s' % (ref)]
-        exit_code, output = execute(command)
-        if exit_code != 0:
-            print('Failed to diff files.')
-            sys.exit(1)
+        lines = iter_execute(command, encoding='utf-8')
+        return BrinkGit._parseFileNames(
+            BrinkGit._checkDiff(lines, 'Failed to diff files.'))
 
-        for line in output.splitlines():
-            action, name = line.split('\t')
+    @staticmethod
+    def _parseFileNames(lines):
+        """
+        Return the list of (action, filename) from the decoded lines of
+        `git diff --name-status`.
+        """
+        result = []
+        for line in lines:
+            action, name = line.rstrip('\r\n').split('\t')
             action = action.lower()
             result.append((action, name))
-
         return result
 
     @staticmethod
@@ -175,3 +185,141 @@ class BrinkGit(object):
             sys.exit(1)
 
         return output
+
+    @staticmethod
+    def spooledDiff(ref='master', max_memory=SPOOL_MEMORY):
+        """
+        Like `diff` but return the diff as a temporary file, which is moved
+        from memory to disk once larger than `max_memory`.
+
+        The caller should close the file.
+        """
+        if ref:
+            command = ['git', 'diff', '%s' % (ref)]
+        else:
+            command = ['git', 'diff']
+
+        exit_code, output_file = execute_spooled(
+            command, max_memory=max_memory, ignore_errors=True)
+        if exit_code != 0:
+            output_file.close()
+            print('Failed to diff repo.')
+            sys.exit(1)
+
+        return output_file
+
+    @staticmethod
+    def iterDiff(ref='master', chunk_size=None):
+        """
+        Like `diff` but yield the diff lines as they are produced by git,
+        without keeping the whole diff in memory.
+
+        When `chunk_size` is defined, it yields chunks of at most
+        `chunk_size` bytes, instead of lines.
+        """
+        if ref:
+            command = ['git', 'diff', '%s' % (ref)]
+        else:
+            command = ['git', 'diff']
+
+        lines = iter_execute(command, chunk_size=chunk_size)
+        return BrinkGit._checkDiff(lines, 'Failed to diff repo.')
+
+    @staticmethod
+    def _checkDiff(lines, error_message):
+        """
+        Yield `lines` and exit with `error_message` if git fails.
+        """
+        try:
+            for line in lines:
+                yield line
+        except SystemExit:
+            print(error_message)
+            sys.exit(1)
+
+    def _asyncOutput(self, command, parse):
+        """
+        Execute `command` using asyncio and return a future for the
+        result of calling `parse` with (exit_code, output).
+
+        It must be called from the running event loop.
+        """
+        import asyncio
+
+        result = asyncio.get_running_loop().create_future()
+
+        def on_done(execution):
+            if execution.cancelled():
+                result.cancel()
+                return
+            if result.done():
+                return
+            try:
+                value = parse(*execution.result())
+            except (Exception, SystemExit) as error:
+                result.set_exception(error)
+                return
+            result.set_result(value)
+
+        execution = async_execute(command, ignore_errors=True)
+        execution.add_done_callback(on_done)
+        result.add_done_callback(
+            lambda future: future.cancelled() and execution.cancel())
+        return result
+
+    def _asyncStrip(self, command):
+        """
+        Return an awaitable for the stripped output of `command`.
+
+        It exits on errors, as the blocking version.
+        """
+        def parse(exit_code, output):
+            if exit_code != 0:
+                sys.exit(exit_code)
+            return output.strip()
+
+        return self._asyncOutput(command, parse)
+
+    def asyncRevision(self):
+        """
+        Asyncio version of `revision`.
+        """
+        return self._asyncStrip([self.git, 'show', '-s', '--pretty=format:%H'])
+
+    def asyncOrigin(self):
+        """
+        Asyncio version of `origin`.
+        """
+        return self._asyncStrip(
+            [self.git, 'config', '--get', 'remote.origin.url'])
+
+    def asyncStatus(self):
+        """
+        Asyncio version of `status`.
+        """
+        return self._asyncStrip([self.git, 'status', '-s'])
+
+    def asyncBranchName(self):
+        """
+        Asyncio version of `branch_name`.
+        """
+        def parse(exit_code, output):
+            if exit_code != 0:
+                sys.exit(exit_code)
+            return output.strip().split(b'/')[-1]
+
+        return self._asyncOutput([self.git, 'symbolic-ref', 'HEAD'], parse)
+
+    def asyncDiffFileNames(self, ref='master'):
+        """
+        Asyncio version of `diffFileNames`.
+        """
+        def parse(exit_code, output):
+            if exit_code != 0:
+                print('Failed to diff files.')
+                sys.exit(1)
+            return self._parseFileNames(
+                output.decode('utf-8').splitlines())
+
+        return self._asyncOutput(
+            ['git', 'diff', '--name-status', '%s' % (ref)], parse)
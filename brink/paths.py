@@ -7,6 +7,98 @@ from __future__ import (
     unicode_literals,
     )
 import os
+import sys
+
+try:
+    bool(type(unicode))
+except NameError:
+    unicode = str
+
+# Type of the paths used by the low level filesystem API.
+if os.name == 'nt':
+    _LOW_LEVEL_PATH = unicode
+else:
+    _LOW_LEVEL_PATH = bytes
+
+# Interned paths, keyed by (type, value).
+_INTERNED = {}
+
+# Python 3 keeps the bytes which can not be decoded as surrogates.
+if sys.version_info[0] >= 3:
+    _DECODE_ERRORS = 'surrogateescape'
+    _ENCODE_ERRORS = 'surrogateescape'
+else:
+    _DECODE_ERRORS = 'replace'
+    _ENCODE_ERRORS = 'strict'
+
+
+def _decode(path):
+    """
+    Return the Unicode form of the bytes `path`.
+
+    On Unix the paths are UTF-8, as encoded by BrinkFilesystem, but other
+    paths are decoded using the filesystem encoding.
+    """
+    if os.name != 'nt':
+        try:
+            return path.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    encoding = sys.getfilesystemencoding() or 'utf-8'
+    return path.decode(encoding, _DECODE_ERRORS)
+
+
+class FilePath(_LOW_LEVEL_PATH):
+    """
+    Immutable path in the representation used by the low level filesystem
+    API: UTF-8 bytes on Unix and Unicode on Windows.
+
+    The Unicode form is available as `text`.
+    Bytes paths are used as they are on Unix, even when they are not
+    UTF-8.
+    Paths are interned, so each path is encoded only once and its hash is
+    computed only once.
+    """
+
+    def __new__(cls, path):
+        if isinstance(path, cls):
+            return path
+
+        key = (type(path), path)
+        result = _INTERNED.get(key)
+        if result is not None:
+            return result
+
+        if isinstance(path, unicode):
+            text = path
+        else:
+            text = _decode(path)
+
+        if _LOW_LEVEL_PATH is unicode:
+            low_level = text
+        elif isinstance(path, bytes):
+            low_level = path
+        else:
+            low_level = text.encode('utf-8', _ENCODE_ERRORS)
+
+        low_level_key = (_LOW_LEVEL_PATH, low_level)
+        result = _INTERNED.get(low_level_key)
+        if result is None:
+            result = _LOW_LEVEL_PATH.__new__(cls, low_level)
+            result.__dict__['text'] = text
+            hash(result)
+            _INTERNED[low_level_key] = result
+        _INTERNED[key] = result
+        return result
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FilePath is immutable.')
+
+    def __delattr__(self, name):
+        raise AttributeError('FilePath is immutable.')
+
+    def __repr__(self):
+        return 'FilePath(%r)' % (self.text,)
 
 
 class ProjectPaths(object):
@@ -19,12 +111,14 @@ class ProjectPaths(object):
         build_folder_name = build_folder_name.rstrip(b'\\')
         self.fs = filesystem
         self._os_name = os_name
-        self.product = os.path.abspath(b'.')
-        self.build = self.fs.join([self.product, build_folder_name])
-        self.dist = self.fs.join([self.product, folders['dist']])
-        self.publish = self.fs.join([self.product, folders['publish']])
-        self.python_executable = self.getPythonExecutable(os_name=os_name)
-        self.python_scripts = self.getPythonScripts()
+        self.product = FilePath(os.path.abspath(b'.'))
+        self.build = FilePath(self.fs.join([self.product, build_folder_name]))
+        self.dist = FilePath(self.fs.join([self.product, folders['dist']]))
+        self.publish = FilePath(
+            self.fs.join([self.product, folders['publish']]))
+        self.python_executable = FilePath(
+            self.getPythonExecutable(os_name=os_name))
+        self.python_scripts = FilePath(self.getPythonScripts())
         self.brink_package = os.path.dirname(__file__)
 
     def getPythonExecutable(self, os_name=None):
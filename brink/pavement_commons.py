@@ -24,11 +24,12 @@ from __future__ import (
     )
 
 from six.moves.configparser import RawConfigParser
+import atexit
 import getpass
+import json
 import os
 import re
 import sys
-import subprocess
 import time
 from base64 import b64encode
 from datetime import datetime
@@ -38,8 +39,17 @@ from zipfile import ZipFile
 from paver.easy import call_task, cmdopts, task, pushd, needs
 from paver.tasks import BuildFailure, environment, help, consume_args
 
+from brink.archive import benchmark_archive, get_archive_profiles
 from brink.configuration import SETUP, DIST_EXTENSION, DIST_TYPE
-from brink.utils import BrinkPaver
+from brink.execute import call, load_trace, safe_command, set_trace_path
+from brink.filesystem import set_copy_debug
+from brink.spawn import start_spawn_server
+from brink.utils import (
+    ArchiveCache,
+    BrinkPaver,
+    ChecksumFile as BaseChecksumFile,
+    DigestCache,
+    )
 from brink.qm import (
     github,
     merge_init,
@@ -50,28 +60,44 @@ from brink.qm import (
     )
 
 
+# Start it before the heavy modules are imported by the tasks, so that
+# external commands are forked from a small process.
+start_spawn_server()
+
 pave = BrinkPaver(setup=SETUP)
 
+# Resource usage for external commands is recorded only on request.
+EXECUTE_TRACE = [pave.path.build, 'execute-trace.jsonl']
+if os.environ.get('BRINK_TRACE', '').lower() in ['1', 'yes', 'true']:
+    set_trace_path(pave.fs.join(EXECUTE_TRACE))
+
+# Digests of the files from previous runs.
+DIGEST_CACHE = [pave.path.build, 'digest-cache.json']
+pave.digest_cache = DigestCache(pave.fs, DIGEST_CACHE)
+# Also keep the digests computed outside of a batch.
+atexit.register(pave.digest_cache.save)
+
+# Archives from previous runs, reused when the files were not changed.
+ARCHIVE_CACHE = [pave.path.build, 'archive-cache']
+pave.archive_cache = ArchiveCache(pave.fs, ARCHIVE_CACHE)
+
+# Show the method used for copying files.
+if os.environ.get('BRINK_DEBUG', '').lower() in ['1', 'yes', 'true']:
+    set_copy_debug(True)
 
-class ChecksumFile(object):
+
+class ChecksumFile(BaseChecksumFile):
     """
-    A file storing sha256 checksums for files.
+    A file storing sha256 checksums for files of this pavement.
+
+    It can be used as a context manager to add files in a batch::
+
+        with ChecksumFile(segments) as checksums:
+            checksums.addFiles(paths)
     """
 
     def __init__(self, segments):
-        """
-        Initialize by creating an empty file.
-        """
-        self._segments = segments
-        pave.fs.createEmptyFile(target=self._segments)
-
-    def addFile(self, file_path):
-        """
-        Add file to file listed in checksum file.
-        """
-        content = pave.createSHA256Sum([file_path]) + '  ' + file_path + '\n'
-        pave.fs.appendContentToFile(
-            destination=self._segments, content=content)
+        super(ChecksumFile, self).__init__(segments, pave)
 
 
 @task
@@ -392,15 +418,9 @@ def test_remote(args):
 
 def safe_command_output(test_command):
     """
+    Return the command as text, with the secrets masked.
     """
-    result = []
-    for part in test_command:
-        if 'CODECOV_TOKEN' in part:
-            result.append('CODECOV_TOKEN=***')
-            continue
-        result.append(part)
-
-    return ' '.join(result)
+    return ' '.join(safe_command(test_command))
 
 
 def run_test(python_command, switch_user, arguments):
@@ -444,11 +464,130 @@ def run_test(python_command, switch_user, arguments):
     test_command.extend(test_args)
     with pushd(pave.path.build):
         print(safe_command_output(test_command))
-        exit_code = subprocess.call(test_command)
+        exit_code = call(test_command)
         print('Exit code is: %d' % (exit_code))
         return exit_code
 
 
+@task
+@cmdopts([
+    ('limit=', 'l', 'Number of commands to show in each list.'),
+    ])
+def execute_trace(options):
+    """
+    Show the slowest and heaviest external commands.
+
+    Commands are recorded in the build folder only when running with
+    BRINK_TRACE=yes in the environment.
+    """
+    limit = int(pave.getOption(
+        options, 'execute_trace', 'limit', default_value=10))
+    trace_path = pave.fs.join(EXECUTE_TRACE)
+
+    if not pave.fs.exists(EXECUTE_TRACE):
+        print('No trace found at %s' % (trace_path,))
+        print('Run paver with BRINK_TRACE=yes to record commands.')
+        sys.exit(1)
+
+    records = load_trace(trace_path)
+
+    def cpu_time(record):
+        return (record['user_time'] or 0) + (record['system_time'] or 0)
+
+    def show(title, key, value_format):
+        print(title)
+        print('-' * 72)
+        ordered = sorted(records, key=key, reverse=True)
+        for record in ordered[:limit]:
+            print('%s  %s' % (
+                value_format % (key(record),),
+                ' '.join(record['command'])[:60],
+                ))
+        print('')
+
+    print('Recorded %d commands in %.2f seconds, %.2f seconds CPU.\n' % (
+        len(records),
+        sum(record['duration'] for record in records),
+        sum(cpu_time(record) for record in records),
+        ))
+    show('Slowest commands', lambda r: r['duration'], '%8.2fs')
+    show('Most CPU time', cpu_time, '%8.2fs')
+    show('Highest peak memory', lambda r: r['max_rss_kb'] or 0, '%7dKB')
+
+
+def _format_rss(value):
+    """
+    Return the text for a memory value of the archive benchmark.
+    """
+    if value is None:
+        return '?'
+    return value
+
+
+@task
+@cmdopts([
+    ('source=', 's', 'Folder with the files of a distributable.'),
+    ('json=', 'j', 'Path to the JSON report.'),
+    ])
+def benchmark_archives(options):
+    """
+    Create and read archives of a distributable folder with all the
+    supported compression profiles and report the results.
+    """
+    source = pave.getOption(
+        options, 'benchmark_archives', 'source', required=True)
+    source_path = os.path.abspath(source)
+    if not os.path.isdir(source_path):
+        print('No folder found at %s' % (source_path,))
+        sys.exit(1)
+    json_path = pave.getOption(
+        options, 'benchmark_archives', 'json',
+        default_value=pave.fs.join([pave.path.build, 'archive-benchmark.json'])
+        )
+
+    work_segments = [pave.path.build, 'archive-benchmark']
+    pave.fs.deleteFolder(work_segments)
+    pave.fs.createFolder(work_segments, recursive=True)
+
+    results = []
+    try:
+        for dist_type, name, extension, create, read in (
+                get_archive_profiles()):
+            print('Running %s...' % (name,))
+            archive_path = pave.fs.join(work_segments + [
+                '%s.%s' % (name, extension)])
+            result = benchmark_archive(source_path, archive_path, create, read)
+            if result is None:
+                print('Failed to benchmark %s.' % (name,))
+                sys.exit(1)
+            result['dist_type'] = dist_type
+            result['name'] = name
+            results.append(result)
+            pave.fs.deleteFile([archive_path])
+    finally:
+        pave.fs.deleteFolder(work_segments)
+
+    print('\n%-8s %-16s %10s %10s %10s %10s %12s' % (
+        'Type', 'Profile', 'Compress', 'Read', 'Memory', 'Added', 'Size'))
+    print('-' * 83)
+    for result in results:
+        print('%-8s %-16s %9.2fs %9.2fs %8sKB %8sKB %12d' % (
+            result['dist_type'],
+            result['name'],
+            result['compress_time'],
+            result['decompress_time'],
+            _format_rss(result['max_rss_kb']),
+            _format_rss(result['delta_rss_kb']),
+            result['size'],
+            ))
+
+    pave.fs.writeContentToFile(
+        [json_path],
+        json.dumps({'source': source_path, 'results': results}, indent=2),
+        )
+    print('\nJSON report written to %s' % (json_path,))
+
+
 @task
 def coverage_prepare():
     """
@@ -787,9 +926,11 @@ def buildbot_list(args):
                     print(line)
 
 
-def _github_api(url, method=b'GET', json=None, absolute=False):
+def _github_api(url, method=b'GET', json=None, absolute=False, data=None):
     """
     Return the JSON response from GitHub API.
+
+    `data` is an iterable with the chunks of a JSON request body.
     """
     from requests import request
 
@@ -802,8 +943,11 @@ def _github_api(url, method=b'GET', json=None, absolute=False):
         'accept': 'application/vnd.github.v3+json',
         'authorization': b'token ' + user_config['actions']['token'],
         }
+    if data is not None:
+        headers['content-type'] = 'application/json'
 
-    result = request(method=method, url=url, headers=headers, json=json)
+    result = request(
+        method=method, url=url, headers=headers, json=json, data=data)
     try:
         return result.json(), result
     except ValueError:
@@ -818,6 +962,51 @@ def _parse_datetime(raw):
     return dp.parse(raw)
 
 
+# Size of the raw diff chunks. It is a multiple of 3 so that the
+# base64 encoding of each chunk can be concatenated.
+DIFF_CHUNK_SIZE = 3 * 64 * 1024
+
+
+def _iter_b64encode_file(source):
+    """
+    Iterate over the base64 encoding of the content of the `source` file,
+    without reading the whole raw content in memory.
+    """
+    while True:
+        chunk = source.read(DIFF_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield b64encode(chunk)
+
+
+def _iter_json_with_file(payload, key, source):
+    """
+    Iterate over the JSON serialization of `payload` in which the
+    `key` member of `payload['inputs']` is the base64 encoded
+    content of the `source` file.
+
+    The `inputs` member is serialized last, ending with the `key` member,
+    so that the file content is followed only by the closing of the
+    objects.
+    """
+    def serialize(members, exclude):
+        return [
+            '%s: %s' % (json.dumps(name), json.dumps(value))
+            for name, value in sorted(members.items())
+            if name != exclude
+            ]
+
+    inputs = serialize(payload['inputs'], key)
+    inputs.append('%s: "' % (json.dumps(key),))
+    members = serialize(payload, 'inputs')
+    members.append('"inputs": {' + ', '.join(inputs))
+    yield ('{' + ', '.join(members)).encode('utf-8')
+    # The base64 alphabet does not need escaping inside a JSON string.
+    for chunk in _iter_b64encode_file(source):
+        yield chunk
+    yield b'"}}'
+
+
 class TC:
     """
     Terminal colors.
@@ -863,29 +1052,41 @@ def actions_try(options):
     target_step = options.actions_try.get('step', '')
     branch = pave.git.branch_name
 
-    diff = pave.git.diff(ref=None)
-    if debug:
-        print(diff)
-
-    diff = b64encode(diff)
-
-    # Push the latest changes to remote repo, as otherwise the diff will
-    # not be valid.
-    print('Pushing all branch commits...')
-    pave.git.push()
-
-    payload = {
-        'ref': branch,
-        'inputs': {
-            'tests': tests,
-            'diff': diff,
-            'job': job,
-            },
-        }
-
-    # Triggering the run will not give us any positive feedback.
-    url = '/actions/workflows/%s/dispatches' % (target,)
-    result, response = _github_api(url, method='POST', json=payload)
+    diff_file = pave.git.spooledDiff(ref=None)
+    try:
+        if debug:
+            # The diff is written as bytes.
+            output = getattr(sys.stdout, 'buffer', sys.stdout)
+            sys.stdout.flush()
+            for chunk in iter(lambda: diff_file.read(DIFF_CHUNK_SIZE), b''):
+                output.write(chunk)
+            output.flush()
+            print('')
+            diff_file.seek(0)
+
+        # Push the latest changes to remote repo, as otherwise the diff
+        # will not be valid.
+        print('Pushing all branch commits...')
+        pave.git.push()
+
+        payload = {
+            'ref': branch,
+            'inputs': {
+                'tests': tests,
+                'job': job,
+                },
+            }
+
+        # The diff is encoded while the request is sent.
+        # Triggering the run will not give us any positive feedback.
+        url = '/actions/workflows/%s/dispatches' % (target,)
+        result, response = _github_api(
+            url,
+            method='POST',
+            data=_iter_json_with_file(payload, 'diff', diff_file),
+            )
+    finally:
+        diff_file.close()
     if response.status_code != 204:
         print("Failed to dispatch action: %s" % (result,))
         sys.exit(1)
@@ -1062,7 +1263,7 @@ def publish_distributables(args):
     version_minor = SETUP['product']['version_minor']
 
     # Start with a clean base.
-    pave.fs.deleteFolder(target=[pave.path.dist])
+    pave.fs.deleteFolder(target=[pave.path.dist], background=True)
     pave.fs.createFolder(destination=[pave.path.dist])
 
     # This will create all the distributables aka install kits, including
@@ -1078,23 +1279,26 @@ def publish_distributables(args):
         url_fragment, version_major, version_minor]
 
     # Create publishing content for download site.
-    pave.fs.deleteFolder(trial_publish_folder)
+    pave.fs.deleteFolder(trial_publish_folder, background=True)
     pave.fs.createFolder(release_publish_folder, recursive=True)
     pave.fs.createFolder(trial_publish_folder, recursive=True)
 
-    # Copy trial files from dist into publish:
-    pave.fs.copyFolderContent(
-        source=[pave.path.dist],
-        destination=trial_publish_folder,
-        mask='.*-trial.*',
-        )
+    with pave.fs.indexed([pave.path.dist]):
+        # Link trial files from dist into publish, as they are not changed.
+        pave.fs.copyFolderContent(
+            source=[pave.path.dist],
+            destination=trial_publish_folder,
+            mask='.*-trial.*',
+            link=True,
+            )
 
-    # Copy the download files from dist into publish.
-    pave.fs.copyFolderContent(
-        source=[pave.path.dist],
-        destination=release_publish_folder,
-        mask='.*' + version + '*',
-        )
+        # Link the download files from dist into publish.
+        pave.fs.copyFolderContent(
+            source=[pave.path.dist],
+            destination=release_publish_folder,
+            mask='.*' + version + '*',
+            link=True,
+            )
 
     # For production, update latest download page.
     publish_config = SETUP['publish']
@@ -1131,6 +1335,24 @@ def publish_distributables(args):
     print("Distributable(s) published.")
 
 
+def _delete_other_folders(folder, keep):
+    """
+    Delete all members of `folder` with the exception of the names from
+    `keep`.
+    """
+    path = pave.fs.join(folder)
+    for name in pave.fs.listFolder(path):
+        member = [path, name]
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        if name in keep:
+            continue
+        if pave.fs.isFolder(member):
+            pave.fs.deleteFolder(member)
+        else:
+            pave.fs.deleteFile(member)
+
+
 @task
 @needs('update_setup')
 @consume_args
@@ -1177,23 +1399,33 @@ def publish_documentation(args):
         pave.path.publish, 'website', 'downloads']
 
     # Create publishing content for website.
-    pave.fs.createFolder([pave.path.publish])
-    pave.fs.deleteFolder(publish_website_folder)
-    pave.fs.createFolder(publish_website_folder)
-    pave.fs.createFolder(publish_documentation_folder)
-    pave.fs.createFolder(publish_documentation_versioned_folder)
+    # The documentation for this release and the latest documentation are
+    # kept from previous runs so that they are only synchronized.
+    pave.fs.createFolder(
+        publish_documentation_versioned_folder, recursive=True)
+    keep = ['v']
+    if latest:
+        keep.append('latest')
+    with pave.fs.indexed(publish_documentation_folder):
+        _delete_other_folders(
+            publish_documentation_versioned_folder, keep=[version])
+        _delete_other_folders(publish_documentation_folder, keep=keep)
+    pave.fs.deleteFolder(publish_downloads_folder, background=True)
     pave.fs.createFolder(publish_downloads_folder)
 
     call_task('documentation_website')
     pave.fs.copyFolder(
         source=[pave.path.build, 'doc', 'html'],
         destination=publish_release_folder,
+        sync=True,
+        link=True,
         )
 
     call_task('download_pages', args=[target])
 
     trial_folder = [
         pave.path.publish, 'website', 'documentation', 'trial']
+    # Not deleted in background, as the trash folder would be published.
     pave.fs.deleteFolder(trial_folder)
     pave.fs.createFolder(trial_folder)
 
@@ -1211,6 +1443,8 @@ def publish_documentation(args):
         pave.fs.copyFolder(
             source=[pave.path.build, 'doc', 'html'],
             destination=publish_latest_folder,
+            sync=True,
+            link=True,
             )
         pave.fs.copyFile(
             source=[pave.path.dist, 'index.html'],
@@ -1264,6 +1498,8 @@ def clean():
 __all__ = [
     'DIST_EXTENSION',
     'DIST_TYPE',
+    'benchmark_archives',
+    'execute_trace',
     'github',
     'merge_init',
     'merge_commit',
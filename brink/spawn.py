@@ -0,0 +1,460 @@
+# Copyright (c) 2020 Adi Roiban.
+# See LICENSE for details.
+"""
+Helper process for starting external commands.
+
+Forking a large process is slow, as the whole address space needs to be
+copied.
+The spawn server is forked while the build process is still small and it
+will fork and execute the commands on behalf of the build process.
+
+The streams of the commands are passed using named pipes and the exit
+status is sent back using a named pipe for each command.
+
+It is only used on Unix, when the Python `subprocess` module would fork
+the build process.
+"""
+from __future__ import (
+    absolute_import,
+    print_function,
+    with_statement,
+    unicode_literals,
+    )
+from collections import namedtuple
+import errno
+import os
+import pickle
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the spawn server is not used.
+    fcntl = None
+
+# Resource usage of a command, as reported by the spawn server.
+Usage = namedtuple('Usage', ['ru_utime', 'ru_stime', 'ru_maxrss'])
+
+# Format for the size of each message.
+_HEADER = struct.Struct(b'!I')
+
+_SERVER = {
+    'server': None,
+    }
+
+
+def start_spawn_server():
+    """
+    Start the spawn server used by brink.execute.
+
+    It does nothing if the spawn server is already started or if it is not
+    needed on this system.
+    """
+    if _SERVER['server'] is not None:
+        return
+    if not _is_forking():
+        return
+
+    server = SpawnServer()
+    server.start()
+    _SERVER['server'] = server
+
+
+def _is_forking():
+    """
+    Return True if `subprocess` forks the current process when starting
+    the commands of brink.execute.
+
+    The commands are started with `close_fds` and in a new process group,
+    so `subprocess` never uses `posix_spawn` for them.
+    Since Python 3.11 the process group is set without `preexec_fn` and
+    `vfork` is used on Linux.
+    """
+    if os.name != 'posix':
+        return False
+    if (
+        sys.version_info >= (3, 11) and
+        sys.platform.startswith('linux') and
+        getattr(subprocess, '_USE_VFORK', False)
+            ):
+        return False
+    return True
+
+
+def stop_spawn_server():
+    """
+    Stop the spawn server, if started.
+    """
+    server = _SERVER['server']
+    if server is None:
+        return
+    _SERVER['server'] = None
+    server.stop()
+
+
+def get_spawn_server():
+    """
+    Return the current spawn server or None when it is not started.
+    """
+    return _SERVER['server']
+
+
+def _retry(function, *args):
+    """
+    Call `function` and retry on interrupted system calls.
+    """
+    while True:
+        try:
+            return function(*args)
+        except (IOError, OSError) as error:
+            if error.errno != errno.EINTR:
+                raise
+
+
+def _send(connection, message):
+    """
+    Send the message as a pickle.
+    """
+    data = pickle.dumps(message, 2)
+    _retry(connection.sendall, _HEADER.pack(len(data)) + data)
+
+
+def _receive_exact(connection, size):
+    """
+    Return `size` bytes or None if the connection was closed.
+    """
+    chunks = []
+    while size:
+        chunk = _retry(connection.recv, size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _receive(connection):
+    """
+    Return the next message or None if the connection was closed.
+    """
+    header = _receive_exact(connection, _HEADER.size)
+    if header is None:
+        return None
+    data = _receive_exact(connection, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+def _get_returncode(status):
+    """
+    Return the exit code in the same format as `Popen.returncode`.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class SpawnedProcess(object):
+    """
+    A process started by the spawn server.
+
+    It has a subset of the `subprocess.Popen` API.
+    The resource usage is available as `usage` after the process ends.
+    """
+
+    def __init__(self, pid, stdin, stdout, status):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.returncode = None
+        self.usage = None
+        self._status = status
+
+    def __del__(self):
+        # Process which was never waited.
+        status = getattr(self, '_status', None)
+        if status is not None:
+            status.close()
+
+    def poll(self):
+        """
+        Return the exit code or None if the process is still running.
+        """
+        if self.returncode is not None:
+            return self.returncode
+
+        try:
+            os.kill(self.pid, 0)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                raise
+            # Process ended and was waited by the server.
+            return self.wait()
+        return None
+
+    def wait(self):
+        """
+        Wait for the process to end and return the exit code.
+        """
+        if self.returncode is not None:
+            return self.returncode
+
+        # The status is written by the server when the process ends.
+        # Without a status, the server was stopped.
+        with self._status:
+            data = _retry(self._status.read)
+        self._status = None
+        if not data:
+            raise OSError(errno.ECHILD, 'Spawn server is not running.')
+        returncode, usage = pickle.loads(data)
+
+        self.usage = Usage(*usage)
+        self.returncode = returncode
+        return returncode
+
+    def communicate(self, input_text=None):
+        """
+        Send the input and return (stdoutdata, None).
+        """
+        writer = None
+        if input_text:
+            writer = threading.Thread(
+                target=self._writeInput, args=(input_text,))
+            writer.start()
+        else:
+            self.stdin.close()
+
+        stdoutdata = self.stdout.read()
+        self.stdout.close()
+
+        if writer:
+            writer.join()
+
+        self.wait()
+        return (stdoutdata, None)
+
+    def _writeInput(self, input_text):
+        """
+        Write all input to the process.
+        """
+        try:
+            self.stdin.write(input_text)
+        except IOError as error:
+            if error.errno != errno.EPIPE:
+                raise
+        finally:
+            self.stdin.close()
+
+    def kill(self):
+        """
+        Kill the process.
+        """
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                raise
+
+
+class SpawnServer(object):
+    """
+    Forked process which starts the commands.
+    """
+
+    def __init__(self):
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Fork the server process.
+        """
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            # We are in the server.
+            try:
+                parent.close()
+                _serve(child)
+            finally:
+                os._exit(0)
+
+        child.close()
+        self._connection = parent
+        self._pid = pid
+
+    def stop(self):
+        """
+        Stop the server process.
+        """
+        self._connection.close()
+        _retry(os.waitpid, self._pid, 0)
+
+    def spawn(self, command, environment, cwd=None, group=True):
+        """
+        Start `command` and return the `SpawnedProcess`.
+
+        When `group` is True, the command is started in a new process
+        group.
+        Standard input and standard output are pipes, while standard error
+        is the one from the server.
+        """
+        if cwd is None:
+            cwd = os.getcwd()
+
+        folder = tempfile.mkdtemp(prefix=b'brink-spawn-')
+        try:
+            paths = [
+                os.path.join(folder, name)
+                for name in [b'stdin', b'stdout', b'status']
+                ]
+            for path in paths:
+                os.mkfifo(path, 0o600)
+
+            with self._lock:
+                _send(
+                    self._connection,
+                    [command, environment, cwd, group] + paths,
+                    )
+                pid = _receive(self._connection)
+                if pid is None:
+                    raise OSError(
+                        errno.ECHILD, 'Spawn server is not running.')
+                # The pipes are opened in the same order as in the child
+                # and in the server.
+                stdin = open(paths[0], 'wb')
+                stdout = open(paths[1], 'rb')
+                status = open(paths[2], 'rb')
+                error_code = _receive(self._connection)
+        finally:
+            # The named pipes are no longer needed once opened.
+            shutil.rmtree(folder, ignore_errors=True)
+
+        if error_code:
+            stdin.close()
+            stdout.close()
+            status.close()
+            raise OSError(error_code, os.strerror(error_code))
+
+        return SpawnedProcess(
+            pid=pid, stdin=stdin, stdout=stdout, status=status)
+
+
+def _serve(connection):
+    """
+    Main loop of the server process.
+
+    It ends when the build process closes the connection.
+    """
+    # Keyboard interrupt is handled by the build process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        request = _receive(connection)
+        if request is None:
+            return
+        _spawn(connection, *request)
+
+
+def _spawn(
+        connection, command, environment, cwd, group,
+        stdin_path, stdout_path, status_path):
+    """
+    Start `command` and report the pid and the exec error code.
+
+    When `group` is True, it is started in a new process group.
+    """
+    error_read, error_write = os.pipe()
+    # The error pipe is closed by a successful exec.
+    fcntl.fcntl(error_write, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    pid = os.fork()
+    if pid == 0:
+        # We are in the child.
+        try:
+            os.close(error_read)
+            if group:
+                os.setpgrp()
+            stdin = os.open(stdin_path, os.O_RDONLY)
+            stdout = os.open(stdout_path, os.O_WRONLY)
+            os.dup2(stdin, 0)
+            os.dup2(stdout, 1)
+            # Only keep the standard streams and the error pipe.
+            os.closerange(3, error_write)
+            os.closerange(error_write + 1, _get_max_fd())
+            for name in ['SIGINT', 'SIGPIPE', 'SIGXFSZ']:
+                if hasattr(signal, name):
+                    signal.signal(getattr(signal, name), signal.SIG_DFL)
+            os.chdir(cwd)
+            os.execvpe(command[0], command, environment)
+        except BaseException as error:
+            error_code = getattr(error, 'errno', None) or errno.EINVAL
+            os.write(error_write, str(error_code).encode('ascii'))
+        finally:
+            os._exit(255)
+
+    os.close(error_write)
+    _send(connection, pid)
+    # Opened before the exit is reported, so that it does not block
+    # when the process is never waited.
+    status_fd = os.open(status_path, os.O_WRONLY)
+
+    chunks = []
+    while True:
+        chunk = _retry(os.read, error_read, 64)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(error_read)
+
+    if chunks:
+        os.close(status_fd)
+        _retry(os.waitpid, pid, 0)
+        _send(connection, int(b''.join(chunks)))
+        return
+
+    _send(connection, 0)
+    reporter = threading.Thread(
+        target=_report_exit, args=(pid, status_fd))
+    reporter.daemon = True
+    reporter.start()
+
+
+def _report_exit(pid, status_fd):
+    """
+    Wait for the child and send the exit code and resource usage.
+
+    Called in a separate thread of the server.
+    """
+    _, status, usage = _retry(os.wait4, pid, 0)
+    result = (
+        _get_returncode(status),
+        (usage.ru_utime, usage.ru_stime, usage.ru_maxrss),
+        )
+    try:
+        _retry(os.write, status_fd, pickle.dumps(result, 2))
+    except OSError as error:
+        # The process was never waited and its status was closed.
+        if error.errno != errno.EPIPE:
+            raise
+    finally:
+        os.close(status_fd)
+
+
+def _get_max_fd():
+    """
+    Return the maximum number of file descriptors.
+    """
+    try:
+        return os.sysconf(str('SC_OPEN_MAX'))
+    except (AttributeError, ValueError):
+        return 256
@@ -0,0 +1,405 @@
+# Copyright (c) 2020 Adi Roiban.
+# See LICENSE for details.
+"""
+Unit tests for brink archives.
+"""
+from __future__ import (
+    absolute_import,
+    print_function,
+    with_statement,
+    unicode_literals,
+    )
+from contextlib import closing
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+import gzip
+import io
+import os
+import tarfile
+import threading
+import time
+
+from brink import archive as archive_module
+from brink.archive import (
+    CompressionPolicy,
+    ParallelGzipWriter,
+    benchmark_archive,
+    create_tar_gz_archive,
+    create_zip_archive,
+    get_archive_profiles,
+    )
+from brink.filesystem import BrinkFilesystem
+from brink.testing import BrinkTestCase, mk
+
+
+class ArchiveTestCase(BrinkTestCase):
+    """
+    Test case with a temporary folder for the archives.
+    """
+
+    def setUp(self):
+        super(ArchiveTestCase, self).setUp()
+        self.segments = mk.fs.createFolderInTemp(prefix=u'zip-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(self.segments))
+        self.folder = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(self.segments))
+
+    def createTree(self):
+        """
+        Create a source folder and return its path.
+        """
+        source = self.segments + [u'product']
+        mk.fs.createFolder(source)
+        mk.fs.createFolder(source + [u'lib'])
+        mk.fs.createFolder(source + [u'lib', u'empty'])
+        mk.fs.createFile(source + [u'b.txt'], content=b'b' * 100000)
+        mk.fs.createFile(source + [u'a.txt'], content=b'a')
+        mk.fs.createFile(source + [u'lib', u'skip.pyc'], content=b'skip')
+        mk.fs.createFile(
+            source + [u'lib', u'module.py'], content=b'value = 1\n' * 100)
+        return os.path.join(self.folder, b'product')
+
+    def getContent(self, path):
+        """
+        Return the content of the file at `path`.
+        """
+        with io.open(path, 'rb') as stream:
+            return stream.read()
+
+
+class TestCreateZipArchive(ArchiveTestCase):
+    """
+    Unit tests for `create_zip_archive`.
+    """
+
+    def test_content(self):
+        """
+        The archive contains the folder, without the excluded files and
+        with the members in sorted order.
+        """
+        source_path = self.createTree()
+        archive_path = os.path.join(self.folder, b'product.zip')
+
+        create_zip_archive(source_path, archive_path, exclude=['skip.pyc'])
+
+        with closing(ZipFile(archive_path)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual([
+                'product/a.txt',
+                'product/b.txt',
+                'product/lib/empty/',
+                'product/lib/module.py',
+                ],
+                archive.namelist())
+            self.assertEqual(b'b' * 100000, archive.read('product/b.txt'))
+            self.assertEqual(
+                b'value = 1\n' * 100, archive.read('product/lib/module.py'))
+
+    def test_stored(self):
+        """
+        Members selected by the policy are stored without compression.
+        """
+        source_path = self.createTree()
+        with open(os.path.join(source_path, b'image.png'), 'wb') as image:
+            image.write(b'png' * 1000)
+        with open(os.path.join(source_path, b'random'), 'wb') as random:
+            random.write(os.urandom(10000))
+        archive_path = os.path.join(self.folder, b'product.zip')
+
+        create_zip_archive(source_path, archive_path)
+
+        with closing(ZipFile(archive_path)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual({
+                'product/a.txt': ZIP_STORED,
+                'product/b.txt': ZIP_DEFLATED,
+                'product/image.png': ZIP_STORED,
+                'product/lib/empty/': ZIP_STORED,
+                'product/lib/module.py': ZIP_DEFLATED,
+                'product/lib/skip.pyc': ZIP_STORED,
+                'product/random': ZIP_STORED,
+                },
+                dict(
+                    (info.filename, info.compress_type)
+                    for info in archive.infolist()
+                    ))
+
+    def test_reproducible(self):
+        """
+        The archive is the same when created in parallel or with
+        a single thread.
+        """
+        source_path = self.createTree()
+        parallel_path = os.path.join(self.folder, b'parallel.zip')
+        serial_path = os.path.join(self.folder, b'serial.zip')
+
+        create_zip_archive(source_path, parallel_path, max_workers=4)
+        create_zip_archive(source_path, serial_path, max_workers=1)
+
+        self.assertEqual(
+            self.getContent(serial_path), self.getContent(parallel_path))
+
+
+    def test_bounded_pending(self):
+        """
+        Only a few compressed members wait to be written, even when the
+        archive is written slower than the members are compressed.
+        """
+        source_path = os.path.join(self.folder, b'many')
+        os.mkdir(source_path)
+        for index in range(40):
+            name = ('%02d' % (index,)).encode('ascii')
+            with open(os.path.join(source_path, name), 'wb') as member:
+                member.write(b'data')
+        state = {'waiting': 0, 'max': 0}
+        lock = threading.Lock()
+        compress = archive_module._compress_member
+        write = archive_module._write_member
+
+        def compress_member(*args, **kwargs):
+            result = compress(*args, **kwargs)
+            with lock:
+                state['waiting'] += 1
+                state['max'] = max(state['max'], state['waiting'])
+            return result
+
+        def write_member(*args, **kwargs):
+            time.sleep(0.01)
+            with lock:
+                state['waiting'] -= 1
+            return write(*args, **kwargs)
+
+        for name, value in [
+                ('_compress_member', compress_member),
+                ('_write_member', write_member),
+                ]:
+            patcher = self.patchObject(archive_module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        create_zip_archive(
+            source_path, os.path.join(self.folder, b'many.zip'),
+            max_workers=2)
+
+        # The window and the members being compressed by the workers.
+        self.assertLessEqual(state['max'], 2 * 2 + 1 + 2)
+
+
+class TestCompressionPolicy(BrinkTestCase):
+    """
+    Unit tests for `CompressionPolicy`.
+    """
+
+    def test_matchName(self):
+        """
+        Files with compressed formats are stored, unless configured to be
+        compressed.
+        """
+        sut = CompressionPolicy(store=['.DAT'], deflate=['.jar'])
+
+        self.assertTrue(sut.matchName('lib/python.tar.gz'))
+        self.assertTrue(sut.matchName(b'lib/IMAGE.PNG'))
+        self.assertTrue(sut.matchName('lib/data.dat'))
+        self.assertFalse(sut.matchName('lib/java.jar'))
+        self.assertIsNone(sut.matchName('lib/module.py'))
+
+    def test_isIncompressible(self):
+        """
+        Data is incompressible when its sample does not compress below
+        the store ratio.
+        """
+        sut = CompressionPolicy(probe_size=1000)
+
+        self.assertTrue(sut.isIncompressible(os.urandom(2000)))
+        self.assertFalse(sut.isIncompressible(b'text' * 500))
+        # Only the sample is checked.
+        self.assertFalse(
+            sut.isIncompressible(b'text' * 250 + os.urandom(2000)))
+        self.assertFalse(sut.isIncompressible(b''))
+
+    def test_fromConfiguration(self):
+        """
+        The policy is created from the product configuration.
+        """
+        sut = CompressionPolicy.fromConfiguration({
+            'store': ['.bin'],
+            'deflate': ['.gz'],
+            'store_ratio': 0.5,
+            })
+
+        self.assertContains('.bin', sut.store)
+        self.assertEqual(('.gz',), sut.deflate)
+        self.assertEqual(0.5, sut.store_ratio)
+
+
+class TestParallelGzipWriter(BrinkTestCase):
+    """
+    Unit tests for `ParallelGzipWriter`.
+    """
+
+    def compress(self, chunks, max_workers):
+        """
+        Return the gzip data for `chunks`, compressed in small blocks.
+        """
+        output = io.BytesIO()
+        with ParallelGzipWriter(
+                output, block_size=1000, max_workers=max_workers) as sut:
+            for chunk in chunks:
+                sut.write(chunk)
+        return output.getvalue()
+
+    def test_blocks(self):
+        """
+        The data is compressed in multiple blocks as a single gzip stream,
+        which is the same for any number of workers.
+        """
+        chunks = [b'%d some data' % (index,) * index for index in range(100)]
+
+        result = self.compress(chunks, max_workers=4)
+
+        compressed = gzip.GzipFile(fileobj=io.BytesIO(result))
+        self.assertEqual(b''.join(chunks), compressed.read())
+        self.assertEqual(self.compress(chunks, max_workers=1), result)
+
+    def test_empty(self):
+        """
+        A valid gzip stream is written when there is no data.
+        """
+        result = self.compress([], max_workers=2)
+
+        compressed = gzip.GzipFile(fileobj=io.BytesIO(result))
+        self.assertEqual(b'', compressed.read())
+
+
+class TestCreateTarGZArchive(ArchiveTestCase):
+    """
+    Unit tests for `create_tar_gz_archive`.
+    """
+
+    def test_content(self):
+        """
+        The archive contains the folder in sorted order, with normalized
+        owners and modification times.
+        """
+        source_path = self.createTree()
+        os.utime(os.path.join(source_path, b'a.txt'), (1000, 1000))
+        archive_path = os.path.join(self.folder, b'product.tar.gz')
+
+        create_tar_gz_archive(source_path, archive_path, mtime=2000)
+
+        with closing(tarfile.open(archive_path, 'r:gz')) as archive:
+            members = archive.getmembers()
+            root = members[0].name
+            self.assertEqual([
+                '/a.txt',
+                '/b.txt',
+                '/lib',
+                '/lib/module.py',
+                '/lib/skip.pyc',
+                '/lib/empty',
+                ],
+                [member.name[len(root):].rstrip('/')
+                    for member in members[1:]])
+            self.assertEqual(
+                b'b' * 100000, archive.extractfile(members[2]).read())
+            self.assertEqual(
+                [0], list(set(member.uid for member in members)))
+            self.assertEqual(
+                [1000] + [2000] * 6,
+                sorted(member.mtime for member in members))
+
+    def test_reproducible(self):
+        """
+        The archive is the same when created in parallel or with
+        a single thread.
+        """
+        source_path = self.createTree()
+        parallel_path = os.path.join(self.folder, b'parallel.tar.gz')
+        serial_path = os.path.join(self.folder, b'serial.tar.gz')
+
+        create_tar_gz_archive(source_path, parallel_path, max_workers=4)
+        create_tar_gz_archive(source_path, serial_path, max_workers=1)
+
+        self.assertEqual(
+            self.getContent(serial_path), self.getContent(parallel_path))
+
+
+    def test_stored_level(self):
+        """
+        Only the stored members are written with compression level 0.
+        """
+        source_path = os.path.join(self.folder, b'mixed')
+        os.mkdir(source_path)
+        for index in range(6):
+            name = ('%d.txt' % (index,)).encode('ascii')
+            with open(os.path.join(source_path, name), 'wb') as member:
+                member.write(b'compressible ' * (300 * index + 100))
+            name = ('%d.png' % (index,)).encode('ascii')
+            with open(os.path.join(source_path, name), 'wb') as member:
+                member.write(os.urandom(1000 * index + 100))
+        blocks = []
+        deflate = archive_module._deflate_block
+
+        def deflate_block(job):
+            blocks.append(job[:2])
+            return deflate(job)
+
+        patcher = self.patchObject(
+            archive_module, '_deflate_block', deflate_block)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        archive_path = os.path.join(self.folder, b'mixed.tar.gz')
+
+        create_tar_gz_archive(source_path, archive_path, max_workers=1)
+
+        stored = b''.join(data for data, level in blocks if level == 0)
+        self.assertNotEqual(b'', stored)
+        self.assertNotIn(b'compressible ' * 10, stored)
+        with closing(tarfile.open(archive_path, 'r:gz')) as archive:
+            members = archive.getmembers()
+            self.assertTrue(members[-1].name.endswith(str('5.txt')))
+            self.assertEqual(
+                b'compressible ' * 1600,
+                archive.extractfile(members[-1]).read())
+
+class TestBenchmarkArchive(ArchiveTestCase):
+    """
+    Unit tests for `benchmark_archive` and `get_archive_profiles`.
+    """
+
+    def test_get_archive_profiles(self):
+        """
+        There are profiles for zip and tar.gz distributables.
+        """
+        result = get_archive_profiles()
+
+        names = [profile[1] for profile in result]
+        self.assertContains('zip-store', names)
+        self.assertContains('zip-deflate-9', names)
+        self.assertContains('tar.gz-1', names)
+        self.assertContains('tar.gz-policy', names)
+        self.assertEqual(
+            ['TAR_GZ', 'ZIP'], sorted(set(profile[0] for profile in result)))
+
+    def test_benchmark_archive(self):
+        """
+        The archive is created and read, and its size is reported.
+        """
+        source_path = self.createTree()
+        archive_path = os.path.join(self.folder, b'product.zip')
+        profiles = dict(
+            (profile[1], profile) for profile in get_archive_profiles())
+        _, _, _, create, read = profiles['zip-store']
+
+        result = benchmark_archive(source_path, archive_path, create, read)
+
+        self.assertEqual(
+            os.path.getsize(archive_path), result['size'])
+        self.assertGreater(result['size'], 100000)
+        self.assertGreaterEqual(result['compress_time'], 0)
+        self.assertGreaterEqual(result['decompress_time'], 0)
+        if os.name == 'posix':
+            self.assertGreater(result['max_rss_kb'], 0)
+            self.assertGreater(result['base_rss_kb'], 0)
+            self.assertEqual(
+                result['max_rss_kb'] - result['base_rss_kb'],
+                result['delta_rss_kb'])
@@ -0,0 +1,657 @@
+# Copyright (c) 2020 Adi Roiban.
+# See LICENSE for details.
+"""
+Tests for executing external commands.
+"""
+from __future__ import (
+    absolute_import,
+    print_function,
+    with_statement,
+    unicode_literals,
+    )
+import mmap
+import os
+import sys
+import time
+
+from brink.execute import (
+    async_execute,
+    call,
+    deadline,
+    execute,
+    execute_many,
+    execute_spooled,
+    get_output_view,
+    iter_execute,
+    load_trace,
+    safe_command,
+    set_trace_path,
+    TIMEOUT_EXIT_CODE,
+    )
+from brink.filesystem import BrinkFilesystem
+from brink.testing import BrinkTestCase, conditionals, mk
+
+
+def python_command(code):
+    """
+    Return the command for running Python `code` in a child process.
+    """
+    return [sys.executable, '-c', code]
+
+
+class TestExecuteMany(BrinkTestCase):
+    """
+    Tests for execute_many.
+    """
+
+    def test_empty(self):
+        """
+        Returns an empty list when there is nothing to execute.
+        """
+        result = execute_many([])
+
+        self.assertEqual([], result)
+
+    def test_submission_order(self):
+        """
+        Results are returned in the same order as the commands, even if
+        a later command finishes first.
+        """
+        commands = [
+            python_command(
+                'import time, sys; time.sleep(0.3); sys.stdout.write("1")'),
+            python_command('import sys; sys.stdout.write("2")'),
+            python_command('import sys; sys.stdout.write("3")'),
+            ]
+
+        result = execute_many(commands, max_workers=3)
+
+        self.assertEqual([(0, b'1'), (0, b'2'), (0, b'3')], result)
+
+    def test_ignore_errors(self):
+        """
+        When errors are ignored, the exit code of each command is returned.
+        """
+        commands = [
+            python_command('import sys; sys.exit(3)'),
+            python_command('import sys; sys.stdout.write("ok")'),
+            ]
+
+        result = execute_many(commands, ignore_errors=True)
+
+        self.assertEqual([(3, b''), (0, b'ok')], result)
+
+    def test_exit_on_error(self):
+        """
+        By default, it waits for all the commands and exits with the
+        code of the first failed command.
+        """
+        commands = [
+            python_command('import sys; sys.stdout.write("ok")'),
+            python_command('import sys; sys.exit(4)'),
+            python_command('import sys; sys.exit(5)'),
+            ]
+
+        with self.assertRaises(SystemExit) as context:
+            execute_many(commands, max_workers=1)
+
+        self.assertEqual(4, context.exception.code)
+
+    def test_extra_environment(self):
+        """
+        The extra environment is passed to all commands.
+        """
+        code = 'import os, sys; sys.stdout.write(os.environ["BRINK_TEST"])'
+        commands = [python_command(code), python_command(code)]
+
+        result = execute_many(
+            commands, extra_environment={'BRINK_TEST': 'value'})
+
+        self.assertEqual([(0, b'value'), (0, b'value')], result)
+
+
+class TestIterExecute(BrinkTestCase):
+    """
+    Tests for iter_execute.
+    """
+
+    def test_lines(self):
+        """
+        By default it yields the output lines, with the line endings.
+        """
+        command = python_command(
+            'import sys; sys.stdout.write("one\\ntwo\\nthree")')
+
+        result = list(iter_execute(command))
+
+        self.assertEqual([b'one\n', b'two\n', b'three'], result)
+
+    def test_chunks(self):
+        """
+        When a chunk size is requested, it yields chunks of at most that
+        size.
+        """
+        command = python_command('import sys; sys.stdout.write("a" * 10)')
+
+        result = list(iter_execute(command, chunk_size=4))
+
+        self.assertEqual([b'aaaa', b'aaaa', b'aa'], result)
+
+    def test_encoding(self):
+        """
+        When an encoding is requested, it yields decoded text.
+        """
+        command = python_command('import sys; sys.stdout.write("one\\n")')
+
+        result = list(iter_execute(command, encoding='utf-8'))
+
+        self.assertEqual([u'one\n'], result)
+
+    def test_exit_on_error(self):
+        """
+        The exit code is checked after the output was consumed.
+        """
+        command = python_command(
+            'import sys; sys.stdout.write("partial\\n"); sys.exit(3)')
+        lines = []
+
+        with self.assertRaises(SystemExit) as context:
+            for line in iter_execute(command):
+                lines.append(line)
+
+        self.assertEqual(3, context.exception.code)
+        self.assertEqual([b'partial\n'], lines)
+
+    def test_ignore_errors(self):
+        """
+        When errors are ignored, it just stops at the end of the output.
+        """
+        command = python_command('import sys; sys.exit(3)')
+
+        result = list(iter_execute(command, ignore_errors=True))
+
+        self.assertEqual([], result)
+
+    def test_stop_early(self):
+        """
+        The child process is stopped when the iteration is stopped
+        before the end of the output.
+        """
+        command = python_command(
+            'import sys, time\n'
+            'sys.stdout.write("first\\n")\n'
+            'sys.stdout.flush()\n'
+            'time.sleep(60)\n'
+            )
+        lines = iter_execute(command)
+
+        self.assertEqual(b'first\n', next(lines))
+        lines.close()
+
+        with self.assertRaises(StopIteration):
+            next(lines)
+
+
+class TestExecuteSpooled(BrinkTestCase):
+    """
+    Tests for execute_spooled.
+    """
+
+    def test_in_memory(self):
+        """
+        Small output is kept in memory.
+        """
+        command = python_command('import sys; sys.stdout.write("small")')
+
+        exit_code, output_file = execute_spooled(command)
+        self.addCleanup(output_file.close)
+
+        self.assertEqual(0, exit_code)
+        self.assertEqual(b'small', output_file.read())
+        self.assertEqual(b'small', get_output_view(output_file))
+        self.assertEqual(5, output_file.tell())
+
+    def test_on_disk(self):
+        """
+        Output larger than the memory limit is moved to disk and can be
+        accessed as a memory map.
+        """
+        command = python_command('import sys; sys.stdout.write("a" * 1000)')
+
+        exit_code, output_file = execute_spooled(command, max_memory=100)
+        self.addCleanup(output_file.close)
+
+        self.assertEqual(0, exit_code)
+        self.assertEqual(b'a' * 1000, output_file.read())
+        view = get_output_view(output_file, max_memory=100)
+        self.addCleanup(view.close)
+        self.assertIsInstance(view, mmap.mmap)
+        self.assertEqual(1000, len(view))
+        self.assertEqual(b'aaa', view[:3])
+
+    def test_exit_on_error(self):
+        """
+        It exits on errors, as execute().
+        """
+        command = python_command('import sys; sys.exit(3)')
+
+        with self.assertRaises(SystemExit) as context:
+            execute_spooled(command)
+
+        self.assertEqual(3, context.exception.code)
+
+    def test_ignore_errors(self):
+        """
+        When errors are ignored, the exit code and the output are returned.
+        """
+        command = python_command(
+            'import sys; sys.stdout.write("partial"); sys.exit(3)')
+
+        exit_code, output_file = execute_spooled(command, ignore_errors=True)
+        self.addCleanup(output_file.close)
+
+        self.assertEqual(3, exit_code)
+        self.assertEqual(b'partial', output_file.read())
+
+
+class TestProcessGroup(BrinkTestCase):
+    """
+    Tests for the process group of the executed commands.
+    """
+
+    @conditionals.onOSFamily('posix')
+    def test_group(self):
+        """
+        The child is started in a new process group, but in the same
+        session, so that it keeps the controlling terminal.
+        """
+        exit_code, output = execute(python_command(
+            'import os, sys; '
+            'sys.stdout.write("%d %d" % (os.getsid(0), os.getpgrp()))'
+            ))
+
+        session, group = [int(value) for value in output.split()]
+        self.assertEqual(0, exit_code)
+        self.assertEqual(os.getsid(0), session)
+        self.assertNotEqual(os.getpgrp(), group)
+
+    def runInTerminal(self, timeout):
+        """
+        Run a build in the foreground of a new terminal, executing a
+        command which reads the answer from the terminal.
+
+        Returns the output of the terminal.
+        """
+        import pty
+        import select
+        from brink import get_module_path
+
+        command = python_command(
+            'import sys; sys.stdout.write(open("/dev/tty").readline())')
+        code = (
+            'import sys\n'
+            'from brink.execute import execute\n'
+            'exit_code, output = execute(%r, timeout=%r)\n'
+            'sys.stdout.write("got:" + output.decode("ascii"))\n'
+            ) % (command, timeout)
+        environment = os.environ.copy()
+        environment[str('PYTHONPATH')] = os.path.dirname(get_module_path())
+
+        pid, terminal = pty.fork()
+        if pid == 0:
+            # We are in the build process.
+            try:
+                os.execve(
+                    sys.executable, python_command(code), environment)
+            finally:
+                os._exit(1)
+
+        os.write(terminal, b'answer\n')
+        output = b''
+        end = time.time() + 30
+        while time.time() < end:
+            readable, _, _ = select.select([terminal], [], [], 1)
+            if not readable:
+                continue
+            try:
+                data = os.read(terminal, 1024)
+            except OSError:
+                # Terminal was closed.
+                break
+            if not data:
+                break
+            output += data
+        else:
+            os.kill(pid, 9)
+        os.close(terminal)
+        os.waitpid(pid, 0)
+        return output
+
+    @conditionals.onOSFamily('posix')
+    def test_terminal_prompt(self):
+        """
+        Without a timeout, the child is kept in the foreground process
+        group and can read from the terminal.
+        """
+        output = self.runInTerminal(timeout=None)
+
+        self.assertContains(b'got:answer', output)
+
+    @conditionals.onOSFamily('posix')
+    def test_terminal_prompt_timeout(self):
+        """
+        With a timeout, the child is moved to the foreground of the
+        terminal while running, so it can read from the terminal.
+        """
+        output = self.runInTerminal(timeout=20)
+
+        self.assertContains(b'got:answer', output)
+
+
+class TestTrace(BrinkTestCase):
+    """
+    Tests for recording the resource usage of the executed commands.
+    """
+
+    def setUp(self):
+        super(TestTrace, self).setUp()
+        self.trace_segments = mk.fs.createFileInTemp(suffix='.jsonl')
+        self.addCleanup(mk.fs.deleteFile, self.trace_segments)
+        self.trace_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(self.trace_segments))
+        set_trace_path(self.trace_path)
+        self.addCleanup(set_trace_path, None)
+
+    def test_safe_command(self):
+        """
+        The codecov token is masked.
+        """
+        result = safe_command(['sudo', 'CODECOV_TOKEN=secret', 'python'])
+
+        self.assertEqual(['sudo', 'CODECOV_TOKEN=***', 'python'], result)
+
+    def test_disabled(self):
+        """
+        Nothing is recorded when tracing is disabled.
+        """
+        set_trace_path(None)
+
+        execute(python_command('pass'))
+
+        self.assertEqual([], load_trace(self.trace_path))
+
+    def test_execute(self):
+        """
+        The masked command, exit code and timing is recorded for each
+        command, while the output is still returned.
+        """
+        command = python_command(
+            'import sys; sys.stdout.write("done"); sys.exit(2)')
+        command.append('CODECOV_TOKEN=secret')
+
+        result = execute(command, ignore_errors=True)
+
+        self.assertEqual((2, b'done'), result)
+        records = load_trace(self.trace_path)
+        self.assertEqual(1, len(records))
+        record = records[0]
+        self.assertEqual('CODECOV_TOKEN=***', record['command'][-1])
+        self.assertEqual(2, record['exit_code'])
+        self.assertGreater(record['duration'], 0)
+
+    def test_execute_input(self):
+        """
+        Input is still sent to the child while tracing.
+        """
+        command = python_command(
+            'import sys; sys.stdout.write(sys.stdin.read())')
+
+        result = execute(command, input_text=b'some input')
+
+        self.assertEqual((0, b'some input'), result)
+        self.assertEqual(1, len(load_trace(self.trace_path)))
+
+    @conditionals.onOSFamily('posix')
+    def test_resource_usage(self):
+        """
+        On Unix, the CPU time and the peak memory is recorded.
+        """
+        execute_many([python_command('pass'), python_command('pass')])
+        list(iter_execute(python_command('pass')))
+        call(python_command('pass'))
+
+        records = load_trace(self.trace_path)
+
+        self.assertEqual(4, len(records))
+        for record in records:
+            self.assertEqual(0, record['exit_code'])
+            self.assertGreater(record['user_time'] + record['system_time'], 0)
+            self.assertGreater(record['max_rss_kb'], 0)
+
+    def test_missing_folder(self):
+        """
+        The folder of the trace file is created when it does not exist.
+        """
+        segments = mk.fs.createFolderInTemp(prefix=u'trace-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(segments))
+        folder = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(segments))
+        trace_path = os.path.join(folder, b'build', b'trace.jsonl')
+        set_trace_path(trace_path)
+
+        execute(python_command('pass'))
+
+        self.assertEqual(1, len(load_trace(trace_path)))
+
+    def test_call(self):
+        """
+        call() returns the exit code without exiting.
+        """
+        result = call(python_command('import sys; sys.exit(3)'))
+
+        self.assertEqual(3, result)
+        self.assertEqual(3, load_trace(self.trace_path)[0]['exit_code'])
+
+
+class TestTimeout(BrinkTestCase):
+    """
+    Tests for stopping commands which run for too long.
+    """
+
+    def test_execute_timeout(self):
+        """
+        The command is stopped after the timeout and exits with the
+        timeout exit code.
+        """
+        command = python_command('import time; time.sleep(60)')
+
+        with self.assertRaises(SystemExit) as context:
+            execute(command, timeout=0.5)
+
+        self.assertEqual(TIMEOUT_EXIT_CODE, context.exception.code)
+
+    def test_execute_timeout_ignore_errors(self):
+        """
+        When errors are ignored, the timeout exit code is returned together
+        with the output produced before the timeout.
+        """
+        command = python_command(
+            'import sys, time\n'
+            'sys.stdout.write("started")\n'
+            'sys.stdout.flush()\n'
+            'time.sleep(60)\n'
+            )
+
+        result = execute(command, timeout=0.5, ignore_errors=True)
+
+        self.assertEqual((TIMEOUT_EXIT_CODE, b'started'), result)
+
+    def test_execute_no_timeout(self):
+        """
+        Commands ending before the timeout are not affected.
+        """
+        result = execute(python_command('pass'), timeout=30)
+
+        self.assertEqual((0, b''), result)
+
+    @conditionals.onOSFamily('posix')
+    def test_timeout_process_tree(self):
+        """
+        The children started by the command are also stopped.
+
+        The child keeps the output open, so the command will only
+        return after the child is stopped.
+        """
+        command = [
+            '/bin/sh', '-c', 'sleep 60 & sleep 60',
+            ]
+        start = time.time()
+
+        result = execute(command, timeout=0.5, ignore_errors=True)
+
+        self.assertEqual(TIMEOUT_EXIT_CODE, result[0])
+        self.assertLess(time.time() - start, 30)
+
+    def test_iter_execute_timeout(self):
+        """
+        The streaming mode is also stopped after the timeout.
+        """
+        command = python_command(
+            'import sys, time\n'
+            'sys.stdout.write("first\\n")\n'
+            'sys.stdout.flush()\n'
+            'time.sleep(60)\n'
+            )
+        lines = []
+
+        with self.assertRaises(SystemExit) as context:
+            for line in iter_execute(command, timeout=0.5):
+                lines.append(line)
+
+        self.assertEqual(TIMEOUT_EXIT_CODE, context.exception.code)
+        self.assertEqual([b'first\n'], lines)
+
+    def test_deadline(self):
+        """
+        The deadline is shared by all the commands executed inside the
+        context.
+        """
+        sleep = python_command('import time; time.sleep(0.4)')
+
+        with deadline(1):
+            first = execute(sleep, ignore_errors=True)
+            second = execute(sleep, ignore_errors=True)
+            third = execute(sleep, ignore_errors=True)
+
+        self.assertEqual(0, first[0])
+        self.assertEqual(0, second[0])
+        self.assertEqual(TIMEOUT_EXIT_CODE, third[0])
+        # Deadline is no longer active outside the context.
+        self.assertEqual(0, execute(sleep)[0])
+
+    def test_deadline_execute_many(self):
+        """
+        The deadline also applies to parallel commands.
+        """
+        commands = [
+            python_command('pass'),
+            python_command('import time; time.sleep(60)'),
+            ]
+
+        with deadline(0.5):
+            result = execute_many(commands, ignore_errors=True)
+
+        self.assertEqual(0, result[0][0])
+        self.assertEqual(TIMEOUT_EXIT_CODE, result[1][0])
+
+
+class TestAsyncExecute(BrinkTestCase):
+    """
+    Tests for async_execute.
+    """
+
+    def setUp(self):
+        super(TestAsyncExecute, self).setUp()
+        if sys.version_info[0] < 3:
+            raise self.skipTest('asyncio requires Python 3.')
+
+        import asyncio
+        self.asyncio = asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    def runAsync(self, function):
+        """
+        Call `function` from the running event loop and return the result
+        of the future returned by it, as awaited by a coroutine.
+        """
+        started = self.loop.create_future()
+
+        def start():
+            try:
+                started.set_result(function())
+            except Exception as error:
+                started.set_exception(error)
+
+        self.loop.call_soon(start)
+        future = self.loop.run_until_complete(started)
+        return self.loop.run_until_complete(
+            self.asyncio.wait_for(future, None))
+
+    def test_output(self):
+        """
+        It resolves to the exit code and the output.
+        """
+        command = python_command(
+            'import sys; sys.stdout.write(sys.stdin.read())')
+
+        result = self.runAsync(
+            lambda: async_execute(command, input_text=b'some input'))
+
+        self.assertEqual((0, b'some input'), result)
+
+    def test_parallel(self):
+        """
+        Multiple commands can run at the same time.
+        """
+        sleep = python_command('import time; time.sleep(0.5)')
+        start = time.time()
+
+        result = self.runAsync(lambda: self.asyncio.gather(
+            async_execute(sleep), async_execute(sleep), async_execute(sleep)))
+
+        self.assertEqual([(0, b''), (0, b''), (0, b'')], result)
+        self.assertLess(time.time() - start, 1.4)
+
+    def test_exit_on_error(self):
+        """
+        It fails with SystemExit on errors, as execute().
+        """
+        command = python_command('import sys; sys.exit(3)')
+
+        with self.assertRaises(SystemExit) as context:
+            self.runAsync(lambda: async_execute(command))
+
+        self.assertEqual(3, context.exception.code)
+
+    def test_missing_command(self):
+        """
+        It fails with SystemExit when the command is not found.
+        """
+        with self.assertRaises(SystemExit) as context:
+            self.runAsync(lambda: async_execute(['no-such-brink-command']))
+
+        self.assertEqual(1, context.exception.code)
+
+    def test_timeout(self):
+        """
+        The command is stopped after the timeout.
+        """
+        command = python_command('import time; time.sleep(60)')
+
+        result = self.runAsync(lambda: async_execute(
+            command, timeout=0.5, ignore_errors=True))
+
+        self.assertEqual((TIMEOUT_EXIT_CODE, b''), result)
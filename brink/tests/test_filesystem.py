@@ -11,9 +11,14 @@ from __future__ import (
     with_statement,
     unicode_literals,
     )
+import errno
+import io
 import os
+import shutil
+import stat
 
-from brink.filesystem import BrinkFilesystem
+from brink import filesystem
+from brink.filesystem import BrinkFilesystem, wait_background_deletes
 from brink.testing import BrinkTestCase, mk
 
 try:
@@ -40,7 +45,7 @@ class TestBrinkFilesystem(BrinkTestCase):
         """
         command = mk.string()
         extra_paths = [mk.string()]
-        self.sut.listFolder = self.Mock(return_value=[])
+        self.sut._isCommandFile = self.Mock(return_value=False)
 
         result = self.sut.which(command, extra_paths=extra_paths)
 
@@ -56,13 +61,7 @@ class TestBrinkFilesystem(BrinkTestCase):
         full_path_to_command = os.path.join(folder, command)
         extra_paths = [mk.string(), folder]
 
-        def _folderListing(path):
-            result = []
-            if folder == path:
-                result.append(command)
-            return result
-
-        self.sut.listFolder = _folderListing
+        self.setCommandFiles(folder, [command])
 
         result = self.sut.which(command, extra_paths=extra_paths)
 
@@ -75,13 +74,61 @@ class TestBrinkFilesystem(BrinkTestCase):
         """
         command = mk.string()
         path_exe_file = '%s.exe' % command
-        self.sut.listFolder = self.Mock(return_value=[])
+        self.sut._isCommandFile = self.Mock(return_value=False)
         extra_paths = [mk.string(), path_exe_file]
 
         result = self.sut.which(command, extra_paths=extra_paths)
 
         self.assertIsNone(result)
 
+    def test_which_cached(self):
+        """
+        The result is cached and searched again only when one of the
+        searched folders is modified.
+        """
+        segments = mk.fs.createFolderInTemp(prefix=u'bin-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(segments))
+        folder = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(segments))
+        command = mk.makeFilename().encode('utf-8')
+        self.sut._isCommandFile = self.Mock(return_value=False)
+
+        result = self.sut.which(command, extra_paths=[folder])
+
+        self.assertIsNone(result)
+        self.assertTrue(self.sut._isCommandFile.called)
+        self.sut._isCommandFile.reset_mock()
+
+        result = self.sut.which(command, extra_paths=[folder])
+
+        self.assertIsNone(result)
+        self.assertFalse(self.sut._isCommandFile.called)
+
+        # Creating a file in a searched folder invalidates the cache.
+        os.utime(folder, (1000, 2000))
+        self.setCommandFiles(folder, [command])
+
+        result = self.sut.which(command, extra_paths=[folder])
+
+        self.assertEqual(os.path.join(folder, command), result)
+
+    def test_isCommandFile(self):
+        """
+        Only existing files are commands.
+        """
+        segments = mk.fs.createFolderInTemp(prefix=u'bin-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(segments))
+        folder = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(segments))
+        path = os.path.join(folder, b'command')
+        with open(path, 'wb'):
+            pass
+
+        self.assertTrue(self.sut._isCommandFile(path))
+        self.assertFalse(self.sut._isCommandFile(folder))
+        self.assertFalse(
+            self.sut._isCommandFile(os.path.join(folder, b'missing')))
+
     def test_parseUnixPaths(self):
         """
         It uses : to separate path entries.
@@ -129,7 +176,7 @@ class TestBrinkFilesystem(BrinkTestCase):
             bat_command,
             cmd_command,
             ]
-        self.sut.listFolder = self.Mock(return_value=files)
+        self.setCommandFiles(path, files)
 
         result = self.sut._findCommand(command, path)
 
@@ -157,7 +204,7 @@ class TestBrinkFilesystem(BrinkTestCase):
             command,
             exe_command,
             ]
-        self.sut.listFolder = self.Mock(return_value=files)
+        self.setCommandFiles(path, files)
 
         result = self.sut._findCommand(command, path)
 
@@ -179,7 +226,7 @@ class TestBrinkFilesystem(BrinkTestCase):
             command,
             exe_command,
             ]
-        self.sut.listFolder = self.Mock(return_value=files)
+        self.setCommandFiles(path, files)
 
         result = self.sut._findCommand(exe_command, path)
 
@@ -205,7 +252,7 @@ class TestBrinkFilesystem(BrinkTestCase):
         command = mk.string()
         path = mk.string()
         files = [mk.string(), mk.string()]
-        self.sut.listFolder = self.Mock(return_value=files)
+        self.setCommandFiles(path, files)
 
         result = self.sut._findCommand(command, path)
 
@@ -285,3 +332,755 @@ class TestBrinkFilesystem(BrinkTestCase):
             self.assertIsInstance(str, second_join)
         else:
             self.assertIsInstance(unicode, second_join)
+
+    def test_copyFolder_tree(self):
+        """
+        It copies the whole tree, with the file attributes and symbolic
+        links, skipping the excepted folders and files.
+        """
+        source_segments = mk.fs.createFolderInTemp(prefix=u'src-')
+        destination_segments = mk.fs.createFolderInTemp(prefix=u'dst-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(source_segments))
+        self.addCleanup(lambda: mk.fs.deleteFolder(destination_segments))
+        mk.fs.createFolder(source_segments + [u'child'])
+        mk.fs.createFolder(source_segments + [u'child', u'deep'])
+        mk.fs.createFolder(source_segments + [u'skip-folder'])
+        mk.fs.createFile(source_segments + [u'root.txt'], content=b'root')
+        mk.fs.createFile(
+            source_segments + [u'child', u'deep', u'leaf.txt'],
+            content=b'leaf')
+        mk.fs.createFile(source_segments + [u'child', u'skip.pyc'])
+        mk.fs.createFile(source_segments + [u'skip-folder', u'other.txt'])
+        source_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(source_segments))
+        os.utime(os.path.join(source_path, b'root.txt'), (1000, 2000))
+        if os.name == 'posix':
+            os.symlink(b'root.txt', os.path.join(source_path, b'link'))
+
+        self.sut.copyFolder(
+            source=[u'/'] + source_segments,
+            destination=[u'/'] + destination_segments,
+            excepted_folders=[u'.*skip-folder$'],
+            excepted_files=[u'.*\\.pyc$'],
+            )
+
+        self.assertEqual(
+            b'leaf',
+            mk.fs.getFileContent(
+                destination_segments + [u'child', u'deep', u'leaf.txt'],
+                utf8=False))
+        self.assertFalse(
+            mk.fs.exists(destination_segments + [u'child', u'skip.pyc']))
+        self.assertFalse(
+            mk.fs.exists(destination_segments + [u'skip-folder']))
+        destination_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(destination_segments))
+        root_stat = os.stat(os.path.join(destination_path, b'root.txt'))
+        self.assertEqual(2000, root_stat.st_mtime)
+        if os.name == 'posix':
+            self.assertEqual(
+                b'root.txt',
+                os.readlink(os.path.join(destination_path, b'link')))
+
+    def test_copyFolder_overwrite(self):
+        """
+        By default, existing files are replaced.
+        """
+        source_segments = mk.fs.createFolderInTemp(prefix=u'src-')
+        destination_segments = mk.fs.createFolderInTemp(prefix=u'dst-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(source_segments))
+        self.addCleanup(lambda: mk.fs.deleteFolder(destination_segments))
+        mk.fs.createFile(source_segments + [u'file'], content=b'source')
+        mk.fs.createFile(destination_segments + [u'file'], content=b'old')
+
+        self.sut.copyFolder(
+            source=[u'/'] + source_segments,
+            destination=[u'/'] + destination_segments,
+            )
+
+        self.assertEqual(
+            b'source',
+            mk.fs.getFileContent(destination_segments + [u'file'], utf8=False))
+
+    def test_list_entries(self):
+        """
+        Without `scandir`, the folder entries are listed using `os.lstat`,
+        with the same types as `scandir`.
+        """
+        segments = mk.fs.createFolderInTemp(prefix=u'list-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(segments))
+        mk.fs.createFolder(segments + [u'folder'])
+        mk.fs.createFile(segments + [u'file'], content=b'data')
+        path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(segments))
+        if hasattr(os, 'symlink'):
+            os.symlink(b'folder', os.path.join(path, b'link'))
+            os.symlink(b'missing', os.path.join(path, b'broken'))
+
+        def describe(entries):
+            return sorted(
+                (entry.name, entry.path, entry.is_dir(), entry.is_file(),
+                 entry.is_symlink())
+                for entry in entries
+                )
+
+        self.assertEqual(
+            describe(filesystem.scandir(path)),
+            describe(filesystem._list_entries(path)),
+            )
+
+    def test_copyFolder_sync(self):
+        """
+        In sync mode, files with the same size and modification time are
+        not copied again and files which are no longer in the source are
+        removed.
+        """
+        source_segments = mk.fs.createFolderInTemp(prefix=u'src-')
+        destination_segments = mk.fs.createFolderInTemp(prefix=u'dst-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(source_segments))
+        self.addCleanup(lambda: mk.fs.deleteFolder(destination_segments))
+        mk.fs.createFile(source_segments + [u'same'], content=b'source')
+        mk.fs.createFile(source_segments + [u'changed'], content=b'new')
+        mk.fs.createFile(destination_segments + [u'same'], content=b'other!')
+        mk.fs.createFile(destination_segments + [u'changed'], content=b'old')
+        mk.fs.createFile(destination_segments + [u'removed'])
+        mk.fs.createFolder(destination_segments + [u'removed-folder'])
+        source_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(source_segments))
+        destination_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(destination_segments))
+        os.utime(os.path.join(source_path, b'same'), (1000, 2000))
+        os.utime(os.path.join(destination_path, b'same'), (1000, 2000))
+
+        self.sut.copyFolder(
+            source=[u'/'] + source_segments,
+            destination=[u'/'] + destination_segments,
+            sync=True,
+            )
+
+        self.assertEqual(
+            [b'changed', b'same'], sorted(os.listdir(destination_path)))
+        self.assertEqual(
+            b'other!',
+            mk.fs.getFileContent(destination_segments + [u'same'], utf8=False))
+        self.assertEqual(
+            b'new',
+            mk.fs.getFileContent(
+                destination_segments + [u'changed'], utf8=False))
+
+        # With content comparison, the file is copied again.
+        self.sut.copyFolder(
+            source=[u'/'] + source_segments,
+            destination=[u'/'] + destination_segments,
+            sync=True,
+            compare_content=True,
+            )
+
+        self.assertEqual(
+            b'source',
+            mk.fs.getFileContent(destination_segments + [u'same'], utf8=False))
+
+    def test_copyFile(self):
+        """
+        It copies the content of the file, using the best available method.
+        """
+        source_segments = self.tempFileWithContent(b'data' * 100)
+        destination_segments = self.tempFileWithContent(b'')
+
+        self.sut.copyFile(
+            source=[u'/'] + source_segments,
+            destination=[u'/'] + destination_segments,
+            )
+
+        self.assertEqual(
+            b'data' * 100,
+            mk.fs.getFileContent(destination_segments, utf8=False))
+
+    def test_copyFile_fallback(self):
+        """
+        When the kernel methods are not supported, the data is copied
+        using Python buffers.
+        """
+        source_segments = self.tempFileWithContent(b'data' * 100)
+        destination_segments = self.tempFileWithContent(b'')
+        source_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(source_segments))
+        destination_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(destination_segments))
+
+        def unsupported(source_file, destination_file, size):
+            destination_file.write(b'partial')
+            raise OSError(errno.EXDEV, 'Cross-device link')
+
+        for name in ['_clone', '_copy_file_range', '_sendfile']:
+            patcher = self.patchObject(filesystem, name, unsupported)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with io.open(source_path, 'rb', buffering=0) as source:
+            with io.open(destination_path, 'wb', buffering=0) as destination:
+                result = filesystem._copy_data(
+                    source, destination, clone=True)
+
+        self.assertEqual('buffer', result)
+        self.assertEqual(
+            b'data' * 100,
+            mk.fs.getFileContent(destination_segments, utf8=False))
+
+    def _patchCopyFileRange(self, counts):
+        """
+        Replace os.copy_file_range with a fake returning the `counts`.
+        """
+        counts = list(counts)
+
+        def copy_file_range(source, destination, count):
+            return counts.pop(0)
+
+        patcher = self.patchObject(
+            os, 'copy_file_range', copy_file_range, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_copy_file_range_nothing_copied(self):
+        """
+        When the kernel copies nothing, the next method is tried.
+        """
+        self._patchCopyFileRange([0])
+
+        result = filesystem._copy_file_range(self.Mock(), self.Mock(), 100)
+
+        self.assertFalse(result)
+
+    def test_copy_file_range_truncated(self):
+        """
+        When the kernel stops copying before the end, the source was
+        truncated and an error is raised.
+        """
+        self._patchCopyFileRange([60, 0])
+        source = self.Mock()
+        destination = self.Mock()
+
+        with self.assertRaises(IOError):
+            filesystem._copy_file_range(source, destination, 100)
+
+    def test_copyFile_same_file(self):
+        """
+        Copying a file over itself fails without truncating the file.
+        """
+        segments = self.tempFileWithContent(b'data' * 100)
+
+        with self.assertRaises(shutil.Error):
+            self.sut.copyFile(
+                source=[u'/'] + segments,
+                destination=[u'/'] + segments,
+                )
+
+        self.assertEqual(
+            b'data' * 100, mk.fs.getFileContent(segments, utf8=False))
+
+    def linkInTemp(self, segments):
+        """
+        Create a hard link to the file at `segments` and return the
+        segments of the link.
+        """
+        if not hasattr(os, 'link'):
+            raise self.skipTest('Hard links are not supported.')
+        link_segments = mk.fs.createFileInTemp()
+        mk.fs.deleteFile(link_segments)
+        os.link(
+            BrinkFilesystem.getEncodedPath(
+                mk.fs.getRealPathFromSegments(segments)),
+            BrinkFilesystem.getEncodedPath(
+                mk.fs.getRealPathFromSegments(link_segments)),
+            )
+        self.addCleanup(mk.fs.deleteFile, link_segments)
+        return link_segments
+
+    def test_copyFile_linked(self):
+        """
+        Copying over a hard link replaces the link, without changing the
+        linked file.
+        """
+        linked_segments = self.tempFileWithContent(b'linked')
+        source_segments = self.tempFileWithContent(b'new')
+        destination_segments = self.linkInTemp(linked_segments)
+
+        self.sut.copyFile(
+            source=[u'/'] + source_segments,
+            destination=[u'/'] + destination_segments,
+            )
+
+        self.assertEqual(
+            b'new', mk.fs.getFileContent(destination_segments, utf8=False))
+        self.assertEqual(
+            b'linked', mk.fs.getFileContent(linked_segments, utf8=False))
+
+    def test_copyFile_own_link(self):
+        """
+        Copying a file over a hard link to itself replaces the link with
+        a copy.
+        """
+        source_segments = self.tempFileWithContent(b'data' * 100)
+        destination_segments = self.linkInTemp(source_segments)
+
+        self.sut.copyFile(
+            source=[u'/'] + source_segments,
+            destination=[u'/'] + destination_segments,
+            )
+
+        self.assertEqual(
+            b'data' * 100,
+            mk.fs.getFileContent(destination_segments, utf8=False))
+        self.assertFalse(os.path.samefile(
+            BrinkFilesystem.getEncodedPath(
+                mk.fs.getRealPathFromSegments(source_segments)),
+            BrinkFilesystem.getEncodedPath(
+                mk.fs.getRealPathFromSegments(destination_segments)),
+            ))
+
+    def test_concatenateFiles(self):
+        """
+        It writes the content of all sources in order.
+        """
+        first_segments = self.tempFileWithContent(b'first\n')
+        second_segments = self.tempFileWithContent(b'second\n')
+        destination_segments = self.tempFileWithContent(b'')
+
+        self.sut.concatenateFiles(
+            sources=[[u'/'] + first_segments, [u'/'] + second_segments],
+            destination=[u'/'] + destination_segments,
+            )
+
+        self.assertEqual(
+            b'first\nsecond\n',
+            mk.fs.getFileContent(destination_segments, utf8=False))
+
+    def test_replaceFileContent(self):
+        """
+        It applies the rules in order, on each line.
+        """
+        segments = self.tempFileWithContent(
+            b'version: VERSION\nname: NAME-VERSION\nother\n')
+        rules = [
+            ['VERSION', '1.2.3'],
+            ['NAME', 'product VERSION'],
+            ['^name: (.*)$', 'title: \\1'],
+            ]
+
+        self.sut.replaceFileContent([u'/'] + segments, rules)
+
+        self.assertEqual(
+            b'version: 1.2.3\ntitle: product VERSION-1.2.3\nother\n',
+            mk.fs.getFileContent(segments, utf8=False))
+
+    def test_replaceFileContent_mmap(self):
+        """
+        Plain text rules can be applied on the memory mapped file, with the
+        same result.
+        """
+        content = b'PAGE-TITLE-PLACEHOLDER\nPAGE-CONTENT-PLACEHOLDER\n'
+        segments = self.tempFileWithContent(content)
+        rules = filesystem.ReplaceRules([
+            ['PAGE-TITLE-PLACEHOLDER', 'Title'],
+            ['PAGE-CONTENT-PLACEHOLDER', '<p>\nContent\n</p>'],
+            ])
+
+        self.sut.replaceFileContent([u'/'] + segments, rules, use_mmap=True)
+
+        self.assertTrue(rules.literal)
+        self.assertEqual(
+            b'Title\n<p>\nContent\n</p>\n',
+            mk.fs.getFileContent(segments, utf8=False))
+
+    def test_ReplaceRules_merge(self):
+        """
+        Plain text rules are merged only when the result is the same as
+        applying them one after the other.
+        """
+        merged = filesystem.ReplaceRules([['first', '1'], ['second', '2']])
+        overlapping = filesystem.ReplaceRules([['bc', 'Y'], ['ab', 'X']])
+        chained = filesystem.ReplaceRules([['one', 'two'], ['two', '2']])
+
+        self.assertEqual(1, len(merged._steps))
+        self.assertEqual(b'1 2', merged.apply(b'first second'))
+        self.assertEqual(2, len(overlapping._steps))
+        self.assertEqual(b'aY', overlapping.apply(b'abc'))
+        self.assertEqual(2, len(chained._steps))
+        self.assertEqual(b'2', chained.apply(b'one'))
+
+    def test_writeContentToFile_atomic(self):
+        """
+        In atomic mode, the file is replaced by a new file with the content.
+        """
+        segments = self.tempFileWithContent(b'old content')
+        folder = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(segments[:-1]))
+        before = os.listdir(folder)
+
+        self.sut.writeContentToFile(
+            [u'/'] + segments, content='new', atomic=True)
+
+        self.assertEqual(
+            b'new', mk.fs.getFileContent(segments, utf8=False))
+        self.assertEqual(sorted(before), sorted(os.listdir(folder)))
+
+    def test_iterLines(self):
+        """
+        It returns the lines as bytes, with the newlines.
+        """
+        segments = self.tempFileWithContent(b'first\r\nsecond\nlast')
+
+        result = list(self.sut.iterLines([u'/'] + segments, buffer_size=4))
+
+        self.assertEqual([b'first\r\n', b'second\n', b'last'], result)
+
+    def test_iterLines_carriage_return(self):
+        """
+        As with universal newlines, a lone carriage return ends a line.
+        """
+        segments = self.tempFileWithContent(
+            b'first\rsecond\r\r\nthird\nfourth\rlast')
+
+        result = list(self.sut.iterLines([u'/'] + segments, buffer_size=4))
+
+        self.assertEqual([
+            b'first\r',
+            b'second\r',
+            b'\r\n',
+            b'third\n',
+            b'fourth\r',
+            b'last',
+            ],
+            result,
+            )
+
+    def test_iterChunks(self):
+        """
+        It returns the content in chunks of the requested size.
+        """
+        segments = self.tempFileWithContent(b'0123456789')
+
+        result = list(self.sut.iterChunks([u'/'] + segments, chunk_size=4))
+
+        self.assertEqual([b'0123', b'4567', b'89'], result)
+
+    def test_getFileView(self):
+        """
+        It provides a read-only view of the whole file, and empty bytes
+        for empty files.
+        """
+        segments = self.tempFileWithContent(b'content')
+        empty_segments = self.tempFileWithContent(b'')
+
+        with self.sut.getFileView([u'/'] + segments) as view:
+            self.assertEqual(b'content', view[:])
+            with self.assertRaises(TypeError):
+                view[0:1] = b'X'
+
+        with self.sut.getFileView([u'/'] + empty_segments) as view:
+            self.assertEqual(b'', view)
+
+    def test_getFileContentAsString_read_only(self):
+        """
+        It can read files without write permissions.
+        """
+        segments = self.tempFileWithContent(b'content')
+        path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(segments))
+        os.chmod(path, stat.S_IREAD)
+
+        result = self.sut.getFileContentAsString([u'/'] + segments)
+
+        self.assertEqual('content', result)
+
+    def setCommandFiles(self, path, files):
+        """
+        Make the `files` from `path` the only command files.
+        """
+        def isCommandFile(candidate):
+            return candidate in [os.path.join(path, name) for name in files]
+
+        self.sut._isCommandFile = isCommandFile
+
+    def tempFileWithContent(self, content):
+        """
+        Create a temporary file with `content` and return its segments.
+        """
+        segments = mk.fs.createFileInTemp(content=content)
+        self.addCleanup(lambda: mk.fs.deleteFile(segments))
+        return segments
+
+    def test_copyFolder_link(self):
+        """
+        In link mode, files are created as hard links to the source.
+        """
+        if os.name != 'posix':
+            raise self.skipTest("Unix specific test.")
+        source_segments = mk.fs.createFolderInTemp(prefix=u'src-')
+        destination_segments = mk.fs.createFolderInTemp(prefix=u'dst-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(source_segments))
+        self.addCleanup(lambda: mk.fs.deleteFolder(destination_segments))
+        mk.fs.createFolder(source_segments + [u'child'])
+        mk.fs.createFile(source_segments + [u'child', u'file'], content=b'a')
+        mk.fs.createFile(source_segments + [u'other.txt'], content=b'b')
+        mk.fs.createFile(destination_segments + [u'other.txt'], content=b'c')
+        source_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(source_segments))
+        destination_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(destination_segments))
+
+        self.sut.copyFolder(
+            source=[u'/'] + source_segments,
+            destination=[u'/'] + destination_segments,
+            link=True,
+            )
+
+        for name in [[b'child', b'file'], [b'other.txt']]:
+            self.assertTrue(os.path.samefile(
+                os.path.join(source_path, *name),
+                os.path.join(destination_path, *name),
+                ))
+
+    def test_copyFolderContent_link(self):
+        """
+        In link mode, the matched files are created as hard links to the
+        source, replacing existing files.
+        """
+        if os.name != 'posix':
+            raise self.skipTest("Unix specific test.")
+        source_segments = mk.fs.createFolderInTemp(prefix=u'src-')
+        destination_segments = mk.fs.createFolderInTemp(prefix=u'dst-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(source_segments))
+        self.addCleanup(lambda: mk.fs.deleteFolder(destination_segments))
+        mk.fs.createFile(source_segments + [u'kit-1.0.tar.gz'], content=b'a')
+        mk.fs.createFile(source_segments + [u'other'], content=b'b')
+        mk.fs.createFile(
+            destination_segments + [u'kit-1.0.tar.gz'], content=b'old')
+        source_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(source_segments))
+        destination_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(destination_segments))
+
+        self.sut.copyFolderContent(
+            source=[u'/'] + source_segments,
+            destination=[u'/'] + destination_segments,
+            mask='.*1.0.*',
+            link=True,
+            )
+
+        self.assertEqual([b'kit-1.0.tar.gz'], os.listdir(destination_path))
+        self.assertTrue(os.path.samefile(
+            os.path.join(source_path, b'kit-1.0.tar.gz'),
+            os.path.join(destination_path, b'kit-1.0.tar.gz'),
+            ))
+
+    def test_deleteFolder(self):
+        """
+        It deletes the whole tree, including read-only files.
+        """
+        segments = mk.fs.createFolderInTemp(prefix=u'del-')
+        self.addCleanup(self.sut.deleteFolder, [u'/'] + segments)
+        mk.fs.createFolder(segments + [u'child'])
+        mk.fs.createFile(segments + [u'child', u'file'])
+        mk.fs.createFile(segments + [u'other'])
+        path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(segments))
+        os.chmod(os.path.join(path, b'other'), stat.S_IREAD)
+
+        self.sut.deleteFolder([u'/'] + segments)
+
+        self.assertFalse(os.path.exists(path))
+
+    def test_deleteFolder_missing(self):
+        """
+        It ignores missing folders.
+        """
+        self.sut.deleteFolder([u'/'] + mk.fs.temp_segments + [mk.string()])
+        self.sut.deleteFolder(
+            [u'/'] + mk.fs.temp_segments + [mk.string()], background=True)
+
+    def test_deleteFolder_background(self):
+        """
+        In background mode, the folder is removed right away and its content
+        is deleted in a separate thread.
+        """
+        parent_segments = mk.fs.createFolderInTemp(prefix=u'parent-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(parent_segments))
+        segments = parent_segments + [u'child']
+        mk.fs.createFolder(segments)
+        mk.fs.createFile(segments + [u'file'])
+        parent_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(parent_segments))
+
+        self.sut.deleteFolder([u'/'] + segments, background=True)
+
+        self.assertFalse(mk.fs.exists(segments))
+        wait_background_deletes()
+        self.assertEqual([], os.listdir(parent_path))
+
+    def test_deleteFolder_background_stale_trash(self):
+        """
+        Trash folders left by an interrupted build are deleted by the next
+        deletion in background from the same folder.
+        """
+        parent_segments = mk.fs.createFolderInTemp(prefix=u'parent-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(parent_segments))
+        stale_segments = parent_segments + [u'.brink-trash-stale']
+        mk.fs.createFolder(stale_segments)
+        mk.fs.createFolder(stale_segments + [u'child'])
+        mk.fs.createFile(stale_segments + [u'child', u'file'])
+        segments = parent_segments + [u'child']
+        mk.fs.createFolder(segments)
+        parent_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(parent_segments))
+
+        self.sut.deleteFolder([u'/'] + segments, background=True)
+
+        wait_background_deletes()
+        self.assertEqual([], os.listdir(parent_path))
+
+    def test_deleteFolder_background_relative(self):
+        """
+        A relative folder is moved to a trash folder inside the current
+        folder and stale trash folders are found there.
+        """
+        parent_segments = mk.fs.createFolderInTemp(prefix=u'parent-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(parent_segments))
+        mk.fs.createFolder(parent_segments + [u'.brink-trash-stale'])
+        mk.fs.createFolder(parent_segments + [u'child'])
+        mk.fs.createFile(parent_segments + [u'child', u'file'])
+        parent_path = BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(parent_segments))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(parent_path)
+
+        self.sut.deleteFolder([u'child'], background=True)
+
+        self.assertFalse(mk.fs.exists(parent_segments + [u'child']))
+        wait_background_deletes()
+        self.assertEqual([], os.listdir(parent_path))
+
+
+class TestFilesystemIndex(BrinkTestCase):
+    """
+    Unit tests for `FilesystemIndex`.
+    """
+
+    def setUp(self):
+        super(TestFilesystemIndex, self).setUp()
+        self.fs = BrinkFilesystem()
+        self.segments = mk.fs.createFolderInTemp(prefix=u'index-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(self.segments))
+        mk.fs.createFolder(self.segments + [u'child'])
+        mk.fs.createFile(self.segments + [u'child', u'file'], content=b'12')
+        self.root = [u'/'] + self.segments
+        self.sut = self.fs.createIndex(self.root)
+
+    def test_queries(self):
+        """
+        It answers the queries from the scanned folders.
+        """
+        self.sut.refresh()
+        folder = self.fs.join(self.root + [u'child'])
+        path = self.fs.join(self.root + [u'child', u'file'])
+        missing = self.fs.join(self.root + [u'missing', u'file'])
+
+        self.assertTrue(self.sut.exists(path))
+        self.assertTrue(self.sut.isFile(path))
+        self.assertFalse(self.sut.isFolder(path))
+        self.assertTrue(self.sut.isFolder(folder))
+        self.assertFalse(self.sut.exists(missing))
+        self.assertEqual(2, self.sut.getSize(path))
+        self.assertEqual([b'file'], self.sut.listFolder(folder))
+
+    def test_snapshot(self):
+        """
+        Changes done outside of `BrinkFilesystem` are only seen after the
+        path is invalidated.
+        """
+        path = self.fs.join(self.root + [u'child', u'file'])
+        self.assertTrue(self.sut.exists(path))
+
+        os.remove(path)
+
+        self.assertTrue(self.sut.exists(path))
+        self.sut.invalidate(path)
+        self.assertFalse(self.sut.exists(path))
+
+    def test_invalidate_on_write(self):
+        """
+        Changes done with `BrinkFilesystem` invalidate the index.
+        """
+        new_path = self.fs.join(self.root + [u'child', u'new'])
+        self.assertFalse(self.sut.exists(new_path))
+
+        self.fs.writeContentToFile(
+            self.root + [u'child', u'new'], content='new')
+
+        self.assertTrue(self.sut.isFile(new_path))
+
+        self.fs.deleteFolder(self.root + [u'child'])
+
+        self.assertFalse(self.sut.exists(new_path))
+
+    def test_invalidate_nested_create(self):
+        """
+        Creating a file in new nested folders invalidates the listings of
+        all its ancestors.
+        """
+        segments = self.root + [u'new', u'nested', u'file']
+        path = self.fs.join(segments)
+        folder = self.fs.join(self.root + [u'new'])
+        self.assertFalse(self.sut.exists(folder))
+        self.assertFalse(self.sut.exists(path))
+
+        self.fs.createFolder(self.root + [u'new', u'nested'], recursive=True)
+        self.fs.writeContentToFile(segments, content='new')
+
+        self.assertTrue(self.sut.isFile(path))
+        self.assertTrue(self.sut.isFolder(folder))
+
+    def test_invalidate_copyFolder(self):
+        """
+        The copied files are seen after copying a folder.
+        """
+        path = self.fs.join(self.root + [u'copy', u'file'])
+        self.assertFalse(self.sut.exists(path))
+
+        self.fs.copyFolder(self.root + [u'child'], self.root + [u'copy'])
+
+        self.assertTrue(self.sut.isFile(path))
+
+    def test_indexed(self):
+        """
+        Inside the `indexed` context, the queries of `BrinkFilesystem` for
+        paths in the root folder are answered from the index.
+        """
+        segments = self.root + [u'child', u'file']
+        path = self.fs.join(segments)
+
+        with self.fs.indexed(self.root):
+            self.assertTrue(self.fs.isFile(segments))
+            os.remove(path)
+            self.assertTrue(self.fs.exists(segments))
+            self.assertEqual(
+                [b'file'],
+                self.fs.listFolder(self.fs.join(self.root + [u'child'])))
+
+        self.assertFalse(self.fs.exists(segments))
+
+    def test_indexed_write(self):
+        """
+        Inside the `indexed` context, changes done with `BrinkFilesystem`
+        are seen by its queries.
+        """
+        segments = self.root + [u'copy', u'file']
+
+        with self.fs.indexed(self.root):
+            self.assertFalse(self.fs.exists(segments))
+            self.fs.createFolder(self.root + [u'copy'])
+            self.fs.copyFolderContent(
+                self.root + [u'child'], self.root + [u'copy'])
+
+            self.assertTrue(self.fs.isFile(segments))
+            self.assertTrue(self.fs.isFolder(self.root + [u'copy']))
@@ -0,0 +1,84 @@
+# Copyright (c) 2020 Adi Roiban.
+# See LICENSE for details.
+"""
+Unit tests for brink paths.
+"""
+from __future__ import (
+    absolute_import,
+    print_function,
+    with_statement,
+    unicode_literals,
+    )
+import os
+
+from brink.filesystem import BrinkFilesystem
+from brink.paths import FilePath
+from brink.testing import BrinkTestCase, mk
+
+
+class TestFilePath(BrinkTestCase):
+    """
+    Unit tests for `FilePath`.
+    """
+
+    def test_forms(self):
+        """
+        It is the low level path and has the Unicode form as `text`.
+        """
+        text = '/' + mk.string()
+
+        result = FilePath(text)
+
+        self.assertEqual(text, result.text)
+        if os.name == 'posix':
+            self.assertIsInstance(result, bytes)
+            self.assertEqual(text.encode('utf-8'), result)
+        else:
+            self.assertEqual(text, result)
+
+    def test_interned(self):
+        """
+        The same instance is returned for the same path and existing
+        instances are returned as is.
+        """
+        text = mk.string()
+        path = FilePath(text)
+
+        self.assertIs(path, FilePath(text))
+        self.assertIs(path, FilePath(path))
+        self.assertIs(path, FilePath(text.encode('utf-8')))
+
+    def test_not_utf8(self):
+        """
+        Bytes paths which are not UTF-8 are kept as they are on Unix.
+        """
+        path = b'/brink-\xff-' + mk.string().encode('utf-8')
+
+        result = FilePath(path)
+
+        self.assertIsInstance(result.text, type(''))
+        if os.name == 'posix':
+            self.assertEqual(path, result)
+            self.assertIs(result, FilePath(path))
+
+    def test_immutable(self):
+        """
+        Attributes can not be changed.
+        """
+        path = FilePath(mk.string())
+
+        with self.assertRaises(AttributeError):
+            path.text = 'other'
+
+    def test_join(self):
+        """
+        `BrinkFilesystem` uses it as low level path.
+        """
+        fs = BrinkFilesystem()
+        path = FilePath('/' + mk.string())
+        name = mk.string()
+
+        self.assertIs(path, fs.join([path]))
+        self.assertIs(path, fs.getEncodedPath(path))
+        self.assertEqual(
+            fs.join([path.text, name]), fs.join([path, name]))
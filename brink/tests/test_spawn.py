@@ -0,0 +1,191 @@
+# Copyright (c) 2020 Adi Roiban.
+# See LICENSE for details.
+"""
+Tests for the spawn server.
+"""
+from __future__ import (
+    absolute_import,
+    print_function,
+    with_statement,
+    unicode_literals,
+    )
+import errno
+import os
+import sys
+import tempfile
+
+from brink.execute import execute, iter_execute, TIMEOUT_EXIT_CODE
+from brink.spawn import (
+    _is_forking,
+    get_spawn_server,
+    SpawnedProcess,
+    start_spawn_server,
+    stop_spawn_server,
+    )
+from brink.testing import BrinkTestCase
+
+
+def python_command(code):
+    """
+    Return the command for running Python `code` in a child process.
+    """
+    return [sys.executable, '-c', code]
+
+
+class TestSpawnServer(BrinkTestCase):
+    """
+    Tests for starting commands using the spawn server.
+    """
+
+    def setUp(self):
+        super(TestSpawnServer, self).setUp()
+        if not _is_forking():
+            raise self.skipTest('Spawn server is not used on this system.')
+
+        start_spawn_server()
+        self.addCleanup(stop_spawn_server)
+        self.sut = get_spawn_server()
+
+    def test_start_twice(self):
+        """
+        Starting an already started server does nothing.
+        """
+        start_spawn_server()
+
+        self.assertIs(self.sut, get_spawn_server())
+
+    def test_spawn(self):
+        """
+        The command receives the input and the environment, and its output
+        and exit code are returned.
+        """
+        environment = os.environ.copy()
+        environment['BRINK_TEST'] = 'value'
+        process = self.sut.spawn(
+            python_command(
+                'import os, sys\n'
+                'sys.stdout.write(os.environ["BRINK_TEST"])\n'
+                'sys.stdout.write(sys.stdin.read())\n'
+                'sys.exit(3)\n'
+                ),
+            environment,
+            )
+
+        result = process.communicate(b'-input')
+
+        self.assertIsInstance(process, SpawnedProcess)
+        self.assertEqual((b'value-input', None), result)
+        self.assertEqual(3, process.returncode)
+        self.assertGreater(process.usage.ru_maxrss, 0)
+
+    def test_spawn_cwd(self):
+        """
+        The command is started in the current folder of the build process.
+        """
+        process = self.sut.spawn(
+            python_command('import os, sys; sys.stdout.write(os.getcwd())'),
+            os.environ.copy(),
+            )
+
+        result = process.communicate()
+
+        self.assertEqual(os.getcwd().encode('utf-8'), result[0])
+
+    def test_spawn_group(self):
+        """
+        The command is started in a new process group only when requested.
+        """
+        command = python_command(
+            'import os, sys; sys.stdout.write(str(os.getpgrp()))')
+
+        grouped = self.sut.spawn(command, os.environ.copy())
+        kept = self.sut.spawn(command, os.environ.copy(), group=False)
+
+        self.assertEqual(grouped.pid, int(grouped.communicate()[0]))
+        self.assertEqual(os.getpgrp(), int(kept.communicate()[0]))
+
+    def test_spawn_missing_command(self):
+        """
+        An error is raised when the command can not be executed.
+        """
+        with self.assertRaises(OSError) as context:
+            self.sut.spawn(['no-such-brink-command'], os.environ.copy())
+
+        self.assertEqual(errno.ENOENT, context.exception.errno)
+
+    def test_execute(self):
+        """
+        When the server is started, execute() uses it for commands with
+        captured output.
+        """
+        result = execute(python_command('import sys; sys.stdout.write("ok")'))
+
+        self.assertEqual((0, b'ok'), result)
+
+    def test_execute_missing_command(self):
+        """
+        execute() exits when the command is not found.
+        """
+        with self.assertRaises(SystemExit):
+            execute(['no-such-brink-command'])
+
+    def test_iter_execute_stop_early(self):
+        """
+        The command is killed when the iteration is stopped early.
+        """
+        command = python_command(
+            'import sys, time\n'
+            'sys.stdout.write("first\\n")\n'
+            'sys.stdout.flush()\n'
+            'time.sleep(60)\n'
+            )
+        lines = iter_execute(command)
+
+        self.assertEqual(b'first\n', next(lines))
+        lines.close()
+
+    def test_execute_timeout(self):
+        """
+        The commands started by the server are stopped on timeout.
+        """
+        command = ['/bin/sh', '-c', 'sleep 60 & sleep 60']
+
+        result = execute(command, timeout=0.5, ignore_errors=True)
+
+        self.assertEqual((TIMEOUT_EXIT_CODE, b''), result)
+
+    def test_wait_server_stopped(self):
+        """
+        Waiting for a process raises an error when the server was stopped,
+        instead of blocking.
+        """
+        process = self.sut.spawn(
+            python_command('import time; time.sleep(60)'), os.environ.copy())
+        self.addCleanup(process.stdout.close)
+        self.addCleanup(process.stdin.close)
+        self.addCleanup(process.kill)
+
+        stop_spawn_server()
+
+        with self.assertRaises(OSError) as context:
+            process.wait()
+
+        self.assertEqual(errno.ECHILD, context.exception.errno)
+
+    def test_spawn_not_waited(self):
+        """
+        No named pipes are left for the processes which are never waited.
+        """
+        process = self.sut.spawn(
+            python_command('import sys; sys.stdout.write("ok")'),
+            os.environ.copy(),
+            )
+        process.stdin.close()
+        self.assertEqual(b'ok', process.stdout.read())
+        process.stdout.close()
+
+        leftovers = [
+            name for name in os.listdir(tempfile.gettempdir())
+            if name.startswith(str('brink-spawn-'))
+            ]
+        self.assertEqual([], leftovers)
@@ -14,7 +14,13 @@ import os
 import sys
 from brink.testing import BrinkTestCase, conditionals, mk
 
-from brink.utils import BrinkPaver
+from brink.filesystem import BrinkFilesystem
+from brink.utils import (
+    ArchiveCache,
+    BrinkPaver,
+    ChecksumFile,
+    DigestCache,
+    )
 
 
 MINIMAL_SETUP = {
@@ -61,6 +67,20 @@ class TestBrinkPaver(BrinkTestCase):
             ),
             result)
 
+    def test_convertToDOSNewlines_carriage_return(self):
+        """
+        Old Mac newlines are also converted.
+        """
+        sut = BrinkPaver(setup=MINIMAL_SETUP)
+        self.test_segments = mk.fs.createFileInTemp(
+            content=u'mac\rdos\r\nunix\n')
+        path = mk.fs.getRealPathFromSegments(self.test_segments)
+
+        sut._convertToDOSNewlines(path)
+
+        result = mk.fs.getFileContent(self.test_segments)
+        self.assertEqual(u'mac\r\ndos\r\nunix\r\n', result)
+
     def test_createMD5Sum(self):
         """
         Return the MD5 of file at path, which is specified as segments
@@ -78,6 +98,206 @@ class TestBrinkPaver(BrinkTestCase):
         expected = hashlib.md5(content).hexdigest()
         self.assertEqual(expected, result)
 
+    def test_createDigests(self):
+        """
+        Return the digests for all requested algorithms, reading the file
+        in multiple buffers.
+        """
+        sut = BrinkPaver(setup=MINIMAL_SETUP)
+        content = b'0123456789' * 300000
+        self.test_segments = mk.fs.createFileInTemp(content=content)
+        name = self.test_segments[-1]
+
+        result = sut.createDigests(
+            [mk.fs.temp_path, name], algorithms=['md5', 'sha1', 'sha256'])
+
+        self.assertEqual({
+            'md5': hashlib.md5(content).hexdigest(),
+            'sha1': hashlib.sha1(content).hexdigest(),
+            'sha256': hashlib.sha256(content).hexdigest(),
+            },
+            result)
+
+    def test_createDigestsForFiles(self):
+        """
+        Return the digests for all files, in the same order, and store them
+        in the digest cache.
+        """
+        sut = BrinkPaver(setup=MINIMAL_SETUP)
+        cache_path = [mk.fs.temp_path, mk.makeFilename()]
+        sut.digest_cache = DigestCache(sut.fs, cache_path)
+        sources = []
+        contents = []
+        for index in range(5):
+            content = str(index).encode('ascii') * 1000
+            segments = mk.fs.createFileInTemp(content=content)
+            self.addCleanup(mk.fs.deleteFile, segments)
+            sources.append([mk.fs.temp_path, segments[-1]])
+            contents.append(content)
+
+        result = sut.createDigestsForFiles(sources, algorithms=['sha256'])
+
+        self.addCleanup(sut.fs.deleteFile, cache_path)
+        self.assertEqual(
+            [{'sha256': hashlib.sha256(content).hexdigest()}
+                for content in contents],
+            result)
+        self.assertTrue(sut.fs.exists(cache_path))
+
+        # A new cache loaded from disk returns the same digests.
+        sut.digest_cache = DigestCache(sut.fs, cache_path)
+        key = sut.digest_cache.getKey(sut.fs.join(sources[1]))
+        self.assertEqual(
+            result[1], sut.digest_cache.get(key, ['sha256']))
+        self.assertIsNone(sut.digest_cache.get(key, ['md5']))
+
+    def test_createDigests_cached(self):
+        """
+        The cached digest is used while the file is not changed, and a
+        new digest is computed once it changes.
+        """
+        sut = BrinkPaver(setup=MINIMAL_SETUP)
+        cache_path = [mk.fs.temp_path, mk.makeFilename()]
+        sut.digest_cache = DigestCache(sut.fs, cache_path)
+        segments = mk.fs.createFileInTemp(content=b'old')
+        self.addCleanup(mk.fs.deleteFile, segments)
+        source = [mk.fs.temp_path, segments[-1]]
+        key = sut.digest_cache.getKey(sut.fs.join(source))
+        sut.digest_cache.set(key, {'sha256': 'cached'})
+
+        result = sut.createDigests(source, algorithms=['sha256'])
+
+        self.assertEqual({'sha256': 'cached'}, result)
+
+        # Same size and modification time, but different content.
+        path = sut.fs.join(source)
+        status = os.stat(path)
+        with open(path, 'wb') as new_file:
+            new_file.write(b'new')
+        os.utime(path, (status.st_atime, status.st_mtime))
+
+        result = sut.createDigests(source, algorithms=['sha256'])
+
+        self.assertEqual(
+            {'sha256': hashlib.sha256(b'new').hexdigest()}, result)
+
+    def test_DigestCache_prune(self):
+        """
+        Only the entries used by this process are saved.
+        """
+        fs = BrinkFilesystem()
+        cache_path = [mk.fs.temp_path, mk.makeFilename()]
+        self.addCleanup(fs.deleteFile, cache_path)
+        sut = DigestCache(fs, cache_path)
+        sut.set('used', {'sha256': 'used-digest'})
+        sut.set('stale', {'sha256': 'stale-digest'})
+        sut.save()
+
+        sut = DigestCache(fs, cache_path)
+        self.assertIsNotNone(sut.get('used', ['sha256']))
+        sut.save()
+
+        sut = DigestCache(fs, cache_path)
+        self.assertEqual(
+            {'sha256': 'used-digest'}, sut.get('used', ['sha256']))
+        self.assertIsNone(sut.get('stale', ['sha256']))
+
+    def test_DigestCache_prune_keeps_memory(self):
+        """
+        Entries not used before saving are still available to this
+        process and are saved once used.
+        """
+        fs = BrinkFilesystem()
+        cache_path = [mk.fs.temp_path, mk.makeFilename()]
+        self.addCleanup(fs.deleteFile, cache_path)
+        sut = DigestCache(fs, cache_path)
+        sut.set('first', {'sha256': 'first-digest'})
+        sut.set('second', {'sha256': 'second-digest'})
+        sut.save()
+        sut = DigestCache(fs, cache_path)
+        sut.get('first', ['sha256'])
+        sut.save()
+
+        result = sut.get('second', ['sha256'])
+        sut.save()
+
+        self.assertEqual({'sha256': 'second-digest'}, result)
+        sut = DigestCache(fs, cache_path)
+        self.assertIsNotNone(sut.get('first', ['sha256']))
+        self.assertIsNotNone(sut.get('second', ['sha256']))
+
+    @conditionals.onOSFamily('posix')
+    def test_createZipArchive_cached(self):
+        """
+        The archive is restored from the cache when the files and the
+        options are not changed.
+        """
+        sut = BrinkPaver(setup=MINIMAL_SETUP)
+        segments = mk.fs.createFolderInTemp(prefix=u'cache-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(segments))
+        folder = [u'/'] + segments
+        sut.archive_cache = ArchiveCache(sut.fs, folder + [u'cache'])
+        sut.fs.createFolder(folder + [u'product'])
+        sut.fs.writeContentToFile(folder + [u'product', u'a.txt'], u'a')
+        archive = folder + [u'product.zip']
+
+        archive_path = sut.fs.join(archive)
+        cache_path = sut.fs.join(folder + [u'cache'])
+
+        sut.createZipArchive(folder + [u'product'], archive)
+        # Mark the cached archive, to know when it is restored.
+        cached_path = os.path.join(cache_path, os.listdir(cache_path)[0])
+        with open(cached_path, 'ab') as cached:
+            cached.write(b'cached')
+        sut.createZipArchive(folder + [u'product'], archive)
+        restored = self.getContent(archive_path)
+        # Changing the restored archive does not change the cache.
+        with open(archive_path, 'ab') as changed:
+            changed.write(b'changed')
+        sut.createZipArchive(folder + [u'product'], archive, exclude=['b'])
+        other_options = self.getContent(archive_path)
+        sut.fs.writeContentToFile(folder + [u'product', u'a.txt'], u'b')
+        sut.createZipArchive(folder + [u'product'], archive)
+        other_content = self.getContent(archive_path)
+
+        self.assertTrue(restored.endswith(b'cached'))
+        self.assertTrue(self.getContent(cached_path).endswith(b'cached'))
+        self.assertFalse(other_options.endswith(b'cached'))
+        self.assertFalse(other_content.endswith(b'cached'))
+        self.assertEqual(3, len(os.listdir(cache_path)))
+
+    def getContent(self, path):
+        """
+        Return the content of the file at `path`.
+        """
+        with open(path, 'rb') as stream:
+            return stream.read()
+
+    def test_ArchiveCache_evict(self):
+        """
+        The least recently used archives are removed when the cache is
+        larger than the maximum size.
+        """
+        fs = BrinkFilesystem()
+        segments = mk.fs.createFolderInTemp(prefix=u'cache-')
+        self.addCleanup(lambda: mk.fs.deleteFolder(segments))
+        folder = [u'/'] + segments
+        sut = ArchiveCache(fs, folder + [u'cache'], max_size=25)
+        for index, name in enumerate([u'first', u'second', u'third']):
+            fs.writeContentToFile(folder + [name], u'x' * 10)
+            sut.add(name, folder + [name])
+            os.utime(fs.join(folder + [u'cache', name]), (index, index))
+        # Restoring marks the archive as used.
+        sut.restore(u'second', folder + [u'restored'])
+
+        fs.writeContentToFile(folder + [u'fourth'], u'x' * 10)
+        sut.add(u'fourth', folder + [u'fourth'])
+
+        self.assertEqual(
+            [b'fourth', b'second'],
+            sorted(os.listdir(fs.join(folder + [u'cache']))))
+        self.assertFalse(sut.restore(u'first', folder + [u'restored']))
+
     @conditionals.onOSFamily('posix')
     def test_rsync_unix(self):
         """
@@ -105,6 +325,7 @@ class TestBrinkPaver(BrinkTestCase):
                 'some-user@some-host:path/on/server',
                 ],
             'output': sys.stdout,
+            'timeout': None,
             }], command)
 
     @conditionals.onOSFamily('nt')
@@ -137,6 +358,7 @@ class TestBrinkPaver(BrinkTestCase):
                 'some-user@some-host:path/on/server',
                 ],
             'output': sys.stdout,
+            'timeout': None,
             }], command)
 
     def test_getPythonLibPath_default(self):
@@ -175,3 +397,102 @@ class TestBrinkPaver(BrinkTestCase):
 
         self.assertEqual(build_dir, os.environ['PYTHONPATH'])
         self.assertEqual(b'python2.7', os.environ['CHEVAH_PYTHON'])
+
+
+class TestChecksumFile(BrinkTestCase):
+    """
+    Tests for ChecksumFile.
+    """
+
+    def setUp(self):
+        super(TestChecksumFile, self).setUp()
+        self.paver = BrinkPaver(setup=MINIMAL_SETUP)
+        self.folder = mk.fs.createFolderInTemp(prefix=u'checksum-')
+        self.addCleanup(mk.fs.deleteFolder, self.folder)
+        # Paths are relative to the test folder.
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(BrinkFilesystem.getEncodedPath(
+            mk.fs.getRealPathFromSegments(self.folder)))
+        for name in [u'b-file', u'a-file', u'c-file']:
+            self.paver.fs.writeContentToFile([name], name)
+
+    def getLines(self):
+        """
+        Return the lines of the checksum file.
+        """
+        return self.paver.fs.getFileContentAsList([u'checksums'])
+
+    def getLine(self, name):
+        """
+        Return the checksum line for file `name`.
+        """
+        digest = hashlib.sha256(name.encode('ascii')).hexdigest()
+        return digest + '  ' + name
+
+    def test_batch(self):
+        """
+        In a batch, the lines are only written at exit, sorted by path,
+        replacing the content from a previous run.
+        """
+        self.paver.fs.writeContentToFile([u'checksums'], 'previous\n')
+
+        with ChecksumFile([u'checksums'], self.paver) as sut:
+            sut.addFiles([u'b-file', u'c-file', u'a-file'])
+
+            self.assertEqual(['previous'], self.getLines())
+
+        self.assertEqual([
+            self.getLine(u'a-file'),
+            self.getLine(u'b-file'),
+            self.getLine(u'c-file'),
+            ],
+            self.getLines(),
+            )
+        # The temporary file of the atomic write is not left behind.
+        self.assertEqual(
+            sorted([b'a-file', b'b-file', b'c-file', b'checksums']),
+            sorted(os.listdir(b'.')),
+            )
+
+    def test_batch_error_previous(self):
+        """
+        When the first batch fails, the content from a previous run is
+        kept.
+        """
+        self.paver.fs.writeContentToFile([u'checksums'], 'previous\n')
+        sut = ChecksumFile([u'checksums'], self.paver)
+
+        with self.assertRaises(RuntimeError):
+            with sut:
+                sut.addFiles([u'a-file', u'c-file'])
+                raise RuntimeError('Batch failed.')
+
+        self.assertEqual(['previous'], self.getLines())
+
+    def test_batch_error(self):
+        """
+        When the batch fails, the file is not changed.
+        """
+        self.paver.fs.writeContentToFile([u'checksums'], 'previous\n')
+        sut = ChecksumFile([u'checksums'], self.paver)
+        sut.addFile(u'b-file')
+
+        with self.assertRaises(RuntimeError):
+            with sut:
+                sut.addFiles([u'a-file', u'c-file'])
+                raise RuntimeError('Batch failed.')
+
+        self.assertEqual([self.getLine(u'b-file')], self.getLines())
+
+    def test_verify(self):
+        """
+        It returns the files which are missing or were modified.
+        """
+        with ChecksumFile([u'checksums'], self.paver) as sut:
+            sut.addFiles([u'a-file', u'b-file', u'c-file'])
+        self.paver.fs.deleteFile([u'a-file'])
+        self.paver.fs.writeContentToFile([u'c-file'], 'changed')
+
+        result = sut.verify()
+
+        self.assertEqual([u'a-file', u'c-file'], sorted(result))
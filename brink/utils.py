@@ -10,20 +10,330 @@ from __future__ import (
     unicode_literals,
     )
 
-from contextlib import closing
-from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
-from hashlib import md5, sha256
+import hashlib
+import io
+import json
 import os
 import socket
-import subprocess
+import stat
 import sys
+import threading
 
-from brink.execute import execute
+from brink.archive import (
+    CompressionPolicy,
+    create_tar_gz_archive,
+    create_zip_archive,
+    )
+from brink.execute import _run_parallel, call, execute, execute_many
 from brink.git_command import BrinkGit
-from brink.filesystem import BrinkFilesystem
+from brink.filesystem import _to_text, BrinkFilesystem
 from brink.paths import ProjectPaths
 from brink.sphinx import BrinkSphinx
 
+# Size of the buffer used when reading files for computing digests.
+DIGEST_BUFFER_SIZE = 1024 * 1024
+
+# Maximum size of the archives kept in an ArchiveCache.
+ARCHIVE_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# Changed when the archives are created differently for the same
+# files, to ignore the cached archives.
+_ARCHIVE_CACHE_VERSION = 1
+
+class DigestCache(object):
+    """
+    Digests of files, stored as JSON and keyed on the file identity:
+    device, inode, size, modification and status change times.
+
+    Changes are only written by `save()`, which also drops the entries
+    not used since the cache was loaded.
+    """
+
+    def __init__(self, filesystem, segments):
+        self._fs = filesystem
+        self._segments = segments
+        self._digests = None
+        # Keys used by this process.
+        self._used = set()
+        # Keys stored in the file.
+        self._stored = set()
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def getKey(self, path):
+        """
+        Return the cache key for the file at `path`.
+
+        The status change time is updated by any write, even when the
+        modification time is restored.
+        """
+        status = os.stat(path)
+        if hasattr(status, 'st_mtime_ns'):
+            mtime_ns = status.st_mtime_ns
+            ctime_ns = status.st_ctime_ns
+        else:
+            mtime_ns = int(status.st_mtime * 1000000000)
+            ctime_ns = int(status.st_ctime * 1000000000)
+        return '%d:%d:%d:%d:%d' % (
+            status.st_dev, status.st_ino, status.st_size, mtime_ns, ctime_ns)
+
+    def get(self, key, algorithms):
+        """
+        Return the cached digests for all `algorithms` or None if any of
+        them is not cached.
+        """
+        with self._lock:
+            entry = self._load().get(key, {})
+            if entry:
+                self._used.add(key)
+            if not all(algorithm in entry for algorithm in algorithms):
+                return None
+            return dict(
+                (algorithm, entry[algorithm]) for algorithm in algorithms)
+
+    def set(self, key, digests):
+        """
+        Add the `digests` for file with `key`.
+        """
+        with self._lock:
+            self._load().setdefault(key, {}).update(digests)
+            self._used.add(key)
+            self._changed = True
+
+    def save(self):
+        """
+        Write the cache, if it was changed.
+
+        Entries for files which were not hashed by this process are
+        not written, so that the cache does not grow with the deleted or
+        changed files.
+        They are kept in memory, as they can still be used by this
+        process.
+        """
+        with self._lock:
+            digests = dict(
+                (key, value) for key, value in self._load().items()
+                if key in self._used
+                )
+            if not self._changed and set(digests) == self._stored:
+                return
+            content = json.dumps(digests, sort_keys=True)
+            self._stored = set(digests)
+            self._changed = False
+
+        self._fs.createFolder(self._segments[:-1], recursive=True)
+        self._fs.writeContentToFile(
+            destination=self._segments, content=content, atomic=True)
+
+    def _load(self):
+        """
+        Return the digests, loading them from the file on first use.
+
+        A missing or damaged file is handled as an empty cache.
+        """
+        if self._digests is not None:
+            return self._digests
+
+        self._digests = {}
+        if not self._fs.isFile(self._segments):
+            return self._digests
+
+        try:
+            digests = json.loads(
+                self._fs.getFileContentAsString(self._segments))
+        except ValueError:
+            return self._digests
+        if isinstance(digests, dict):
+            self._digests = digests
+            self._stored = set(digests)
+        return self._digests
+
+
+class ArchiveCache(object):
+    """
+    Archives stored in a folder, keyed on the hash of their manifest.
+
+    Archives are copied in and out of the cache, using reflinks when
+    supported, so that changing a restored archive does not change the
+    cached one.
+    When the archives are larger than `max_size`, the least recently used
+    ones are removed.
+    """
+
+    def __init__(self, filesystem, segments, max_size=ARCHIVE_CACHE_SIZE):
+        self._fs = filesystem
+        self._segments = segments
+        self._max_size = max_size
+
+    def getKey(self, manifest):
+        """
+        Return the cache key for `manifest`.
+        """
+        content = json.dumps(manifest, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(content).hexdigest()
+
+    def restore(self, key, destination):
+        """
+        Create `destination` from the archive with `key`.
+
+        Returns False when the archive is not in the cache.
+        """
+        path = self._fs.join(self._segments + [key])
+        if not os.path.isfile(path):
+            return False
+
+        # The modification time is used to find the least recently used.
+        os.utime(path, None)
+        # The destination might still be a hard link to a cached archive.
+        if self._fs.exists(destination):
+            self._fs.deleteFile(destination)
+        self._fs.copyFile(self._segments + [key], destination)
+        return True
+
+    def add(self, key, source):
+        """
+        Add the archive from `source` as `key`.
+        """
+        self._fs.createFolder(self._segments, recursive=True)
+        target = self._segments + [key]
+        if self._fs.exists(target):
+            self._fs.deleteFile(target)
+        self._fs.copyFile(source, target)
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used archives, until the cache is
+        smaller than the maximum size.
+        """
+        folder = self._fs.join(self._segments)
+        entries = []
+        for name in os.listdir(folder):
+            status = os.stat(os.path.join(folder, name))
+            entries.append((status.st_mtime, status.st_size, name))
+        entries.sort()
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in entries:
+            if size <= self._max_size:
+                break
+            os.remove(os.path.join(folder, name))
+            size -= entry_size
+
+
+class ChecksumFile(object):
+    """
+    A file storing sha256 checksums for files.
+
+    It can be used as a context manager to add files in a batch, which
+    is written at exit in a single atomic write, sorted by path::
+
+        with ChecksumFile(segments, paver) as checksums:
+            checksums.addFiles(paths)
+
+    The content from a previous run is replaced by the first write.
+    """
+
+    def __init__(self, segments, paver):
+        """
+        `paver` is the BrinkPaver used for accessing and hashing the files.
+        """
+        self._segments = segments
+        self._paver = paver
+        self._batch = None
+        # Whether the file was already written by this instance.
+        self._written = False
+
+    def __enter__(self):
+        self._batch = []
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        batch = self._batch
+        self._batch = None
+        if exception_type is not None:
+            # Keep the previous content.
+            return
+
+        lines = []
+        if self._written:
+            lines = self._paver.fs.getFileContentAsList(
+                self._segments, strip_newline=False)
+        lines.extend(batch)
+        lines.sort(key=self._getPath)
+        self._paver.fs.writeContentToFile(
+            destination=self._segments, content=''.join(lines), atomic=True)
+        self._written = True
+        if self._paver.digest_cache is not None:
+            self._paver.digest_cache.save()
+
+    def addFile(self, file_path):
+        """
+        Add file to file listed in checksum file.
+        """
+        self._addLine(self._paver.createSHA256Sum([file_path]), file_path)
+
+    def addFiles(self, file_paths):
+        """
+        Add all files from the `file_paths` list or iterator.
+
+        The files are hashed in parallel.
+        """
+        file_paths = list(file_paths)
+        digests = self._paver.createDigestsForFiles(
+            [[file_path] for file_path in file_paths], algorithms=['sha256'])
+        for file_path, digest in zip(file_paths, digests):
+            self._addLine(digest['sha256'], file_path)
+
+    def _addLine(self, digest, file_path):
+        """
+        Add the checksum line for `file_path`.
+        """
+        content = digest + '  ' + file_path + '\n'
+        if self._batch is not None:
+            self._batch.append(content)
+            return
+        if not self._written:
+            self._paver.fs.createEmptyFile(target=self._segments)
+            self._written = True
+        self._paver.fs.appendContentToFile(
+            destination=self._segments, content=content)
+
+    def verify(self):
+        """
+        Check the files listed in the checksum file.
+
+        Returns the list of paths which are missing or have a different
+        checksum.
+        The files are always read, without using the digest cache.
+        """
+        failures = []
+        expected = []
+        for line in self._paver.fs.getFileContentAsList(self._segments):
+            if not line:
+                continue
+            digest, file_path = line.split('  ', 1)
+            if not self._paver.fs.isFile([file_path]):
+                failures.append(file_path)
+                continue
+            expected.append((digest, file_path))
+
+        digests = self._paver.createDigestsForFiles(
+            [[file_path] for _, file_path in expected],
+            algorithms=['sha256'],
+            use_cache=False,
+            )
+        for (digest, file_path), result in zip(expected, digests):
+            if result['sha256'] != digest:
+                failures.append(file_path)
+        return failures
+
+    def _getPath(self, line):
+        """
+        Return the path from a checksum line.
+        """
+        return line.split('  ', 1)[1]
+
 
 class BrinkPaver(object):
     """
@@ -38,6 +348,10 @@ class BrinkPaver(object):
         self.python_version = self._default_values['python_version']
 
         self.fs = BrinkFilesystem()
+        # Set to a DigestCache to reuse the digests of unchanged files.
+        self.digest_cache = None
+        # Set to an ArchiveCache to reuse the archives of unchanged files.
+        self.archive_cache = None
         self.path = ProjectPaths(
             os_name=self.os_name,
             build_folder_name=self._default_values['build_folder'],
@@ -83,6 +397,14 @@ class BrinkPaver(object):
         """
         return execute(*args, **kwargs)
 
+    def executeMany(self, *args, **kwargs):
+        """
+        Shortcut to execute_many function.
+
+        Run independent commands in parallel.
+        """
+        return execute_many(*args, **kwargs)
+
     def pip(self, command='install', arguments=None,
             exit_on_errors=True, index_url=None, only_cache=False,
             install_hook=None, silent=False):
@@ -102,7 +424,7 @@ class BrinkPaver(object):
         from pip import main
 
         pip_build_path = [self.path.build, 'pip-build']
-        self.fs.deleteFolder(pip_build_path)
+        self.fs.deleteFolder(pip_build_path, background=True)
 
         if index_url is None:
             index_url = self.setup['pypi']['index_url']
@@ -178,82 +500,238 @@ class BrinkPaver(object):
             hostname = hostname[3:]
         return hostname
 
-    def createTarGZArchive(self, folder_name):
-        tar_name = folder_name + '.tar'
-        tar_command = [
-            'pax', '-wf', tar_name, folder_name]
-        execute(tar_command)
-        gzip_command = ['gzip', '-f', tar_name]
-        execute(gzip_command)
+    def getCompressionPolicy(self):
+        """
+        Return the CompressionPolicy for the product archives.
+        """
+        product = self.setup.get('product', {})
+        return CompressionPolicy.fromConfiguration(
+            product.get('compression', {}))
 
-    def createZipArchive(self, source, destination, exclude=None):
+    def createTarGZArchive(self, folder_name, max_workers=None):
         """
-        Create a zip file at `destination` based on files from `source`.
+        Create `folder_name`.tar.gz with the content of `folder_name`.
+
+        The archive is compressed in parallel using at most `max_workers`
+        threads.
+        Modification times are limited to SOURCE_DATE_EPOCH, when defined.
+        Files are stored based on the product compression policy.
         """
+        mtime = os.environ.get('SOURCE_DATE_EPOCH', None)
+        if mtime is not None:
+            mtime = int(mtime)
+        policy = self.getCompressionPolicy()
+
+        def create():
+            create_tar_gz_archive(
+                folder_name,
+                folder_name + '.tar.gz',
+                max_workers=max_workers,
+                mtime=mtime,
+                policy=policy,
+                )
+
+        self._createCachedArchive(
+            source=[folder_name],
+            destination=[folder_name + '.tar.gz'],
+            options={
+                'type': 'tar.gz',
+                'name': folder_name,
+                'mtime': mtime,
+                'policy': self._getPolicyOptions(policy),
+                },
+            create=create,
+            )
+
+    def createZipArchive(
+            self, source, destination, exclude=None, max_workers=None):
         """
         Create a zip file at `destination` based on files from `source`.
+
+        Files are compressed in parallel using at most `max_workers`
+        threads and are written in sorted order.
+        Files are stored based on the product compression policy.
         """
         if exclude is None:
             exclude = []
+        policy = self.getCompressionPolicy()
+
+        def create():
+            create_zip_archive(
+                self.fs.join(source),
+                self.fs.join(destination),
+                exclude=exclude,
+                max_workers=max_workers,
+                policy=policy,
+                )
+
+        self._createCachedArchive(
+            source=source,
+            destination=destination,
+            options={
+                'type': 'zip',
+                'exclude': sorted(exclude),
+                'policy': self._getPolicyOptions(policy),
+                },
+            create=create,
+            )
 
+    def getArchiveManifest(self, source, options):
+        """
+        Return the manifest of an archive for `source` created with
+        `options`.
+
+        It has the path, mode and size of each member, the SHA-256 of
+        files and the target of symbolic links.
+        """
         source_path = self.fs.join(source)
         parent_path = os.path.dirname(source_path)
-        archivename = self.fs.join(destination)
-        with closing(ZipFile(archivename, 'w', ZIP_DEFLATED)) as z:
-            for root, dirs, files in os.walk(source_path):
-                # Write all files.
-                for fn in files:
-                    if fn in exclude:
-                        continue
-                    absolute_filename = os.path.join(root, fn)
-                    zip_filename = absolute_filename[len(parent_path):]
-                    # See http://bugs.python.org/issue1734346
-                    # for adding unicode support.
-                    z.write(str(absolute_filename), str(zip_filename))
-
-                # For empty folders, we need to create a special ZipInfo
-                # entry.
-                # 16 works, but some places suggest using 48.
-                if not files and not dirs:
-                    foldername = root[len(parent_path):] + '/'
-                    zip_info = ZipInfo(foldername)
-                    zip_info.external_attr = 16
-                    z.writestr(zip_info, "")
+        members = []
+        files = []
+        for root, dirs, names in os.walk(source_path):
+            dirs.sort()
+            paths = [root]
+            paths.extend(os.path.join(root, name) for name in sorted(names))
+            # Links to folders are listed as folders, but are not followed.
+            paths.extend(
+                os.path.join(root, name) for name in dirs
+                if os.path.islink(os.path.join(root, name))
+                )
+            for path in paths:
+                status = os.lstat(path)
+                member = [_to_text(path[len(parent_path):]), status.st_mode]
+                if stat.S_ISLNK(status.st_mode):
+                    member.append(_to_text(os.readlink(path)))
+                elif stat.S_ISREG(status.st_mode):
+                    member.append(status.st_size)
+                    files.append((member, path))
+                members.append(member)
+
+        digests = self.createDigestsForFiles(
+            [[path] for _, path in files], algorithms=['sha256'])
+        for (member, _), digest in zip(files, digests):
+            member.append(digest['sha256'])
+
+        return {
+            'version': _ARCHIVE_CACHE_VERSION,
+            'options': options,
+            'members': members,
+            }
+
+    def _createCachedArchive(self, source, destination, options, create):
+        """
+        Call `create` to create the archive at `destination`, unless an
+        archive for the same `source` and `options` is cached.
+        """
+        cache = self.archive_cache
+        if cache is None:
+            create()
+            return
+
+        key = cache.getKey(self.getArchiveManifest(source, options))
+        if cache.restore(key, destination):
+            print('Using cached archive for %s.' % (
+                _to_text(self.fs.join(destination)),))
+            return
+
+        # The destination might be a hard link to a cached archive.
+        if self.fs.exists(destination):
+            self.fs.deleteFile(destination)
+        create()
+        cache.add(key, destination)
+
+    def _getPolicyOptions(self, policy):
+        """
+        Return the options of the CompressionPolicy `policy` used for
+        creating archives.
+        """
+        return {
+            'store': list(policy.store),
+            'deflate': list(policy.deflate),
+            'store_ratio': policy.store_ratio,
+            'probe_size': policy.probe_size,
+            }
 
     def createMD5Sum(self, source):
         '''
         Returns an MD5 hash for the file specified by file_path.
         '''
-        md5hash = md5()
-
-        with open(self.fs.join(source), 'rb') as input_file:
-            while True:
-                read_buffer = input_file.read(8096)
-                if not read_buffer:
-                    break
-                md5hash.update(read_buffer)
-
-            result = md5hash.hexdigest()
-
-        return result
+        return self.createDigests(source, algorithms=['md5'])['md5']
 
     def createSHA256Sum(self, source):
         '''
         Returns an SHA256 hash for the file specified by file_path.
         '''
-        shahash = sha256()
+        return self.createDigests(source, algorithms=['sha256'])['sha256']
+
+    def createDigests(
+            self, source, algorithms=('md5', 'sha256'), use_cache=True):
+        """
+        Return a dictionary with the hex digest of the file for each of the
+        hashlib `algorithms`.
 
-        with open(self.fs.join(source), 'rb') as input_file:
+        The file is read only once and each buffer is passed to all
+        hashes.
+        When `use_cache` is False, the file is always read, but the digest
+        cache is still updated.
+        """
+        path = self.fs.join(source)
+        cache = self.digest_cache
+        if cache is not None:
+            key = cache.getKey(path)
+            result = cache.get(key, algorithms)
+            if use_cache and result is not None:
+                return result
+
+        hashes = [
+            (algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+        read_buffer = bytearray(DIGEST_BUFFER_SIZE)
+        view = memoryview(read_buffer)
+
+        with io.open(path, 'rb', buffering=0) as input_file:
             while True:
-                read_buffer = input_file.read(8096)
-                if not read_buffer:
+                size = input_file.readinto(read_buffer)
+                if not size:
                     break
-                shahash.update(read_buffer)
-
-            result = shahash.hexdigest()
+                for _, file_hash in hashes:
+                    file_hash.update(view[:size])
 
+        result = dict(
+            (algorithm, file_hash.hexdigest())
+            for algorithm, file_hash in hashes
+            )
+        if cache is not None:
+            cache.set(key, result)
         return result
 
+    def createDigestsForFiles(
+            self, sources, algorithms=('md5', 'sha256'), max_workers=None,
+            use_cache=True):
+        """
+        Return the list of digests for each of the `sources`, as returned
+        by `createDigests`.
+
+        Files are hashed in parallel, using at most `max_workers` threads,
+        as hashlib releases the GIL while hashing large buffers.
+        The digest cache is saved at the end.
+        """
+        sources = list(sources)
+        if not sources:
+            return []
+
+        def digest(source):
+            """
+            Called in a worker thread.
+            """
+            return self.createDigests(
+                source, algorithms=algorithms, use_cache=use_cache)
+
+        results = _run_parallel(digest, sources, max_workers)
+
+        if self.digest_cache is not None:
+            self.digest_cache.save()
+        return results
+
     def createNSIS(
             self, folder_name, product_name, product_version,
             product_url, product_publisher, platform='win-x86'):
@@ -310,7 +788,7 @@ class BrinkPaver(object):
         try:
             with self.fs.changeFolder([target]):
                 print("Executing %s" % make_nsis_command)
-                subprocess.call(make_nsis_command)
+                call(make_nsis_command)
         except OSError as os_error:
             if os_error.errno != 2:
                 raise
@@ -361,23 +839,26 @@ class BrinkPaver(object):
         """
         tmp_file_path = self.fs.getEncodedPath(file_path + '.tmp')
         file_path = self.fs.getEncodedPath(file_path)
-        write_file = open(tmp_file_path, 'wb')
-        read_file = open(file_path, 'rU')
-        for line in read_file:
-            # Only discard newline from the end.
-            line = line.rstrip('\n')
-            write_file.write(line + '\r\n')
-        write_file.close()
-        read_file.close()
+        with open(tmp_file_path, 'wb') as write_file:
+            for line in self.fs.iterLines([file_path]):
+                # Only discard newline from the end.
+                if line.endswith(b'\n'):
+                    line = line[:-1]
+                if line.endswith(b'\r'):
+                    line = line[:-1]
+                write_file.write(line + b'\r\n')
         os.remove(file_path)
         os.rename(tmp_file_path, file_path)
 
-    def rsync(self, username, hostname, source, destination, verbose=False):
+    def rsync(
+            self, username, hostname, source, destination, verbose=False,
+            timeout=None):
         """
         Executes the external rsync command using SSH.
 
         `source` is specified as local path segments.
         `destination` is path as string.
+        `timeout` is the number of seconds after which rsync is stopped.
         """
         destination_uri = '%s@%s:%s' % (username, hostname, destination)
         if self.os_name == 'win':
@@ -402,7 +883,7 @@ class BrinkPaver(object):
         command.append(self.fs.join(source))
         command.append(destination_uri)
         exit_code, result = self.execute(
-            command=command, output=sys.stdout)
+            command=command, output=sys.stdout, timeout=timeout)
         if exit_code:
             print("Failed to execute rsync.")
             sys.exit(exit_code)
@@ -16,11 +16,13 @@ import warnings
 
 from brink.pavement_commons import (
     actions_try,
+    benchmark_archives,
     buildbot_list,
     buildbot_try,
     codecov_publish,
     coverage_prepare,
     default,
+    execute_trace,
     github,
     harness,
     help,
@@ -51,11 +53,13 @@ from paver.tasks import environment
 
 # Make pylint shut up.
 actions_try
+benchmark_archives
 buildbot_list
 buildbot_try
 codecov_publish
 coverage_prepare
 default
+execute_trace
 github,
 harness
 help
@@ -304,19 +308,19 @@ def build():
     build_target = pave.fs.join([pave.path.build, 'setup-build'])
 
     # Delete 1-st stage of build use by Python packaging.
-    pave.fs.deleteFolder([build_target])
+    pave.fs.deleteFolder([build_target], background=True)
     # Delete brink package from site-packages.
-    pave.fs.deleteFolder([
-        pave.path.build, pave.getPythonLibPath(), 'brink'])
+    pave.fs.deleteFolder(
+        [pave.path.build, pave.getPythonLibPath(), 'brink'], background=True)
 
     sys.argv = ['setup.py', 'build', '--build-base', build_target]
     print("Building in ", build_target)
 
-    pave.fs.deleteFolder(
-        [pave.path.build, 'doc_source'])
     pave.fs.copyFolder(
         source=['documentation'],
-        destination=[pave.path.build, 'doc_source'])
+        destination=[pave.path.build, 'doc_source'],
+        sync=True,
+        )
     pave.fs.createFolder([pave.path.build, 'doc_source', '_static'])
 
     # Remove the build helpers.